@@ -0,0 +1,88 @@
+"""
+Random column read latency of GCTX files written with cmapPy's default layout and with
+cmapBQ.utils.formats.write_gctx at several chunk shapes and codecs.
+
+    python benchmarks/gctx_read.py --ncol 20000 --nread 50
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import warnings
+from statistics import median
+
+import numpy as np
+import pandas as pd
+from cmapPy.pandasGEXpress.GCToo import GCToo
+from cmapPy.pandasGEXpress.parse_gctx import parse as parse_gctx
+from cmapPy.pandasGEXpress.write_gctx import write as cmappy_write_gctx
+
+from cmapBQ.utils.formats import write_gctx
+
+LAYOUTS = [
+    ("contiguous (cmapPy write)", None),
+    ("contiguous", dict()),
+    ("contiguous, float16", dict(dtype="float16")),
+    ("chunk 256, gzip 4", dict(chunk_cols=256, compression="gzip", compression_level=4)),
+    ("chunk 64, gzip 4", dict(chunk_cols=64, compression="gzip", compression_level=4)),
+    ("chunk 16, gzip 4", dict(chunk_cols=16, compression="gzip", compression_level=4)),
+    ("chunk 4, gzip 1", dict(chunk_cols=4, compression="gzip", compression_level=1)),
+    ("chunk 4, lzf", dict(chunk_cols=4, compression="lzf")),
+    ("chunk 4, gzip 1, float16", dict(chunk_cols=4, compression="gzip", compression_level=1, dtype="float16")),
+]
+
+
+def make_gctoo(nrow, ncol, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(nrow, ncol)).round(4).astype(np.float32)
+    data_df = pd.DataFrame(
+        values,
+        index=pd.Index([str(i) for i in range(nrow)], name="rid"),
+        columns=pd.Index(["sig_{}".format(i) for i in range(ncol)], name="cid"),
+    )
+    return GCToo(data_df)
+
+
+def time_reads(path, cids, nread, repeat, seed=1):
+    rng = np.random.default_rng(seed)
+    times = []
+    for _ in range(repeat):
+        subset = list(rng.choice(cids, size=nread, replace=False))
+        start = time.perf_counter()
+        parse_gctx(path, cid=subset)
+        times.append(time.perf_counter() - start)
+    return median(times)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Compare random column reads across GCTX layouts")
+    parser.add_argument("--nrow", help="Number of rows (genes)", type=int, default=978)
+    parser.add_argument("--ncol", help="Number of columns (signatures)", type=int, default=20000)
+    parser.add_argument("--nread", help="Columns read per request", type=int, default=50)
+    parser.add_argument("--repeat", help="Requests timed per layout", type=int, default=20)
+    args = parser.parse_args(argv)
+    warnings.simplefilter("ignore", FutureWarning)
+
+    gctoo = make_gctoo(args.nrow, args.ncol)
+    cids = list(gctoo.data_df.columns)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print("{:<28} {:>10} {:>12} {:>12}".format("layout", "size MB", "write s", "read ms"))
+        for name, options in LAYOUTS:
+            path = os.path.join(tmp, "{}.gctx".format(len(os.listdir(tmp))))
+            start = time.perf_counter()
+            if options is None:
+                cmappy_write_gctx(gctoo, path)
+            else:
+                write_gctx(gctoo, path, **options)
+            write_time = time.perf_counter() - start
+
+            read_time = time_reads(path, cids, args.nread, args.repeat)
+            print("{:<28} {:>10.1f} {:>12.2f} {:>12.1f}".format(
+                name, os.path.getsize(path) / 2 ** 20, write_time, read_time * 1000
+            ))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,77 @@
+"""
+Cold-start benchmark for the cmapBQ CLI. Each entry point is imported in a fresh interpreter and the
+median wall time is compared to a budget. Exits with status 1 if any entry point is over budget or
+loads a heavy dependency at import.
+
+    python benchmarks/import_time.py --budget 0.3
+"""
+import sys
+import json
+import argparse
+import subprocess
+from statistics import median
+
+ENTRY_POINTS = [
+    "cmapBQ.cli",
+    "cmapBQ.utils",
+    "cmapBQ.config",
+    "cmapBQ.query",
+    "cmapBQ.tools.batch",
+    "cmapBQ.tools.cmap_compounds",
+    "cmapBQ.tools.cmap_matrix",
+    "cmapBQ.tools.replicate",
+]
+
+HEAVY_MODULES = ["google.cloud.bigquery", "google.cloud.storage", "pandas", "numpy", "pyarrow", "cmapPy"]
+
+_SNIPPET = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def time_import(module, repeat=5):
+    """
+    Import a module in fresh interpreters.
+
+    :param module: dotted module name
+    :param repeat: number of interpreters to start
+    :return: (median seconds, list of heavy modules loaded)
+    """
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", _SNIPPET.format(module=module, heavy=HEAVY_MODULES)],
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        result = json.loads(out.decode().strip().splitlines()[-1])
+        times.append(result["elapsed"])
+        loaded = result["loaded"]
+    return median(times), loaded
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Measure cold import time of cmapBQ entry points")
+    parser.add_argument("--budget", help="Seconds allowed per entry point", type=float, default=0.3)
+    parser.add_argument("--repeat", help="Interpreters started per entry point", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module in ENTRY_POINTS:
+        elapsed, loaded = time_import(module, repeat=args.repeat)
+        over = elapsed > args.budget or bool(loaded)
+        failed = failed or over
+        print("{:<32} {:.3f}s {}{}".format(
+            module, elapsed, "OVER BUDGET " if elapsed > args.budget else "",
+            "loads {}".format(", ".join(loaded)) if loaded else "",
+        ))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,272 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+    Result cache for metadata queries. Results are keyed on the normalized query text, the project and
+    credentials of the client and the last-modified time of the tables it reads, so a table update invalidates
+    its cached results and clients with different credentials do not share them.
+
+    Results are held in an in-memory LRU tier and, if cache_dir is set, an on-disk Arrow IPC tier.
+    Entries in both tiers expire after ttl seconds. Results larger than max_result_bytes are not cached.
+
+    Cached DataFrames are returned without copying, so repeated calls return the same object. Copy a result
+    before modifying it in place.
+    """
+
+    def __init__(self, maxsize=128, ttl=3600, cache_dir=None, modified_ttl=300,
+                 max_result_bytes=64 * 2 ** 20, max_bytes=512 * 2 ** 20):
+        """
+        :param maxsize: Maximum number of results held in memory
+        :param ttl: Seconds a cached result stays valid
+        :param cache_dir: Directory for the on-disk Arrow tier. None disables the disk tier.
+        :param modified_ttl: Seconds a table's last-modified time is reused before it is looked up again
+        :param max_result_bytes: Results using more memory than this are returned without being cached
+        :param max_bytes: Maximum memory held by the in-memory tier, least recently used results are evicted first
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.modified_ttl = modified_ttl
+        self.max_result_bytes = max_result_bytes
+        self.max_bytes = max_bytes
+
+        self._results = OrderedDict()
+        self._nbytes = 0
+        self._modified = {}
+        self._lock = threading.Lock()
+
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_or_run(self, client, query, tables, run):
+        """
+        Return cached result for query or call run() and cache its result.
+
+        :param client: BigQuery Client, used to look up table modification times
+        :param query: Query string
+        :param tables: list of table addresses read by the query
+        :param run: Callable with no arguments returning a Pandas DataFrame
+        :return: Pandas DataFrame, shared with the cache
+        """
+        key = self._make_key(client, query, tables)
+
+        result = self._get_memory(key)
+        if result is None:
+            result = self._get_disk(key)
+            if result is not None:
+                self._put_memory(key, result, _result_bytes(result, self.max_result_bytes))
+        if result is not None:
+            return result
+
+        result = run()
+        nbytes = _result_bytes(result, self.max_result_bytes)
+        if nbytes > self.max_result_bytes:
+            return result
+        self._put_memory(key, result, nbytes)
+        self._put_disk(key, result)
+        return result
+
+    def clear(self):
+        """
+        Remove all entries from the memory and disk tiers.
+
+        :return: None
+        """
+        with self._lock:
+            self._results.clear()
+            self._modified.clear()
+            self._nbytes = 0
+        if self.cache_dir is not None:
+            for fn in os.listdir(self.cache_dir):
+                if fn.endswith(".arrow"):
+                    os.remove(os.path.join(self.cache_dir, fn))
+
+    def _make_key(self, client, query, tables):
+        identity = client_identity(client)
+        modified = [
+            "{}:{}".format(table, self._get_modified(client, table, identity)) for table in sorted(set(tables))
+        ]
+        key = "|".join([normalize_query(query), identity] + modified)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _get_modified(self, client, table, identity):
+        now = time.time()
+        # Looked up per identity, a client without metadata access must not reuse another client's lookup
+        lookup = (identity, table)
+        with self._lock:
+            if lookup in self._modified and now - self._modified[lookup][0] < self.modified_ttl:
+                return self._modified[lookup][1]
+
+        try:
+            modified = client.get_table(table.replace("`", "")).modified
+        except Exception:
+            # Tables without metadata access are only invalidated by ttl
+            modified = None
+
+        with self._lock:
+            self._modified[lookup] = (now, modified)
+        return modified
+
+    def _get_memory(self, key):
+        with self._lock:
+            if key not in self._results:
+                return None
+            created, result, nbytes = self._results[key]
+            if time.time() - created > self.ttl:
+                del self._results[key]
+                self._nbytes -= nbytes
+                return None
+            self._results.move_to_end(key)
+            return result
+
+    def _put_memory(self, key, result, nbytes):
+        if nbytes > self.max_result_bytes:
+            return
+        with self._lock:
+            if key in self._results:
+                self._nbytes -= self._results[key][2]
+            self._results[key] = (time.time(), result, nbytes)
+            self._results.move_to_end(key)
+            self._nbytes += nbytes
+            while len(self._results) > self.maxsize or (self._nbytes > self.max_bytes and len(self._results) > 1):
+                self._nbytes -= self._results.popitem(last=False)[1][2]
+
+    def _get_disk(self, key):
+        if self.cache_dir is None:
+            return None
+        path = os.path.join(self.cache_dir, "{}.arrow".format(key))
+        if not os.path.exists(path):
+            return None
+        if time.time() - os.path.getmtime(path) > self.ttl:
+            os.remove(path)
+            return None
+
+        import pyarrow.feather as feather
+        return feather.read_table(path).to_pandas()
+
+    def _put_disk(self, key, result):
+        if self.cache_dir is None:
+            return
+        import pyarrow as pa
+        import pyarrow.feather as feather
+
+        path = os.path.join(self.cache_dir, "{}.arrow".format(key))
+        try:
+            table = pa.Table.from_pandas(result, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            print("Result could not be converted to Arrow, skipping disk cache")
+            return
+        tmp_path = path + ".tmp"
+        feather.write_feather(table, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def _result_bytes(result, limit):
+    """
+    Memory used by a DataFrame. Results whose fixed-width size alone exceeds limit are not measured further,
+    since measuring object columns walks every value.
+
+    :return: Number of bytes
+    """
+    nbytes = int(result.memory_usage(index=True, deep=False).sum())
+    if nbytes > limit:
+        return nbytes
+    return int(result.memory_usage(index=True, deep=True).sum())
+
+
+def client_identity(client):
+    """
+    Project and account a client runs queries as. Service accounts are identified by their email and user
+    credentials by their refresh token; other credentials only match the same credentials object.
+
+    :param client: BigQuery Client
+    :return: Identity string
+    """
+    # bigquery.Client has no public accessor for the credentials it was created with
+    credentials = getattr(client, "_credentials", None)
+    account = client_principal(client)
+    if account is None:
+        account = "id={}".format(id(client) if credentials is None else id(credentials))
+    return "{}|{}|{}".format(getattr(client, "project", None), type(credentials).__name__, account)
+
+
+def client_principal(client):
+    """
+    Account a client runs queries as, stable across processes. Service accounts are identified by their email
+    and user credentials by their refresh token.
+
+    :param client: BigQuery Client
+    :return: Principal string, or None if the credentials do not expose one
+    """
+    credentials = getattr(client, "_credentials", None)
+    for attr in ("service_account_email", "signer_email", "refresh_token"):
+        value = getattr(credentials, attr, None)
+        if isinstance(value, str) and value and value != "default":
+            return "{}={}".format(attr, value)
+    return None
+
+
+def normalize_query(query):
+    """
+    Collapse whitespace in a query string so formatting differences map to the same cache key.
+
+    :param query: Query string
+    :return: Normalized query string
+    """
+    return re.sub(r"\s+", " ", query).strip()
+
+
+_query_cache = QueryCache()
+_cache_enabled = True
+
+
+def get_query_cache():
+    """
+    Return the active QueryCache, or None if caching is disabled.
+
+    :return: QueryCache
+    """
+    if _cache_enabled:
+        return _query_cache
+    return None
+
+
+def configure_cache(maxsize=128, ttl=3600, cache_dir=None, modified_ttl=300, max_result_bytes=64 * 2 ** 20,
+                    max_bytes=512 * 2 ** 20, enabled=True):
+    """
+    Replace the active query cache. Cached results are shared between calls, copy a result before modifying it
+    in place.
+
+    :param maxsize: Maximum number of results held in memory
+    :param ttl: Seconds a cached result stays valid. Default 1 hour.
+    :param cache_dir: Directory for the on-disk Arrow tier, e.g. ~/.cmapBQ/cache. Default None (memory only)
+    :param modified_ttl: Seconds a table's last-modified time is reused before it is looked up again
+    :param max_result_bytes: Results using more memory than this are not cached. Default 64 MiB
+    :param max_bytes: Maximum memory held by cached results. Default 512 MiB
+    :param enabled: Set False to disable caching
+    :return: QueryCache
+    """
+    global _query_cache, _cache_enabled
+    if cache_dir is not None:
+        cache_dir = os.path.expanduser(cache_dir)
+    _query_cache = QueryCache(
+        maxsize=maxsize, ttl=ttl, cache_dir=cache_dir, modified_ttl=modified_ttl,
+        max_result_bytes=max_result_bytes, max_bytes=max_bytes,
+    )
+    _cache_enabled = enabled
+    return _query_cache
+
+
+def clear_cache():
+    """
+    Clear the active query cache.
+
+    :return: None
+    """
+    _query_cache.clear()
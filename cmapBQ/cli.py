@@ -1,4 +1,6 @@
+import os
 import sys
+import ast
 import traceback
 import pkgutil, inspect
 import cmapBQ
@@ -14,22 +16,76 @@ def run_tool(toolname, *argv):
     tool(*argv)
 
 
-def print_help():
+def _tools_dir():
+    return inspect.getabsfile(cmapBQ).replace("__init__.py", "tools")
+
+
+def list_tools():
+    """
+    Names of tools in cmapBQ/tools
+
+    :return: list of tool names
+    """
+    return [name for _, name, _ in pkgutil.iter_modules([_tools_dir()])]
+
+
+def get_tool_info(toolname):
+    """
+    Read a tool's description and arguments from its source without importing it, so listing tools
+    does not load BigQuery, pandas or cmapPy.
+
+    :param toolname: Name of tool module
+    :return: dict with 'name', 'description' and 'args', a list of (flags, help) tuples
+    """
+    path = os.path.join(_tools_dir(), "{}.py".format(toolname))
+    with open(path, "r") as fh:
+        tree = ast.parse(fh.read(), filename=path)
+
+    info = {"name": toolname, "description": "", "args": []}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            if node.targets[0].id == "description":
+                info["description"] = _literal(node.value, default="")
+
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and node.func.attr == "add_argument"
+        ):
+            flags = [_literal(arg) for arg in node.args]
+            help_text = [_literal(kw.value, default="") for kw in node.keywords if kw.arg == "help"]
+            info["args"].append((", ".join(f for f in flags if f), help_text[0] if help_text else ""))
+    return info
+
+
+def _literal(node, default=None):
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError):
+        return default
+
+
+def print_help(toolname=None):
+    if toolname is not None:
+        print_tool_help(toolname)
+        return
     print("cmapBQ: Toolkit for interacting with Google BigQuery and CMAP datasets\n")
     print("Avaliable tools:")
     print_tools()
 
 
+def print_tool_help(toolname):
+    info = get_tool_info(toolname)
+    print("{}: {}\n".format(info["name"], info["description"]))
+    for flags, help_text in info["args"]:
+        print("  {:<24} {}".format(flags, " ".join(help_text.split())))
+
+
 def print_tools():
-    tool_list = [
-        name
-        for _, name, _ in pkgutil.iter_modules(
-            [inspect.getabsfile(cmapBQ).replace("__init__.py", "tools")]
-        )
-    ]
     print("Tools:")
-    for tool in tool_list:
-        print(tool)
+    for tool in list_tools():
+        print("{:<16} {}".format(tool, get_tool_info(tool)["description"]))
 
 
 def main(argv=None):
@@ -38,7 +94,7 @@ def main(argv=None):
         sys.exit(0)
 
     if argv[1] == "help":
-        print_help()
+        print_help(argv[2] if len(argv) > 2 else None)
     else:
         try:
             run_tool(argv[1], argv[2:])
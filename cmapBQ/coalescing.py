@@ -0,0 +1,139 @@
+import time
+import threading
+from concurrent.futures import Future
+
+
+class RequestCoalescer:
+    """
+    Merge concurrent requests for ids from the same table into one query. The first request for a key opens
+    a batch and waits window seconds; requests with the same key arriving in that time add their ids to the
+    batch. One query is run over the union of ids and each caller receives only its own slice.
+
+    Requests whose ids are all covered by a batch that is already running wait for that batch instead of
+    starting another, so identical in-flight requests share one job.
+    """
+
+    def __init__(self, window=0.05, max_ids=10000):
+        """
+        :param window: Seconds a batch stays open for more requests
+        :param max_ids: Maximum number of ids merged into one batch
+        """
+        self.window = window
+        self.max_ids = max_ids
+        self.requests = 0
+        self.batches = 0
+
+        self._pending = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, key, ids, run, select):
+        """
+        Return this caller's part of a merged request.
+
+        :param key: Hashable key, see request_key. Only requests with equal keys are merged.
+        :param ids: list of ids requested by this caller
+        :param run: Callable taking a list of ids and returning the result for all of them
+        :param select: Callable taking a result and a list of ids and returning the part for those ids
+        :return: select(result, ids)
+        """
+        ids = list(dict.fromkeys(str(i) for i in ids))
+        wanted = set(ids)
+
+        with self._lock:
+            self.requests += 1
+            batch = self._find_running(key, wanted)
+            leader = False
+            if batch is None:
+                batch = self._pending.get(key)
+                if batch is None or len(batch.ids | wanted) > self.max_ids:
+                    batch = _Batch()
+                    self._pending[key] = batch
+                    leader = True
+                batch.add(ids)
+
+        if leader:
+            self._run_batch(key, batch, run)
+        return select(batch.future.result(), ids)
+
+    def _find_running(self, key, wanted):
+        for batch in self._running.get(key, []):
+            if wanted <= batch.ids:
+                return batch
+        return None
+
+    def _run_batch(self, key, batch, run):
+        time.sleep(self.window)
+        with self._lock:
+            if self._pending.get(key) is batch:
+                del self._pending[key]
+            self._running.setdefault(key, []).append(batch)
+            self.batches += 1
+
+        try:
+            batch.future.set_result(run(batch.ordered_ids))
+        except BaseException as e:
+            batch.future.set_exception(e)
+        finally:
+            with self._lock:
+                self._running[key].remove(batch)
+                if not self._running[key]:
+                    del self._running[key]
+
+
+class _Batch:
+    def __init__(self):
+        self.ids = set()
+        self.ordered_ids = []
+        self.future = Future()
+
+    def add(self, ids):
+        for i in ids:
+            if i not in self.ids:
+                self.ids.add(i)
+                self.ordered_ids.append(i)
+
+
+def request_key(*parts):
+    """
+    Hashable key from request parameters. Lists and dicts are converted to tuples.
+
+    :param parts: Request parameters
+    :return: tuple
+    """
+    return tuple(_freeze(part) for part in parts)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+_coalescer = None
+
+
+def get_coalescer():
+    """
+    Return the active RequestCoalescer, or None if request coalescing is disabled.
+
+    :return: RequestCoalescer
+    """
+    return _coalescer
+
+
+def configure_coalescing(window=0.05, max_ids=10000, enabled=True):
+    """
+    Enable request coalescing for cmap_sig and cmap_matrix, e.g. in a service answering many concurrent
+    requests with one client. Disabled by default since each batch waits window seconds for other requests.
+
+    :param window: Seconds a batch stays open for more requests. Default 0.05
+    :param max_ids: Maximum number of ids merged into one query. Default 10,000
+    :param enabled: Set False to disable coalescing
+    :return: RequestCoalescer, or None if disabled
+    """
+    global _coalescer
+    _coalescer = RequestCoalescer(window=window, max_ids=max_ids) if enabled else None
+    return _coalescer
@@ -2,8 +2,8 @@ import os
 import sys
 import yaml
 from dataclasses import dataclass
+from typing import Dict, Optional
 import dacite
-from google.cloud import bigquery
 from google.auth.exceptions import DefaultCredentialsError
 
 
@@ -34,6 +34,17 @@ class TableDirectory:
         return "\n".join(tables)
 
 
+@dataclass
+class Materialization:
+    """
+    Where large query results are written. dataset is a 'project.dataset' address the credentials can
+    create tables in; tables expire after expiration_hours. bucket is the GCS bucket used by CSV exports.
+    """
+    dataset: str
+    expiration_hours: int = 24
+    bucket: Optional[str] = None
+
+
 @dataclass
 class Configuration:
     """
@@ -41,6 +52,8 @@ class Configuration:
     """
     credentials: str
     tables: TableDirectory
+    replicas: Optional[Dict[str, str]] = None
+    materialization: Optional[Materialization] = None
 
 def _write_default_config(path):
     default_config = {
@@ -91,6 +104,65 @@ def setup_credentials(path_to_credentials):
     return
 
 
+def register_replica(table_id, replica_path):
+    """
+    Point cmap_matrix queries against table_id to a local replica built by cmapBQ.replica.build_replica.
+    Writes to ~/.cmapBQ/config.txt. A replica_path of None removes the entry.
+
+    :param table_id: Matrix table address
+    :param replica_path: Path to replica directory
+    :return: None (side effect)
+    """
+    config_path = _get_config_path()
+    if not os.path.exists(config_path):
+        _write_default_config(config_path)
+
+    with open(config_path, "r") as ymlfile:
+        cfg = yaml.safe_load(ymlfile)
+
+    replicas = cfg.get("replicas") or {}
+    if replica_path is None:
+        replicas.pop(table_id, None)
+    else:
+        replicas[table_id] = os.path.abspath(os.path.expanduser(replica_path))
+    cfg["replicas"] = replicas
+
+    with open(config_path, "w") as fh:
+        yaml.dump(cfg, fh)
+    return
+
+
+def set_materialization(dataset, expiration_hours=24, bucket=None):
+    """
+    Set the dataset large query results are materialized into, see cmapBQ.query.read_large_query.
+    Writes to ~/.cmapBQ/config.txt. A dataset of None removes the setting.
+
+    :param dataset: 'project.dataset' address of a dataset the credentials can create tables in
+    :param expiration_hours: Hours before materialized tables expire. Default 24
+    :param bucket: Optional GCS bucket for CSV exports
+    :return: None (side effect)
+    """
+    config_path = _get_config_path()
+    if not os.path.exists(config_path):
+        _write_default_config(config_path)
+
+    with open(config_path, "r") as ymlfile:
+        cfg = yaml.safe_load(ymlfile)
+
+    if dataset is None:
+        cfg.pop("materialization", None)
+    else:
+        cfg["materialization"] = {
+            "dataset": dataset,
+            "expiration_hours": int(expiration_hours),
+            "bucket": bucket,
+        }
+
+    with open(config_path, "w") as fh:
+        yaml.dump(cfg, fh)
+    return
+
+
 def _config_dir():
     PATH = os.path.expanduser("~/.cmapBQ")
     if os.path.exists(PATH):
@@ -146,16 +218,24 @@ def get_default_config():
             "setup_credentials(path_to_google_credentials)"
         )
 
+_loaded_configs = {}
+
+
 def _load_config(config_path):
     """
-    Read in config file
+    Read in config file. Parsed configs are reused until the file changes.
     :param config_path: path to YAML config file
     :return: Configuration Dataclass
     """
+    mtime = os.path.getmtime(config_path)
+    if config_path in _loaded_configs and _loaded_configs[config_path][0] == mtime:
+        return _loaded_configs[config_path][1]
+
     with open(config_path, "r") as ymlfile:
         cfg = yaml.safe_load(ymlfile)
 
     config = dacite.from_dict(data_class=Configuration, data=cfg)
+    _loaded_configs[config_path] = (mtime, config)
     return config
 
 
@@ -184,6 +264,8 @@ def get_bq_client(config=None):
     :param config: optional path to config if not default
     :return: BigQuery Client
     """
+    from google.cloud import bigquery
+
     if config is None:
         config = get_default_config()
     else:
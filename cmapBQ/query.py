@@ -1,20 +1,49 @@
 import re
 import os
-import sys
 import gzip
 import shutil
+import uuid
+import json
+import time
+import hashlib
+import threading
 from datetime import datetime
 
-from math import ceil
-import multiprocessing as mp
-
-import pandas as pd
-from google.cloud import bigquery
-from google.cloud import storage
+from concurrent.futures import ThreadPoolExecutor
 
 import cmapBQ.config as cfg
-from .utils import long_to_gctx, parse_condition
-from cmapPy.pandasGEXpress.concat import hstack
+import cmapBQ.cache as cache
+import cmapBQ.coalescing as coalescing
+from .utils import parse_condition
+
+# pandas, cmapPy, numpy and pyarrow are imported where used, so importing this module stays cheap
+
+
+_SIGINFO_PRIORITY_FIELDS = ['sig_id', 'pert_id',
+                            'cmap_name', 'pert_type', 'cell_iname', 'pert_itime',
+                            'pert_idose', 'nsample', 'det_plates', 'build_name', 'project_code',
+                            'ss_ngene', 'cc_q75',
+                            'tas']
+
+_INSTINFO_PRIORITY_FIELDS = ['sample_id', 'det_plate', 'pert_id',
+                             'cmap_name', 'pert_type', 'cell_iname', 'pert_itime',
+                             'pert_idose', 'build_name', 'project_code']
+
+# Return types of matrix queries, see cmap_matrix
+MATRIX_OUTPUTS = ["gctoo", "numpy", "arrow"]
+
+# Fields with few distinct values, returned as categoricals by metadata queries
+_CATEGORICAL_FIELDS = ['pert_type', 'cell_iname', 'pert_itime', 'pert_idose', 'pert_time', 'pert_time_unit',
+                       'pert_dose_unit', 'build_name', 'project_code', 'det_plate', 'feature_space', 'gene_type',
+                       'src', 'cell_type', 'cell_lineage', 'primary_disease', 'subtype', 'donor_sex']
+
+# Gene ids per feature_space value of geneinfo, keyed on geneinfo table. See get_feature_space_genes
+_feature_space_genes = {}
+_feature_space_lock = threading.Lock()
+# Seconds memoized gene lists are used before geneinfo's last-modified time is checked again, and the
+# lifetime of lists for a geneinfo table whose metadata cannot be read. Match the query cache defaults.
+_FEATURE_SPACE_MODIFIED_TTL = 300
+_FEATURE_SPACE_TTL = 3600
 
 
 def list_tables():
@@ -38,11 +67,12 @@ def get_bq_client():
     return cfg.get_bq_client()
 
 
-def list_cmap_moas(client):
+def list_cmap_moas(client, output="pandas"):
     """
     List available MoAs
 
     :param client: BigQuery Client
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
     :return: Single column Dataframe of MoAs
     """
     config = cfg.get_default_config()
@@ -54,14 +84,15 @@ def list_cmap_moas(client):
              'GROUP BY moa')
 
     QUERY = QUERY.format(compoundinfo_table)
-    return run_query(client, QUERY).result().to_dataframe()
+    return _fetch_result(client, QUERY, [compoundinfo_table], output=output)
 
 
-def list_cmap_targets(client):
+def list_cmap_targets(client, output="pandas"):
     """
     List available targets
 
     :param client: BigQuery Client
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
     :return: Pandas DataFrame
     """
     config = cfg.get_default_config()
@@ -74,20 +105,21 @@ def list_cmap_targets(client):
 
     QUERY = QUERY.format(compoundinfo_table)
 
-    return run_query(client, QUERY).result().to_dataframe()
+    return _fetch_result(client, QUERY, [compoundinfo_table], output=output)
 
 
-def list_cmap_compounds(client):
+def list_cmap_compounds(client, output="pandas"):
     """
     List available compounds
 
     :param client: BigQuery Client
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
     :return: Single column Dataframe of compounds
     """
     config = cfg.get_default_config()
     compoundinfo_table = config.tables.compoundinfo
     QUERY = "SELECT DISTINCT cmap_name from {}".format(compoundinfo_table)
-    return run_query(client, QUERY).result().to_dataframe()
+    return _fetch_result(client, QUERY, [compoundinfo_table], output=output)
 
 
 def cmap_genetic_perts(client,
@@ -97,7 +129,10 @@ def cmap_genetic_perts(client,
                        gene_title=None,
                        ensemble_id=None,
                        table=None,
-                       verbose=False):
+                       verbose=False,
+                       return_fields='all',
+                       categorical=True,
+                       output="pandas"):
     """
     Query genetic_pertinfo table
 
@@ -109,13 +144,17 @@ def cmap_genetic_perts(client,
     :param ensemble_id: List of ensumble_ids
     :param table: table to query. This by default points to the siginfo table and normally should not be changed.
     :param verbose: Print query and table address.
-    :return:
+    :param return_fields: 'all' or list of fields to return. Fields are checked against the table schema.
+    :param categorical: Return low-cardinality fields such as cell_iname and pert_type as categoricals
+     (dictionary-encoded for Arrow). Default is True.
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
+    :return: Pandas DataFrame
     """
     if table is None:
         config = cfg.get_default_config()
         table = config.tables.genetic_pertinfo
 
-    SELECT = "SELECT *"
+    SELECT = _get_select(client, table, return_fields)
     FROM = "FROM {}".format(table)
 
     CONDITIONS = []
@@ -146,7 +185,7 @@ def cmap_genetic_perts(client,
         print("Table: \n {}".format(table))
         print("Query:\n {}".format(query))
 
-    return run_query(client, query).result().to_dataframe()
+    return _to_categorical(_fetch_result(client, query, [table], output=output), categorical)
 
 
 def cmap_cell(client,
@@ -157,7 +196,10 @@ def cmap_cell(client,
               cell_lineage=None,
               cell_type=None,
               table=None,
-              verbose=False):
+              verbose=False,
+              return_fields='all',
+              categorical=True,
+              output="pandas"):
     """
     Query cellinfo table
 
@@ -170,13 +212,17 @@ def cmap_cell(client,
     :param cell_type: List of cell_types
     :param table: table to query. This by default points to the siginfo table and normally should not be changed.
     :param verbose: Print query and table address.
+    :param return_fields: 'all' or list of fields to return. Fields are checked against the table schema.
+    :param categorical: Return low-cardinality fields such as cell_iname and pert_type as categoricals
+     (dictionary-encoded for Arrow). Default is True.
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
     :return: Pandas DataFrame
     """
     if table is None:
         config = cfg.get_default_config()
         table = config.tables.cellinfo
 
-    SELECT = "SELECT *"
+    SELECT = _get_select(client, table, return_fields)
     FROM = "FROM {}".format(table)
 
     CONDITIONS = []
@@ -210,7 +256,7 @@ def cmap_cell(client,
         print("Table: \n {}".format(table))
         print("Query:\n {}".format(query))
 
-    return run_query(client, query).result().to_dataframe()
+    return _to_categorical(_fetch_result(client, query, [table], output=output), categorical)
 
 
 def cmap_genes(client,
@@ -222,7 +268,10 @@ def cmap_genes(client,
                feature_space="aig",
                src=None,
                table=None,
-               verbose=False):
+               verbose=False,
+               return_fields='all',
+               categorical=True,
+               output="pandas"):
     """
     Query geneinfo table. Geneinfo contains information about genes including
     ids, symbols, types, ensembl_ids, etc.
@@ -247,6 +296,10 @@ def cmap_genes(client,
     :param src: list of gene sources
     :param table: table to query. This by default points to the siginfo table and normally should not be changed.
     :param verbose: Print query and table address.
+    :param return_fields: 'all' or list of fields to return. Fields are checked against the table schema.
+    :param categorical: Return low-cardinality fields such as cell_iname and pert_type as categoricals
+     (dictionary-encoded for Arrow). Default is True.
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
     :return: Pandas DataFrame
     """
 
@@ -254,7 +307,7 @@ def cmap_genes(client,
         config = cfg.get_default_config()
         table = config.tables.geneinfo
 
-    SELECT = "SELECT *"
+    SELECT = _get_select(client, table, return_fields)
     FROM = "FROM {}".format(table)
 
     CONDITIONS = []
@@ -287,7 +340,7 @@ def cmap_genes(client,
         print("Table: \n {}".format(table))
         print("Query:\n {}".format(query))
 
-    return run_query(client, query).result().to_dataframe()
+    return _to_categorical(_fetch_result(client, query, [table], output=output), categorical)
 
 
 def cmap_sig(
@@ -306,6 +359,11 @@ def cmap_sig(
         limit=None,
         table=None,
         verbose=False,
+        iterator=False,
+        page_size=None,
+        output="pandas",
+        categorical=True,
+        coalesce=True,
 ):
     """
     Query level 5 metadata table. Multiple parameters are filtered using the 'AND' operator
@@ -322,31 +380,43 @@ def cmap_sig(
     instinfo det_plate field with the '|' delimiter used.
     :param build_name: list of builds
     :param project_code: list of project_codes
-    :param return_fields: ['priority', 'all']
+    :param return_fields: 'priority', 'all' or list of fields to return. Fields are checked against the table schema.
     :param limit: Maximum number of rows to return
     :param table: table to query. This by default points to the level 5 siginfo table and normally should not be changed.
     :param verbose: Print query and table address.
-    :return: Pandas Dataframe
+    :param iterator: Return a generator of result pages instead of the full result. Pages are yielded as they
+     are downloaded, so large results can be filtered or written to disk incrementally. Default is False.
+    :param page_size: Number of rows per page when iterator is True. Default lets BigQuery choose.
+    :param output: ['pandas', 'arrow']. Return Pandas DataFrames or pyarrow Tables (RecordBatches for pages)
+    :param categorical: Return low-cardinality fields such as cell_iname and pert_type as categoricals
+     (dictionary-encoded for Arrow). Not applied to pages. Default is True.
+    :param coalesce: If request coalescing is enabled (see cmapBQ.coalescing), merge this request with
+     concurrent requests for other sig_ids that use the same filters. Default is True.
+    :return: Pandas Dataframe, or generator of pages if iterator is True
     """
 
-    priority_fields = ['sig_id', 'pert_id',
-                       'cmap_name', 'pert_type', 'cell_iname', 'pert_itime',
-                       'pert_idose', 'nsample', 'det_plates', 'build_name', 'project_code',
-                       'ss_ngene', 'cc_q75',
-                       'tas']
+    coalescer = coalescing.get_coalescer() if coalesce else None
+    if coalescer is not None and sig_id and not iterator and not limit and _returns_field(return_fields, "sig_id"):
+        key = coalescing.request_key(
+            "cmap_sig", id(client), table, return_fields, output, categorical,
+            pert_id, pert_itime, pert_idose, pert_type, cmap_name, cell_iname, det_plates, build_name, project_code,
+        )
 
-    if return_fields == 'priority':
-        SELECT = "SELECT " + ",".join(priority_fields)
-    elif return_fields == 'all':
-        SELECT = "SELECT *"
-    else:
-        print("return_fields only takes ['priority', 'all']")
-        sys.exit(1)
+        def run(ids):
+            return cmap_sig(
+                client, sig_id=ids, pert_id=pert_id, pert_itime=pert_itime, pert_idose=pert_idose,
+                pert_type=pert_type, cmap_name=cmap_name, cell_iname=cell_iname, det_plates=det_plates,
+                build_name=build_name, project_code=project_code, return_fields=return_fields, table=table,
+                verbose=verbose, output=output, categorical=categorical, coalesce=False,
+            )
+        return coalescer.fetch(key, parse_condition(sig_id), run, lambda result, ids: _select_rows(result, "sig_id", ids))
 
     if table is None:
         config = cfg.get_default_config()
         table = config.tables.siginfo
 
+    SELECT = _get_select(client, table, return_fields, priority_fields=_SIGINFO_PRIORITY_FIELDS)
+
     FROM = "FROM {}".format(table)
 
     CONDITIONS = []
@@ -395,7 +465,9 @@ def cmap_sig(
         print("Table: \n {}".format(table))
         print("Query:\n {}".format(query))
 
-    return run_query(client, query).result().to_dataframe()
+    if iterator:
+        return _iter_query_pages(client, query, page_size=page_size, output=output)
+    return _to_categorical(_fetch_result(client, query, [table], output=output), categorical)
 
 
 def cmap_profiles(
@@ -414,6 +486,10 @@ def cmap_profiles(
         limit=None,
         table=None,
         verbose=False,
+        iterator=False,
+        page_size=None,
+        output="pandas",
+        categorical=True,
 ):
     """
     Query per sample metadata, corresponds to level 3 and level 4 data, AND operator used for multiple
@@ -429,27 +505,23 @@ def cmap_profiles(
     :param det_plate: list of det_plates
     :param build_name: list of builds
     :param project_code: list of project_codes
-    :param return_fields: ['priority', 'all']
+    :param return_fields: 'priority', 'all' or list of fields to return. Fields are checked against the table schema.
     :param limit: Maximum number of rows to return
     :param table: table to query. This by default points to the siginfo table and normally should not be changed.
     :param verbose: Print query and table address.
-    :return: Pandas Dataframe
+    :param iterator: Return a generator of result pages instead of the full result. Pages are yielded as they
+     are downloaded, so large results can be filtered or written to disk incrementally. Default is False.
+    :param page_size: Number of rows per page when iterator is True. Default lets BigQuery choose.
+    :param output: ['pandas', 'arrow']. Return Pandas DataFrames or pyarrow Tables (RecordBatches for pages)
+    :param categorical: Return low-cardinality fields such as cell_iname and pert_type as categoricals
+     (dictionary-encoded for Arrow). Not applied to pages. Default is True.
+    :return: Pandas Dataframe, or generator of pages if iterator is True
     """
     if table is None:
         config = cfg.get_default_config()
         table = config.tables.instinfo
 
-    priority_fields = ['sample_id', 'det_plate', 'pert_id',
-                       'cmap_name', 'pert_type', 'cell_iname', 'pert_itime',
-                       'pert_idose', 'det_plate', 'build_name', 'project_code']
-
-    if return_fields == 'priority':
-        SELECT = "SELECT " + ",".join(priority_fields)
-    elif return_fields == 'all':
-        SELECT = "SELECT *"
-    else:
-        print("return_fields only takes ['priority', 'all']")
-        sys.exit(1)
+    SELECT = _get_select(client, table, return_fields, priority_fields=_INSTINFO_PRIORITY_FIELDS)
 
     FROM = "FROM {}".format(table)
 
@@ -503,7 +575,9 @@ def cmap_profiles(
         print("Table: \n {}".format(table))
         print("Query:\n {}".format(query))
 
-    return run_query(client, query).result().to_dataframe()
+    if iterator:
+        return _iter_query_pages(client, query, page_size=page_size, output=output)
+    return _to_categorical(_fetch_result(client, query, [table], output=output), categorical)
 
 
 def cmap_compounds(
@@ -515,6 +589,9 @@ def cmap_compounds(
         compound_aliases=None,
         limit=None,
         verbose=False,
+        return_fields='all',
+        categorical=True,
+        output="pandas",
 ):
     """
     Query compoundinfo table for various field by providing lists of compounds, moa, targets, etc.
@@ -528,12 +605,16 @@ def cmap_compounds(
     :param compound_aliases: List of compound aliases
     :param limit: Maximum number of rows to return
     :param verbose: Print query and table address.
+    :param return_fields: 'all' or list of fields to return. Fields are checked against the table schema.
+    :param categorical: Return low-cardinality fields such as cell_iname and pert_type as categoricals
+     (dictionary-encoded for Arrow). Default is True.
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
     :return: Pandas Dataframe matching queries
     """
     config = cfg.get_default_config()
     compoundinfo_table = config.tables.compoundinfo
 
-    SELECT = "SELECT *"
+    SELECT = _get_select(client, compoundinfo_table, return_fields)
     FROM = "FROM {}".format(compoundinfo_table)
 
     CONDITIONS = []
@@ -570,7 +651,185 @@ def cmap_compounds(
         print("Table: \n {}".format(compoundinfo_table))
         print("Query:\n {}".format(query))
 
-    return run_query(client, query).result().to_dataframe()
+    return _to_categorical(_fetch_result(client, query, [compoundinfo_table], output=output), categorical)
+
+
+def cmap_lookup(
+        client,
+        conditions=None,
+        compound_conditions=None,
+        cell_conditions=None,
+        data_level="level5",
+        return_fields='priority',
+        limit=None,
+        verbose=False,
+        categorical=True,
+        output="pandas",
+):
+    """
+    Query signature (level 5) or sample (level 3/4) metadata filtered on fields of the siginfo/instinfo,
+    compoundinfo and cellinfo tables in a single query. compoundinfo is joined on pert_id and cellinfo on
+    cell_iname, so intermediate id lists never leave BigQuery. 'AND' operator used for multiple conditions.
+
+    e.g. all signatures for compounds with MoA X in lineage Y:
+
+        cmap_lookup(client, compound_conditions={'moa': ['X']}, cell_conditions={'cell_lineage': ['Y']})
+
+    :param client: BigQuery Client
+    :param conditions: dict of {field: list of values} applied to siginfo ('level5') or instinfo ('level3', 'level4')
+    :param compound_conditions: dict of {field: list of values} applied to compoundinfo
+    :param cell_conditions: dict of {field: list of values} applied to cellinfo
+    :param data_level: 'level5' returns siginfo records, 'level3' and 'level4' return instinfo records
+    :param return_fields: 'priority', 'all' or list of fields to return. Fields are checked against the table schema.
+    :param limit: Maximum number of rows to return
+    :param verbose: Print query and table address.
+    :param categorical: Return low-cardinality fields such as cell_iname and pert_type as categoricals
+     (dictionary-encoded for Arrow). Default is True.
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
+    :return: Pandas Dataframe
+    """
+    config = cfg.get_default_config()
+
+    if data_level == "level5":
+        table = config.tables.siginfo
+        priority_fields = _SIGINFO_PRIORITY_FIELDS
+    elif data_level in ["level3", "level4"]:
+        table = config.tables.instinfo
+        priority_fields = _INSTINFO_PRIORITY_FIELDS
+    else:
+        print("Unsupported data_level. select from ['level3', 'level4', level5'].\n Default is 'level5'. ")
+        raise ValueError
+
+    SELECT = _get_select(client, table, return_fields, priority_fields=priority_fields, alias="meta")
+
+    FROM = "FROM `{}` AS meta".format(table)
+
+    tables = [table]
+    JOINS = []
+    if compound_conditions:
+        tables.append(config.tables.compoundinfo)
+        JOINS.append(
+            "INNER JOIN (SELECT DISTINCT pert_id FROM `{}` WHERE {}) AS cp USING (pert_id)".format(
+                config.tables.compoundinfo, " AND ".join(_build_conditions(compound_conditions))
+            )
+        )
+    if cell_conditions:
+        tables.append(config.tables.cellinfo)
+        JOINS.append(
+            "INNER JOIN (SELECT DISTINCT cell_iname FROM `{}` WHERE {}) AS cell USING (cell_iname)".format(
+                config.tables.cellinfo, " AND ".join(_build_conditions(cell_conditions))
+            )
+        )
+
+    CONDITIONS = _build_conditions(conditions, alias="meta")
+    if CONDITIONS:
+        WHERE = "WHERE " + " AND ".join(CONDITIONS)
+    else:
+        WHERE = ""
+
+    if limit:
+        assert isinstance(limit, int), "Limit argument must be an integer"
+        WHERE = WHERE + " LIMIT {}".format(limit)
+
+    query = " ".join([SELECT, FROM] + JOINS + [WHERE])
+
+    assert (
+            len(query) < 1024 * 10 ** 3
+    ), "Query length exceeds maximum allowed by BQ, keep under 1M characters"
+
+    if verbose:
+        print("Table: \n {}".format(table))
+        print("Query:\n {}".format(query))
+
+    return _to_categorical(_fetch_result(client, query, tables, output=output), categorical)
+
+
+def _build_conditions(conditions, alias=None):
+    """
+    Convert a dict of {field: values} to a list of 'field in UNNEST([...])' conditions
+
+    :param conditions: dict of {field: list of values}. Values are read with parse_condition.
+    :param alias: Optional table alias to qualify fields with
+    :return: list of condition strings
+    """
+    CONDITIONS = []
+    if not conditions:
+        return CONDITIONS
+
+    for field, values in conditions.items():
+        _check_field_name(field)
+        if alias is not None:
+            field = "{}.{}".format(alias, field)
+        CONDITIONS.append("{} in UNNEST({})".format(field, list(parse_condition(values))))
+    return CONDITIONS
+
+
+def _check_field_name(field):
+    if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", field):
+        print("Invalid field name: {}".format(field))
+        raise ValueError
+    return field
+
+
+def _get_select(client, table, return_fields, priority_fields=None, alias=None):
+    """
+    SELECT clause for a metadata query. Requested fields are checked against the table schema, so typos fail
+    before the query is run.
+
+    :param client: BigQuery Client
+    :param table: Table address
+    :param return_fields: 'all', 'priority' (if priority_fields is set) or list of fields
+    :param priority_fields: Fields returned for 'priority'
+    :param alias: Optional table alias to qualify fields with
+    :return: SELECT clause
+    """
+    prefix = "" if alias is None else "{}.".format(alias)
+    if isinstance(return_fields, str) and return_fields == "all":
+        return "SELECT {}*".format(prefix)
+    if isinstance(return_fields, str) and return_fields == "priority" and priority_fields is not None:
+        return "SELECT " + ",".join(prefix + field for field in priority_fields)
+
+    fields = [_check_field_name(field.strip()) for field in parse_condition(return_fields)]
+    if not fields:
+        print("return_fields must be 'all'{} or a list of fields".format(
+            ", 'priority'" if priority_fields is not None else ""
+        ))
+        raise ValueError
+
+    columns = set(get_table_info(client, table.replace("`", ""))["column_name"])
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        print("Fields {} not found in {}. Choices {}".format(unknown, table, sorted(columns)))
+        raise ValueError
+    return "SELECT " + ",".join(prefix + field for field in fields)
+
+
+def _to_categorical(result, categorical=True):
+    """
+    Convert low-cardinality string fields (see _CATEGORICAL_FIELDS) of a metadata result to pandas
+    categoricals, or dictionary-encode them in a pyarrow Table.
+
+    :param result: Pandas DataFrame or pyarrow Table
+    :param categorical: Set False to return result unchanged
+    :return: Pandas DataFrame or pyarrow Table
+    """
+    import pandas as pd
+
+    if not categorical:
+        return result
+
+    if isinstance(result, pd.DataFrame):
+        fields = [field for field in _CATEGORICAL_FIELDS
+                  if field in result.columns and result[field].dtype == object]
+        if fields:
+            result = result.astype({field: "category" for field in fields})
+        return result
+
+    import pyarrow as pa
+    for i, field in enumerate(result.schema):
+        if field.name in _CATEGORICAL_FIELDS and (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)):
+            result = result.set_column(i, field.name, result.column(i).dictionary_encode())
+    return result
 
 
 def _get_feature_list(feature_space):
@@ -590,16 +849,115 @@ def _get_feature_list(feature_space):
         raise ValueError
 
 
-def _get_feature_space_condition(feature_space):
+def _get_feature_space_condition(feature_space, alias=None):
     config = cfg.get_default_config()
     gene_table = config.tables.geneinfo
+    field = "rid" if alias is None else "{}.rid".format(alias)
     CONDITION = (
-        "rid in (SELECT CAST(gene_id AS STRING) "
+        "{} in (SELECT CAST(gene_id AS STRING) "
         "FROM `{}` "
         "WHERE feature_space in UNNEST({}))"
-    ).format(gene_table, _get_feature_list(feature_space))
+    ).format(field, gene_table, _get_feature_list(feature_space))
     return CONDITION
 
+
+def get_feature_space_genes(client, feature_space="landmark", refresh=False):
+    """
+    Gene ids of a feature space in canonical order (sorted as strings, the row order of cmap_matrix results).
+    Gene lists are memoized in the process and cached in ~/.cmapBQ/feature_spaces, versioned by the
+    last-modified time of the geneinfo table. The modified time is checked again every 5 minutes, so an update
+    to geneinfo refreshes both.
+
+    :param client: Bigquery Client
+    :param feature_space: Choices ['landmark', 'bing', 'aig']
+    :param refresh: Ignore cached gene lists and read geneinfo again
+    :return: list of gene ids as strings
+    """
+    features = _get_feature_list(feature_space)
+    gene_table = cfg.get_default_config().tables.geneinfo
+
+    with _feature_space_lock:
+        genes = _memoized_feature_space_genes(client, gene_table, refresh=refresh)
+
+    return sorted(gene for feature in features for gene in genes.get(feature, []))
+
+
+def _memoized_feature_space_genes(client, gene_table, refresh=False):
+    """
+    :return: dict of geneinfo feature_space value to gene ids
+    """
+    now = time.time()
+    entry = None if refresh else _feature_space_genes.get(gene_table)
+    if entry is not None and now - entry[0] < _FEATURE_SPACE_MODIFIED_TTL:
+        return entry[3]
+
+    version = _get_table_version(client, gene_table)
+    if entry is not None:
+        checked, loaded, cached_version, genes = entry
+        if version is not None and version == cached_version:
+            _feature_space_genes[gene_table] = (now, loaded, version, genes)
+            return genes
+        if version is None and cached_version is None and now - loaded < _FEATURE_SPACE_TTL:
+            return genes
+
+    genes = _load_feature_space_genes(client, gene_table, version, refresh=refresh)
+    _feature_space_genes[gene_table] = (now, now, version, genes)
+    return genes
+
+
+def _get_table_version(client, table):
+    """
+    :return: last-modified time of table as a string, or None without table metadata access
+    """
+    try:
+        return str(client.get_table(table.replace("`", "")).modified)
+    except Exception:
+        return None
+
+
+def _load_feature_space_genes(client, gene_table, version, refresh=False):
+    """
+    :param version: geneinfo version from _get_table_version. The disk cache is only used with a version.
+    :return: dict of geneinfo feature_space value to gene ids
+    """
+    cache_path = os.path.join(
+        cfg._config_dir(), "feature_spaces", "{}.json".format(re.sub(r"[^A-Za-z0-9_.-]", "_", gene_table))
+    )
+    if not refresh and version is not None and os.path.exists(cache_path):
+        with open(cache_path, "r") as fh:
+            cached = json.load(fh)
+        if cached.get("version") == version:
+            return cached["genes"]
+
+    QUERY = (
+        "SELECT CAST(gene_id AS STRING) AS gene_id, feature_space "
+        "FROM `{}` "
+        "WHERE feature_space in UNNEST({})"
+    ).format(gene_table, _get_feature_list("aig"))
+    result = run_query(client, QUERY).result().to_dataframe()
+    genes = {
+        str(feature): sorted(set(ids.astype(str)))
+        for feature, ids in result.groupby("feature_space")["gene_id"]
+    }
+
+    if version is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump({"table": gene_table, "version": version, "genes": genes}, fh)
+        os.replace(tmp_path, cache_path)
+    return genes
+
+
+def _get_row_condition(rid=None, feature_space="landmark", alias=None):
+    """
+    Row condition for matrix queries. Explicit rids override the feature space.
+    """
+    if rid:
+        field = "rid" if alias is None else "{}.rid".format(alias)
+        return "{} in UNNEST({})".format(field, [str(r) for r in parse_condition(rid)])
+    return _get_feature_space_condition(feature_space, alias=alias)
+
 def _get_numerical_table_id(table=None, data_level="level5", feature_space="landmark", rid=False):
     config = cfg.get_default_config()
 
@@ -651,6 +1009,15 @@ def cmap_matrix(
         chunk_size=1000,
         table=None,
         limit=4000,
+        annotate=False,
+        use_replica=True,
+        top_k=None,
+        reattach=True,
+        large_result=False,
+        group_by_plate=False,
+        prefetch=2,
+        output="gctoo",
+        coalesce=True,
 ):
     """
     Query for numerical data for signature-gene level data.
@@ -675,230 +1042,1205 @@ def cmap_matrix(
     :param limit: Soft limit for number of signatures allowed. Default is 4,000.
     :param table: Table address to query. Overrides 'data_level' parameter. Generally should not be used.
     :param verbose: Print query and table address.
-    :return: GCToo object
+    :param annotate: Attach row (geneinfo) and column (siginfo for 'level5', instinfo otherwise) metadata to the
+     GCToo object. Metadata is queried concurrently with the matrix chunks. Default is False.
+    :param use_replica: Read from a local replica if one is registered for the table, see cmapBQ.replica.
+     Default is True.
+    :param top_k: Only return the top_k highest and top_k lowest genes of each cid. Genes are ranked inside
+     BigQuery and the result is a cmapBQ.utils.sparse.SparseMatrix with one row per cid and one column per gene
+     of the feature space or rid, in cmap_matrix row order. Requires cid.
+    :param reattach: Submit chunk queries with job ids derived from the query text, the client's account and
+     the current UTC day, so a rerun after a kernel restart reuses jobs that are still running or finished
+     instead of executing them again. Reruns shortly after midnight UTC also find the previous day's jobs.
+     Default is True.
+    :param large_result: Materialize each chunk into the configured dataset and read it over parallel BigQuery
+     Storage API streams, see read_large_query. Suited to large chunk_size values. With reattach, each chunk's
+     table and CREATE TABLE job are named after the chunk query, so a rerun reads tables an interrupted run
+     left behind or waits for its running jobs. Default is False.
+    :param group_by_plate: For 'level3' and 'level4' cids, chunk samples by det_plate so each plate is read by a
+     single query. See iter_cmap_plates to process plates as they land.
+    :param prefetch: Number of downloaded chunks allowed to wait for assembly. Chunks download in a background
+     thread while earlier chunks are assembled; 0 runs downloads and assembly in series. Default is 2.
+    :param output: ['gctoo', 'numpy', 'arrow']. Return a GCToo object, a cmapBQ.utils.assembly.DenseMatrix (NumPy
+     values with rid and cid arrays) or a pyarrow Table with a 'rid' column and one column per cid. 'numpy' and
+     'arrow' download chunks as Arrow and assemble them without building pandas objects. Default is 'gctoo'.
+    :param coalesce: If request coalescing is enabled (see cmapBQ.coalescing), merge this request with
+     concurrent requests for other cids of the same table and rows. Default is True.
+    :return: GCToo object, DenseMatrix or pyarrow Table, or SparseMatrix if top_k is set
     """
+    import pandas as pd
+    import cmapBQ.replica as replica_store
+    from .utils.sparse import long_to_sparse, top_k_long
 
-    config = cfg.get_default_config()
+    _check_matrix_output(output)
+    if annotate and output != "gctoo":
+        print("annotate is only supported with output 'gctoo'")
+        raise ValueError
 
-    if cid:
+    coalescer = coalescing.get_coalescer() if coalesce else None
+    if coalescer is not None and cid and top_k is None and not annotate and not group_by_plate:
         cid = parse_condition(cid)
-
-        if table is not None:
-            table_id = table
-        else:
-            if data_level == "level3":
-                table_id = config.tables.level3
-            elif data_level == "level4":
-                table_id = config.tables.level4
-            elif data_level == "level5":
-                table_id = config.tables.level5
-            else:
-                print(
-                    "Unsupported data_level. select from ['level3', 'level4', level5'].\n Default is 'level5'. "
-                )
-                raise ValueError
-
-        table_id = _get_numerical_table_id(
-            table=table,
-            data_level=data_level,
-            feature_space=feature_space,
-            rid=False
+        if limit is not None:
+            assert len(cid) <= limit, "List of cids can not exceed limit of {}".format(limit)
+        key = coalescing.request_key(
+            "cmap_matrix", id(client), data_level, feature_space, rid, table, use_replica, large_result, output,
         )
 
-        assert len(cid) <= limit, "List of cids can not exceed limit of {}".format(
-            limit
-        )
-
-        cur = 0
-        nparts = ceil(len(cid) / chunk_size)
-        result_dfs = []
-        while cur < nparts:
-            start = cur * chunk_size
-            end = (
-                    cur * chunk_size + chunk_size
-            )  # No need to check for end, index only returns present values
-            cur = cur + 1
-            print("Running query ... ({}/{})".format(cur, nparts))
-            result_dfs.append(
-                _build_and_launch_query(
-                    client, table_id,
-                    rid=rid,
-                    cid=cid[start:end],
-                    feature_space=feature_space,
-                    verbose=verbose
-                )
+        def run(ids):
+            return cmap_matrix(
+                client, data_level=data_level, feature_space=feature_space, rid=rid, cid=ids, verbose=verbose,
+                chunk_size=chunk_size, table=table, limit=None, use_replica=use_replica, reattach=reattach,
+                large_result=large_result, prefetch=prefetch, output=output, coalesce=False,
             )
+        return coalescer.fetch(key, cid, run, _select_columns)
+    if top_k is not None:
+        if not cid:
+            print("top_k requires cid")
+            raise ValueError
+        if annotate:
+            print("annotate is not supported with top_k")
+            raise ValueError
 
-        try:
-            pool = mp.Pool(mp.cpu_count())
-            print("Pivoting Dataframes to GCT objects")
-            result_gctoos = pool.map(_pivot_result, result_dfs)
-            pool.close()
-        except:
-            if nparts > 1:
-                print("Multiprocessing unavailable, pivoting chunks in series...")
-            cur = 0
-            result_gctoos = []
-            for df in result_dfs:
-                cur = cur + 1
-                print("Pivoting... ({}/{})".format(cur, nparts))
-                result_gctoos.append(_pivot_result(df))
-        print("Complete")
-        return hstack(result_gctoos)
-    elif rid:
-        rid = parse_condition(rid)
+    replica = None
+    if use_replica:
+        replica = replica_store.get_replica(
+            _get_numerical_table_id(table=table, data_level=data_level, feature_space=feature_space, rid=False),
+            client=client,
+        )
+        if replica is not None and not rid and feature_space != replica.feature_space:
+            print("Replica holds {} feature space, querying BigQuery".format(replica.feature_space))
+            replica = None
+        if replica is not None and not cid and replica.partial:
+            print("Replica holds a subset of cids, querying BigQuery")
+            replica = None
+
+    # Chunk queries read the feature space as a fixed gene list rather than a geneinfo subquery each
+    row_ids = rid
+    if replica is None and cid and not rid:
+        row_ids = get_feature_space_genes(client, feature_space)
+
+    table_id, chunks, assembler = _plan_matrix_chunks(
+        data_level=data_level,
+        feature_space=feature_space,
+        rid=row_ids,
+        cid=cid,
+        chunk_size=chunk_size,
+        table=table,
+        limit=limit,
+    )
 
-        table_id = _get_numerical_table_id(
-            table=table,
+    if group_by_plate:
+        if data_level not in ["level3", "level4"] or not cid:
+            print("group_by_plate requires 'level3' or 'level4' cids")
+            raise ValueError
+        plate_chunks = _plan_plate_chunks(client, cid=cid, chunk_size=chunk_size, verbose=verbose)
+        chunks = [(row_ids, _plate_chunk_ids(plates)) for plates in plate_chunks]
+
+    if annotate:
+        executor = ThreadPoolExecutor(max_workers=2)
+        metadata_futures = _submit_metadata_queries(
+            executor, client,
             data_level=data_level,
             feature_space=feature_space,
-            rid=True
-        )
-
-        assert len(rid) <= limit, "List of cids can not exceed limit of {}".format(
-            limit
+            rid=parse_condition(rid) if rid else None,
+            cid=parse_condition(cid) if cid else None,
         )
-
-        cur = 0
-        nparts = ceil(len(rid) / chunk_size)
+        executor.shutdown(wait=False)
+
+    if replica is not None:
+        matrix = _read_replica(client, replica, cid=cid, rid=rid, feature_space=feature_space,
+                               chunk_size=chunk_size, verbose=verbose, reattach=reattach,
+                               large_result=large_result, prefetch=prefetch)
+        if top_k is not None:
+            print("Complete")
+            return long_to_sparse(top_k_long(matrix.data_df, top_k), rids=list(matrix.data_df.index))
+    elif top_k is not None:
         result_dfs = []
-        while cur < nparts:
-            start = cur * chunk_size
-            end = (
-                    cur * chunk_size + chunk_size
-            )  # No need to check for end, index only returns present values
-            cur = cur + 1
-            print("Running query ... ({}/{})".format(cur, nparts))
+        for cur, (chunk_rid, chunk_cid) in enumerate(chunks, 1):
+            print("Running query ... ({}/{})".format(cur, len(chunks)))
             result_dfs.append(
                 _build_and_launch_query(
                     client, table_id,
-                    rid=rid[start:end],
-                    cid=cid,
+                    rid=chunk_rid,
+                    cid=chunk_cid,
                     feature_space=feature_space,
-                    verbose=verbose
+                    verbose=verbose,
+                    top_k=top_k,
+                    reattach=reattach,
+                    large_result=large_result
                 )
             )
-
-        try:
-            pool = mp.Pool(mp.cpu_count())
-            print("Pivoting Dataframes to GCT objects")
-            result_gctoos = pool.map(_pivot_result, result_dfs)
-            pool.close()
-        except:
-            if nparts > 1:
-                print("Multiprocessing unavailable, pivoting chunks in series...")
-            cur = 0
-            result_gctoos = []
-            for df in result_dfs:
-                cur = cur + 1
-                print("Pivoting... ({}/{})".format(cur, nparts))
-                result_gctoos.append(_pivot_result(df))
         print("Complete")
-        return hstack(result_gctoos)
+        # Rows span the requested genes, so results for different cids share one gene axis
+        return long_to_sparse(
+            pd.concat(result_dfs, ignore_index=True), rids=sorted(set(str(r) for r in parse_condition(row_ids)))
+        )
     else:
-        print("Provide column or row ids to extract using the cid, rid keyword arguments")
-        raise ValueError
+        matrix = _query_matrix_chunks(client, table_id, chunks, assembler, feature_space=feature_space,
+                                      verbose=verbose, reattach=reattach, large_result=large_result,
+                                      prefetch=prefetch, chunk_output="pandas" if output == "gctoo" else "arrow")
+
+    if annotate:
+        print("Attaching metadata")
+        row_metadata, col_metadata = [future.result() for future in metadata_futures]
+        matrix = _annotate_gctoo(_matrix_output(matrix), row_metadata, col_metadata,
+                                 col_id_field=_get_col_id_field(data_level))
 
+    print("Complete")
+    return _matrix_output(matrix, output=output)
 
-def get_table_info(client, table_id):
+
+def _read_replica(client, replica, cid=None, rid=None, feature_space="landmark", chunk_size=1000, verbose=False,
+                  reattach=True, large_result=False, prefetch=2):
     """
-    Query a table address within client's permissions for schema.
+    Read a matrix request from a local replica. Requested cids the replica does not hold are queried from
+    BigQuery and merged in, unless the replica is known to hold the whole table. Rows and columns are sorted
+    like results read from BigQuery.
 
-    :param client: Bigquery Client
-    :param table_id: table address as {dataset}.{table_id}
-    :return: Pandas Dataframe of column names. Note: Not all column names are query-able but all will be returned from a given metadata table
+    :return: GCToo object
     """
-    tok = table_id.split(".")
+    import pandas as pd
+    from cmapPy.pandasGEXpress.GCToo import GCToo
 
-    if len(tok) > 1:
-        dataset_name = ".".join(tok[0:-1])
-        table_name = tok[-1]
-    else:
-        return NotImplementedError("table_id should be in {dataset}.{table_id} format")
+    cid = list(dict.fromkeys(parse_condition(cid))) if cid else None
+    rid = parse_condition(rid) if rid else None
 
-    QUERY = "SELECT column_name, data_type FROM `{}.INFORMATION_SCHEMA.COLUMNS` WHERE table_name='{}'".format(
-        dataset_name, table_name
+    print("Reading from local replica {}".format(replica.path))
+    matrix = replica.get(cid=cid, rid=rid)
+    missing = replica.missing(cid) if cid and not replica.complete else []
+    if not missing:
+        return matrix
+
+    print("Replica holds {} of {} cids, querying BigQuery for the rest".format(len(cid) - len(missing), len(cid)))
+    table_id, chunks, assembler = _plan_matrix_chunks(
+        feature_space=feature_space, rid=rid or replica.rids, cid=missing, chunk_size=chunk_size, table=replica.table
     )
-    table_desc = run_query(client, QUERY).result().to_dataframe()
-    return table_desc
+    queried = _query_matrix_chunks(client, table_id, chunks, assembler, feature_space=feature_space,
+                                   verbose=verbose, reattach=reattach, large_result=large_result,
+                                   prefetch=prefetch).to_dataframe()
 
+    data_df = pd.concat([matrix.data_df, queried.reindex(matrix.data_df.index)], axis=1)
+    # Sorted columns, as the replica and MatrixAssembler return them
+    data_df = data_df[sorted(data_df.columns)]
+    data_df.columns.name = "cid"
+    return GCToo(data_df)
 
-def _build_query(table_id, cid=None, rid=None, feature_space="landmark"):
+
+def _query_matrix_chunks(client, table_id, chunks, assembler, feature_space="landmark", verbose=False, reattach=True,
+                         large_result=False, prefetch=2, chunk_output="pandas"):
     """
-    Crafts and retrieves query from rid and cid conditions. Uses pandas GBQ read_gbq
-    to download records from BigQuery as a dataframe object.
+    Run the chunk queries of a matrix request and write each result into the preallocated matrix. Chunks
+    are downloaded in a background thread, so chunk N+1 downloads while chunk N is assembled.
 
-    :param table_id: Matrix table
-    :param cid: list of column ids (samples/sig_ids)
-    :param rid: list of row ids (gene space)
-    :param feature_space: Common featurespaces to extract. 'rid' overrides selection
-            Choices: ['landmark', 'bing', 'aig']
-            landmark: 978 landmark genes
-            bing: Best-inferred set of 10,174 genes
-            aig: All inferred genes including 12,328 genes
-            Default is landmark.
-    :return: Long-form DataFrame object
+    :param chunk_output: ['pandas', 'arrow']. Format chunks are downloaded in
+    :return: DenseMatrix
     """
-    SELECT = "SELECT cid, rid, value"
-    FROM = "FROM `{}`".format(table_id)
+    from .utils.pipeline import run_pipeline
 
-    CONDITIONS = []
-    if rid:
-        rids = parse_condition(rid)
-        CONDITIONS.append("rid in UNNEST({})".format(list(rids)))
-    else:
-        CONDITIONS.append(_get_feature_space_condition(feature_space))
+    download = _chunk_downloader(client, table_id, len(chunks), feature_space=feature_space, verbose=verbose,
+                                 reattach=reattach, large_result=large_result, output=chunk_output)
+    for df in run_pipeline(enumerate(chunks, 1), [download], queue_size=prefetch):
+        assembler.add(df)
+        del df
+    return assembler.to_dense()
 
-    if cid:
-        cids = parse_condition(cid)
-        CONDITIONS.append("cid in UNNEST({})".format(cids))
 
-    if CONDITIONS:
-        WHERE = "WHERE " + " AND ".join(CONDITIONS)
-    else:
-        WHERE = ""
+def _chunk_downloader(client, table_id, nparts, feature_space="landmark", verbose=False, reattach=True,
+                      large_result=False, output="pandas"):
+    """
+    :return: function taking (chunk number, (rid, cid)) and returning the long-form chunk result as a Pandas
+     DataFrame or pyarrow Table
+    """
+    def download(item):
+        cur, (chunk_rid, chunk_cid) = item
+        print("Running query ... ({}/{})".format(cur, nparts))
+        return _build_and_launch_query(
+            client, table_id,
+            rid=chunk_rid,
+            cid=chunk_cid,
+            feature_space=feature_space,
+            verbose=verbose,
+            reattach=reattach,
+            large_result=large_result,
+            output=output
+        )
+    return download
 
-    QUERY = " ".join([SELECT, FROM, WHERE])
 
-    return QUERY
+def iter_cmap_matrix(
+        client,
+        data_level="level5",
+        feature_space="landmark",
+        rid=None,
+        cid=None,
+        verbose=False,
+        chunk_size=1000,
+        table=None,
+        limit=None,
+        prefetch=True,
+        reattach=True,
+        large_result=False,
+        output="gctoo",
+):
+    """
+    Generator version of cmap_matrix. Yields one GCToo object per chunk as each query completes, so only one
+    or two chunks are held in memory regardless of the number of ids requested.
 
-def fmt_size(num, suffix='B'):
-    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
+    e.g.
+        for gctoo in iter_cmap_matrix(client, cid=sig_ids, chunk_size=500):
+            score(gctoo)
 
-def _build_and_launch_query(client, table_id, cid=None, rid=None, feature_space="landmark", verbose=False):
+    :param client: Bigquery Client
+    :param data_level: Data level requested. Choices are ['level5', 'level4', 'level3']
+    :param rid: Row ids
+    :param cid: Column ids
+    :param feature_space: Common featurespaces to extract, see cmap_matrix. 'rid' overrides selection
+    :param chunk_size: Number of ids per chunk. Default 1,000
+    :param limit: Optional limit for number of ids allowed. Default is None (no limit).
+    :param table: Table address to query. Overrides 'data_level' parameter. Generally should not be used.
+    :param verbose: Print query and table address.
+    :param prefetch: Number of chunks each background stage (download, pivot) may run ahead of the consumer, so
+     the next chunks download and pivot while the current one is consumed. True is 1, False or 0 runs every
+     stage in series. Default is True.
+    :param reattach: Reuse running or finished jobs for identical chunk queries, see cmap_matrix. Default is True.
+    :param large_result: Read chunks through a materialized table and the Storage API, see cmap_matrix.
+    :param output: ['gctoo', 'numpy', 'arrow']. Type of each chunk, see cmap_matrix. Default is 'gctoo'.
+    :return: Generator of GCToo objects
     """
-    Crafts and retrieves query from rid and cid conditions. Uses pandas GBQ read_gbq
-    to download records from BigQuery as a dataframe object.
+    _check_matrix_output(output)
+    if cid and not rid:
+        rid = get_feature_space_genes(client, feature_space)
+
+    table_id, chunks, _ = _plan_matrix_chunks(
+        data_level=data_level,
+        feature_space=feature_space,
+        rid=rid,
+        cid=cid,
+        chunk_size=chunk_size,
+        table=table,
+        limit=limit,
+    )
 
-    :param table_id: Matrix table
-    :param cid: list of column ids (samples/sig_ids)
-    :param rid: list of row ids (gene space)
-    :param feature_space: Common featurespaces to extract. 'rid' overrides selection
-        Choices: ['landmark', 'bing', 'aig']
-        landmark: 978 landmark genes
-        bing: Best-inferred set of 10,174 genes
-        aig: All inferred genes including 12,328 genes
-        Default is landmark.
-    :param verbose: Shows extra information for debugging
-    :return: Long-form DataFrame object
-    """
+    return _iter_matrix_chunks(
+        client, table_id, chunks,
+        feature_space=feature_space,
+        verbose=verbose,
+        prefetch=prefetch,
+        reattach=reattach,
+        large_result=large_result,
+        output=output,
+    )
 
-    QUERY = _build_query(table_id=table_id,
-                         cid=cid,
-                         rid=rid,
-                         feature_space=feature_space)
 
-    if verbose:
-        print(QUERY)
+def _iter_matrix_chunks(client, table_id, chunks, feature_space="landmark", verbose=False, prefetch=True,
+                        reattach=True, large_result=False, output="gctoo"):
+    """
+    Run chunk queries in order, yielding one matrix per chunk. Downloading and pivoting run in background
+    threads, up to prefetch chunks ahead of the consumer at each stage.
 
-    query_job = run_query(client, QUERY)
+    :return: Generator of GCToo objects, or DenseMatrix or pyarrow Table, see cmap_matrix
+    """
+    from .utils.pipeline import run_pipeline
+
+    download = _chunk_downloader(client, table_id, len(chunks), feature_space=feature_space, verbose=verbose,
+                                 reattach=reattach, large_result=large_result,
+                                 output="pandas" if output == "gctoo" else "arrow")
+
+    def pivot(df_long):
+        return _pivot_result(df_long, output=output)
+
+    return run_pipeline(enumerate(chunks, 1), [download, pivot], queue_size=int(prefetch))
+
+
+def iter_cmap_plates(
+        client,
+        cid=None,
+        det_plate=None,
+        data_level="level4",
+        feature_space="landmark",
+        rid=None,
+        verbose=False,
+        chunk_size=1000,
+        table=None,
+        prefetch=True,
+        reattach=True,
+        output="gctoo",
+):
+    """
+    Fetch level 3 or level 4 data plate by plate. Sample ids are grouped by det_plate from instinfo and whole
+    plates are packed into each chunk query, so every plate is complete as soon as its chunk lands.
+
+    e.g.
+        for plate, gctoo in iter_cmap_plates(client, det_plate=plates):
+            normalize(gctoo)
+
+    :param client: Bigquery Client
+    :param cid: Sample ids. Only these samples are returned, grouped by their plate.
+    :param det_plate: Plates to fetch. All samples of each plate are returned.
+    :param data_level: Data level requested. Choices are ['level3', 'level4']
+    :param feature_space: Common featurespaces to extract, see cmap_matrix. 'rid' overrides selection
+    :param rid: Row ids
+    :param verbose: Print query and table address.
+    :param chunk_size: Maximum number of samples per query. Plates larger than chunk_size get their own query.
+    :param table: Table address to query. Overrides 'data_level' parameter. Generally should not be used.
+    :param prefetch: Number of chunks downloaded and pivoted ahead of the consumer, see iter_cmap_matrix.
+     Default is True.
+    :param reattach: Reuse running or finished jobs for identical chunk queries, see cmap_matrix. Default is True.
+    :param output: ['gctoo', 'numpy', 'arrow']. Type of each plate's matrix, see cmap_matrix. Default is 'gctoo'.
+    :return: Generator of (det_plate, GCToo object), in det_plate order
+    """
+    from cmapPy.pandasGEXpress.GCToo import GCToo
+
+    _check_matrix_output(output)
+    if data_level not in ["level3", "level4"]:
+        print("Plates are only available for ['level3', 'level4']")
+        raise ValueError
+
+    plate_chunks = _plan_plate_chunks(client, cid=cid, det_plate=det_plate, chunk_size=chunk_size, verbose=verbose)
+    table_id = _get_numerical_table_id(table=table, data_level=data_level, feature_space=feature_space, rid=False)
+    if not rid:
+        rid = get_feature_space_genes(client, feature_space)
+    chunks = [(rid, _plate_chunk_ids(plates)) for plates in plate_chunks]
+
+    gctoos = _iter_matrix_chunks(
+        client, table_id, chunks,
+        feature_space=feature_space,
+        verbose=verbose,
+        prefetch=prefetch,
+        reattach=reattach,
+    )
+    for plates, gctoo in zip(plate_chunks, gctoos):
+        for plate, sample_ids in plates.items():
+            columns = [sample_id for sample_id in sample_ids if sample_id in gctoo.data_df.columns]
+            yield plate, _matrix_output(GCToo(gctoo.data_df[columns]), output=output)
+
+
+def _plan_plate_chunks(client, cid=None, det_plate=None, chunk_size=1000, verbose=False):
+    """
+    Look up the det_plate of each sample in instinfo and pack whole plates, in det_plate order, into chunks of
+    at most chunk_size samples.
+
+    :return: list of dicts of det_plate to sorted sample ids, one per chunk
+    """
+    if not cid and not det_plate:
+        print("Provide sample ids or plates using the cid, det_plate keyword arguments")
+        raise ValueError
+
+    samples = cmap_profiles(client, sample_id=cid, det_plate=det_plate, verbose=verbose, categorical=False)
+    if cid:
+        missing = len(set(parse_condition(cid)) - set(samples["sample_id"]))
+        if missing:
+            print("{} sample ids not found in instinfo".format(missing))
+    if samples.empty:
+        print("No samples found for the requested ids or plates")
+        raise ValueError
+
+    plates = samples.groupby("det_plate", sort=True)["sample_id"].apply(lambda ids: sorted(set(ids)))
+
+    chunks = []
+    current = {}
+    n_samples = 0
+    for plate, sample_ids in plates.items():
+        if current and n_samples + len(sample_ids) > chunk_size:
+            chunks.append(current)
+            current = {}
+            n_samples = 0
+        current[plate] = sample_ids
+        n_samples += len(sample_ids)
+    chunks.append(current)
+    return chunks
+
+
+def _plate_chunk_ids(plates):
+    return [sample_id for sample_ids in plates.values() for sample_id in sample_ids]
+
+
+def _plan_matrix_chunks(data_level="level5", feature_space="landmark", rid=None, cid=None, chunk_size=1000,
+                        table=None, limit=None):
+    """
+    Split a matrix request into per-query chunks. Requests with cids are chunked over cids against the
+    column-clustered table, requests with only rids are chunked over rids against the row-clustered table.
+
+    :return: (table_id, list of (rid, cid) per chunk, MatrixAssembler preallocated for the requested ids)
+    """
+    from .utils.assembly import MatrixAssembler
+
+    if cid:
+        cid = parse_condition(cid)
+        table_id = _get_numerical_table_id(
+            table=table,
+            data_level=data_level,
+            feature_space=feature_space,
+            rid=False
+        )
+
+        if limit is not None:
+            assert len(cid) <= limit, "List of cids can not exceed limit of {}".format(
+                limit
+            )
+
+        chunks = [(rid, cid[start:start + chunk_size]) for start in range(0, len(cid), chunk_size)]
+        return table_id, chunks, MatrixAssembler(rid=parse_condition(rid) if rid else None, cid=cid)
+    elif rid:
+        rid = parse_condition(rid)
+        table_id = _get_numerical_table_id(
+            table=table,
+            data_level=data_level,
+            feature_space=feature_space,
+            rid=True
+        )
+
+        if limit is not None:
+            assert len(rid) <= limit, "List of rids can not exceed limit of {}".format(
+                limit
+            )
+
+        chunks = [(rid[start:start + chunk_size], cid) for start in range(0, len(rid), chunk_size)]
+        return table_id, chunks, MatrixAssembler(rid=rid)
+    else:
+        print("Provide column or row ids to extract using the cid, rid keyword arguments")
+        raise ValueError
+
+
+def _get_col_id_field(data_level="level5"):
+    if data_level == "level5":
+        return "sig_id"
+    else:
+        return "sample_id"
+
+
+def _submit_metadata_queries(executor, client, data_level="level5", feature_space="landmark", rid=None, cid=None):
+    """
+    Submit row and column metadata queries for a matrix pull to an executor so they run alongside the
+    matrix chunks.
+
+    :param executor: concurrent.futures Executor
+    :param client: BigQuery Client
+    :param data_level: Data level of matrix. 'level5' uses siginfo, 'level3' and 'level4' use instinfo
+    :param feature_space: Feature space of matrix, used when rid is not given
+    :param rid: list of row ids
+    :param cid: list of column ids. If None, all column metadata is returned.
+    :return: (row metadata future, column metadata future)
+    """
+    if rid:
+        row_future = executor.submit(
+            cmap_genes, client, gene_id=[int(r) for r in rid], feature_space=None, categorical=False
+        )
+    else:
+        row_future = executor.submit(cmap_genes, client, feature_space=feature_space, categorical=False)
+
+    if data_level == "level5":
+        col_future = executor.submit(cmap_sig, client, sig_id=cid, return_fields='all', categorical=False)
+    else:
+        col_future = executor.submit(cmap_profiles, client, sample_id=cid, return_fields='all', categorical=False)
+
+    return row_future, col_future
+
+
+def _annotate_gctoo(gctoo, row_metadata, col_metadata, col_id_field="sig_id"):
+    """
+    Attach geneinfo and siginfo/instinfo records to a GCToo object, aligned to its rids and cids.
+
+    :param gctoo: GCToo object
+    :param row_metadata: geneinfo DataFrame
+    :param col_metadata: siginfo or instinfo DataFrame
+    :param col_id_field: field of col_metadata holding the cids. 'sig_id' or 'sample_id'
+    :return: GCToo object
+    """
+    from cmapPy.pandasGEXpress.GCToo import GCToo
+
+    row_metadata = row_metadata.astype({"gene_id": str}).drop_duplicates("gene_id")
+    row_metadata = row_metadata.set_index("gene_id").reindex(gctoo.data_df.index)
+    row_metadata.index.name = "rid"
+    row_metadata.columns.name = "rhd"
+
+    col_metadata = col_metadata.drop_duplicates(col_id_field)
+    col_metadata = col_metadata.set_index(col_id_field).reindex(gctoo.data_df.columns)
+    col_metadata.index.name = "cid"
+    col_metadata.columns.name = "chd"
+
+    return GCToo(gctoo.data_df, row_metadata_df=row_metadata, col_metadata_df=col_metadata)
+
+
+def cmap_similarity(
+        client,
+        profiles,
+        method="pearson",
+        top_k=100,
+        bottom_k=0,
+        cid=None,
+        data_level="level5",
+        feature_space="landmark",
+        table=None,
+        annotate=False,
+        verbose=False,
+        output="pandas",
+):
+    """
+    Score query profiles against every signature in a matrix table inside BigQuery and return the most
+    similar signatures. Only the top_k (and bottom_k) scores per query profile are downloaded.
+
+    :param client: Bigquery Client
+    :param profiles: Query profile(s) indexed by rid. A Pandas Series, a DataFrame with one column per query
+     profile, a GCToo object or a dict of {rid: value}. Keep to a small number of profiles, they are sent as
+     part of the query text.
+    :param method: Similarity measure. Choices are ['pearson', 'spearman', 'cosine']. Default is pearson.
+    :param top_k: Number of highest scoring signatures to return per query profile. Default 100
+    :param bottom_k: Number of lowest scoring signatures to return per query profile. Default 0
+    :param cid: Optional list of column ids to restrict scoring to. Default scores the whole table.
+    :param data_level: Data level to score against. Choices are ['level5', 'level4', 'level3']
+    :param feature_space: Feature space of the table to query, see cmap_matrix. Default is landmark.
+    :param table: Table address to query. Overrides 'data_level' parameter. Generally should not be used.
+    :param annotate: Join siginfo fields to the result. Only supported for 'level5'. Default is False.
+    :param verbose: Print query and table address.
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
+    :return: Pandas DataFrame with columns qid, cid, score and rank. Rank is negative for bottom_k results.
+    """
+    table_id = _get_numerical_table_id(
+        table=table,
+        data_level=data_level,
+        feature_space=feature_space,
+        rid=False
+    )
+
+    profiles_long = _profiles_to_long(profiles)
+
+    if method == "pearson":
+        SCORE = "CORR(q.value, m.value)"
+        MATRIX = "`{}` AS m".format(table_id)
+    elif method == "spearman":
+        # Difference of ascending and descending ranks is an affine function of the average rank
+        SCORE = "CORR(q.value, m.value)"
+        MATRIX = (
+            "(SELECT q.qid, m.cid, "
+            "RANK() OVER (PARTITION BY q.qid, m.cid ORDER BY m.value) - "
+            "RANK() OVER (PARTITION BY q.qid, m.cid ORDER BY m.value DESC) AS value, "
+            "RANK() OVER (PARTITION BY q.qid, m.cid ORDER BY q.value) - "
+            "RANK() OVER (PARTITION BY q.qid, m.cid ORDER BY q.value DESC) AS q_value, "
+            "m.rid "
+            "FROM `{}` AS m JOIN query_profiles AS q ON m.rid = q.rid{})"
+        ).format(table_id, _cid_condition(cid, alias="m", prefix=" WHERE "))
+    elif method == "cosine":
+        SCORE = "SUM(q.value * m.value) / (SQRT(SUM(q.value * q.value)) * SQRT(SUM(m.value * m.value)))"
+        MATRIX = "`{}` AS m".format(table_id)
+    else:
+        print("method {} unknown. Choices ['pearson', 'spearman', 'cosine']".format(method))
+        raise ValueError
+
+    WITH = "WITH query_profiles AS (SELECT * FROM UNNEST({}))".format(_struct_array_literal(profiles_long))
+
+    if method == "spearman":
+        SCORES = (
+            "scores AS (SELECT m.qid, m.cid, CORR(m.q_value, m.value) AS score "
+            "FROM {} AS m GROUP BY m.qid, m.cid)"
+        ).format(MATRIX)
+    else:
+        SCORES = (
+            "scores AS (SELECT q.qid, m.cid, {} AS score "
+            "FROM {} JOIN query_profiles AS q ON m.rid = q.rid{} "
+            "GROUP BY q.qid, m.cid)"
+        ).format(SCORE, MATRIX, _cid_condition(cid, alias="m", prefix=" WHERE "))
+
+    RANKED = (
+        "ranked AS (SELECT qid, cid, score, "
+        "ROW_NUMBER() OVER (PARTITION BY qid ORDER BY score DESC) AS top_rank, "
+        "ROW_NUMBER() OVER (PARTITION BY qid ORDER BY score ASC) AS bottom_rank "
+        "FROM scores WHERE score IS NOT NULL)"
+    )
+
+    SELECT = "SELECT r.qid, r.cid, r.score, IF(r.top_rank <= {}, r.top_rank, -r.bottom_rank) AS rank".format(
+        int(top_k)
+    )
+    FROM = "FROM ranked AS r"
+    if annotate:
+        if data_level != "level5":
+            print("annotate is only supported for 'level5'")
+            raise ValueError
+        config = cfg.get_default_config()
+        SELECT = SELECT + ", " + ", ".join(
+            "sig.{}".format(field) for field in _SIGINFO_PRIORITY_FIELDS if field != "sig_id"
+        )
+        FROM = FROM + " LEFT JOIN `{}` AS sig ON r.cid = sig.sig_id".format(config.tables.siginfo)
+    WHERE = "WHERE r.top_rank <= {} OR r.bottom_rank <= {}".format(int(top_k), int(bottom_k))
+    ORDER = "ORDER BY r.qid, r.score DESC"
+
+    query = " ".join([WITH + ", " + SCORES + ", " + RANKED, SELECT, FROM, WHERE, ORDER])
+
+    assert (
+            len(query) < 1024 * 10 ** 3
+    ), "Query length exceeds maximum allowed by BQ, reduce the number of query profiles"
+
+    if verbose:
+        print("Table: \n {}".format(table_id))
+        print("Query:\n {}".format(query))
+
+    query_job = run_query(client, query)
+    result = _query_result(query_job, output=output)
+    _print_bytes_processed(query_job)
+    return result
+
+
+def cmap_aggregate(
+        client,
+        group_by=("pert_id", "cell_iname", "pert_idose", "pert_itime"),
+        conditions=None,
+        method="mean",
+        data_level="level4",
+        feature_space="landmark",
+        rid=None,
+        table=None,
+        verbose=False,
+        output="gctoo",
+):
+    """
+    Aggregate level 3 or level 4 replicate profiles into consensus profiles inside BigQuery. Samples are
+    selected from instinfo, grouped by instinfo fields and aggregated per gene, so only one column per group
+    is downloaded.
+
+    e.g. consensus profiles per compound, cell line, dose and time for two compounds:
+
+        cmap_aggregate(client, conditions={'pert_id': ['BRD-A', 'BRD-B']}, method='modz')
+
+    :param client: Bigquery Client
+    :param group_by: instinfo fields to group samples by.
+     Default is ('pert_id', 'cell_iname', 'pert_idose', 'pert_itime')
+    :param conditions: dict of {field: list of values} selecting samples from instinfo. Required.
+    :param method: Aggregate to compute per group and gene. Choices are ['mean', 'median', 'modz'].
+
+                mean: Average of replicate values
+
+                median: Median of replicate values
+
+                modz: Average weighted by each replicate's mean Spearman correlation to the other replicates
+                in its group, with weights floored at 0.01. Groups with one replicate get weight 1.
+
+                Default is mean.
+    :param data_level: Data level of replicates. Choices are ['level4', 'level3']. Default is 'level4'
+    :param feature_space: Common featurespaces to aggregate, see cmap_matrix. 'rid' overrides selection
+    :param rid: Row ids
+    :param table: Table address to query. Overrides 'data_level' parameter. Generally should not be used.
+    :param verbose: Print query and table address.
+    :param output: ['gctoo', 'numpy', 'arrow']. Return a GCToo object, a cmapBQ.utils.assembly.DenseMatrix (NumPy
+     values with rid and cid arrays) or a pyarrow Table with a 'rid' column and one column per cid.
+    :return: GCToo object with one column per group. Column ids join the group values with ':' and column
+     metadata holds the group fields and nsample (GCToo output only).
+    """
+    _check_matrix_output(output)
+    if not conditions:
+        print("Provide conditions selecting samples from instinfo")
+        raise ValueError
+    if data_level not in ["level3", "level4"]:
+        print("Unsupported data_level. select from ['level3', 'level4']")
+        raise ValueError
+
+    group_by = [_check_field_name(field) for field in group_by]
+    config = cfg.get_default_config()
+    table_id = _get_numerical_table_id(
+        table=table,
+        data_level=data_level,
+        feature_space=feature_space,
+        rid=False
+    )
+
+    DECLARE = _declare_id_array(
+        "sample_ids", "sample_id", config.tables.instinfo, _build_conditions(conditions)
+    )
+
+    GROUP_FIELDS = ", ".join("s.{}".format(field) for field in group_by)
+    VALUES = (
+        "vals AS (SELECT {}, TO_JSON_STRING(STRUCT({})) AS grp, m.cid, m.rid, m.value "
+        "FROM `{}` AS m JOIN `{}` AS s ON m.cid = s.sample_id "
+        "WHERE m.cid in UNNEST(sample_ids) AND s.sample_id in UNNEST(sample_ids) AND {})"
+    ).format(
+        GROUP_FIELDS, GROUP_FIELDS, table_id, config.tables.instinfo,
+        _get_row_condition(rid=rid, feature_space=feature_space, alias="m"),
+    )
+
+    OUT_FIELDS = ", ".join(group_by)
+    if method == "mean":
+        WITH = "WITH " + VALUES
+        SELECT = "SELECT {}, rid, AVG(value) AS value, COUNT(*) AS nsample".format(OUT_FIELDS)
+        FROM = "FROM vals GROUP BY {}, grp, rid".format(OUT_FIELDS)
+    elif method == "median":
+        WITH = "WITH " + VALUES
+        SELECT = (
+            "SELECT DISTINCT {}, rid, PERCENTILE_CONT(value, 0.5) OVER (PARTITION BY grp, rid) AS value, "
+            "COUNT(*) OVER (PARTITION BY grp, rid) AS nsample"
+        ).format(OUT_FIELDS)
+        FROM = "FROM vals"
+    elif method == "modz":
+        WITH = "WITH " + ", ".join([
+            VALUES,
+            "ranked AS (SELECT grp, cid, rid, "
+            "RANK() OVER (PARTITION BY cid ORDER BY value) - "
+            "RANK() OVER (PARTITION BY cid ORDER BY value DESC) AS rank_value FROM vals)",
+            "pairs AS (SELECT a.cid, CORR(a.rank_value, b.rank_value) AS cc "
+            "FROM ranked AS a JOIN ranked AS b ON a.grp = b.grp AND a.rid = b.rid AND a.cid != b.cid "
+            "GROUP BY a.cid, b.cid)",
+            "weights AS (SELECT cid, GREATEST(AVG(cc), 0.01) AS weight FROM pairs GROUP BY cid)",
+        ])
+        SELECT = (
+            "SELECT {}, rid, SUM(value * IFNULL(weight, 1)) / SUM(IFNULL(weight, 1)) AS value, "
+            "COUNT(*) AS nsample"
+        ).format(", ".join("v.{}".format(field) for field in group_by))
+        FROM = "FROM vals AS v LEFT JOIN weights AS w USING (cid) GROUP BY {}, v.grp, v.rid".format(
+            ", ".join("v.{}".format(field) for field in group_by)
+        )
+    else:
+        print("method {} unknown. Choices ['mean', 'median', 'modz']".format(method))
+        raise ValueError
+
+    query = " ".join([DECLARE, WITH, SELECT, FROM])
+
+    if verbose:
+        print("Table: \n {}".format(table_id))
+        print("Query:\n {}".format(query))
+
+    query_job = run_query(client, query)
+    if output == "gctoo":
+        result = _query_result(query_job, output="pandas")
+        _print_bytes_processed(query_job)
+        return _groups_to_gctoo(result, group_by)
+
+    # numpy and arrow outputs carry no column metadata, so the result is pivoted from Arrow directly
+    result = _query_result(query_job, output="arrow")
+    _print_bytes_processed(query_job)
+    return _pivot_result(_group_cids(result, group_by), output=output)
+
+
+def cmap_geneset_score(
+        client,
+        up=None,
+        down=None,
+        gene_sets=None,
+        cid=None,
+        conditions=None,
+        data_level="level5",
+        feature_space="landmark",
+        table=None,
+        verbose=False,
+        output="pandas",
+):
+    """
+    Score signatures against gene sets inside BigQuery. For each signature and gene set the score is the
+    mean value of the up genes minus the mean value of the down genes. Only the score table is downloaded.
+
+    :param client: Bigquery Client
+    :param up: Up gene set as a GRP file path, comma separated string or list of gene_ids (rids)
+    :param down: Optional down gene set, same formats as up
+    :param gene_sets: dict of {set_name: {'up': genes, 'down': genes}} to score several sets in one query.
+     Used instead of up and down.
+    :param cid: list of column ids to score
+    :param conditions: dict of {field: list of values} selecting signatures from siginfo ('level5') or
+     samples from instinfo ('level3', 'level4'). Used with or instead of cid.
+    :param data_level: Data level to score. Choices are ['level5', 'level4', 'level3']
+    :param feature_space: Feature space of the table to query, see cmap_matrix. Genes outside it are ignored.
+     Default is landmark.
+    :param table: Table address to query. Overrides 'data_level' parameter. Generally should not be used.
+    :param verbose: Print query and table address.
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
+    :return: Pandas DataFrame with columns cid, set_name, up_size, down_size, up_score, down_score and score
+    """
+    import pandas as pd
+
+    if gene_sets is None:
+        if up is None:
+            print("Provide an up gene set or gene_sets")
+            raise ValueError
+        gene_sets = {"set": {"up": up, "down": down}}
+
+    set_rows = []
+    for set_name, genes in gene_sets.items():
+        for direction, key in [(1, "up"), (-1, "down")]:
+            if genes.get(key):
+                set_rows.extend((str(set_name), str(gene), direction) for gene in parse_condition(genes[key]))
+    set_df = pd.DataFrame(set_rows, columns=["set_name", "rid", "direction"]).drop_duplicates()
+
+    config = cfg.get_default_config()
+    table_id = _get_numerical_table_id(
+        table=table,
+        data_level=data_level,
+        feature_space=feature_space,
+        rid=False
+    )
+
+    DECLARE = ""
+    CONDITIONS = ["m.rid in UNNEST({})".format(sorted(set(set_df["rid"])))]
+    if cid:
+        CONDITIONS.append(_cid_condition(cid, alias="m"))
+    if conditions:
+        if data_level == "level5":
+            meta_table, id_field = config.tables.siginfo, "sig_id"
+        else:
+            meta_table, id_field = config.tables.instinfo, "sample_id"
+        DECLARE = _declare_id_array("score_ids", id_field, meta_table, _build_conditions(conditions))
+        CONDITIONS.append("m.cid in UNNEST(score_ids)")
+    if not cid and not conditions:
+        print("No cid or conditions given, scoring every column of {}".format(table_id))
+
+    WITH = "WITH gene_sets AS (SELECT * FROM UNNEST({}))".format(_struct_array_literal(set_df))
+    SELECT = (
+        "SELECT cid, set_name, up_size, down_size, up_score, down_score, "
+        "IFNULL(up_score, 0) - IFNULL(down_score, 0) AS score FROM ("
+        "SELECT m.cid, g.set_name, "
+        "COUNTIF(g.direction > 0) AS up_size, "
+        "COUNTIF(g.direction < 0) AS down_size, "
+        "AVG(IF(g.direction > 0, m.value, NULL)) AS up_score, "
+        "AVG(IF(g.direction < 0, m.value, NULL)) AS down_score"
+    )
+    FROM = "FROM `{}` AS m JOIN gene_sets AS g ON m.rid = g.rid".format(table_id)
+    WHERE = "WHERE " + " AND ".join(CONDITIONS)
+    GROUP = "GROUP BY m.cid, g.set_name)"
+
+    query = " ".join([DECLARE, WITH, SELECT, FROM, WHERE, GROUP]).strip()
+
+    assert (
+            len(query) < 1024 * 10 ** 3
+    ), "Query length exceeds maximum allowed by BQ, keep under 1M characters"
+
+    if verbose:
+        print("Table: \n {}".format(table_id))
+        print("Query:\n {}".format(query))
+
+    query_job = run_query(client, query)
+    result = _query_result(query_job, output=output)
+    _print_bytes_processed(query_job)
+    return result
+
+
+def cmap_replicates(
+        client,
+        sig_id,
+        data_level="level4",
+        feature_space="landmark",
+        rid=None,
+        table=None,
+        verbose=False,
+        output="gctoo",
+):
+    """
+    Fetch the level 4 or level 3 replicate profiles behind level 5 signatures in one query. Signatures are
+    resolved to their samples through the siginfo distil_ids field inside BigQuery.
+
+    :param client: Bigquery Client
+    :param sig_id: list of sig_ids
+    :param data_level: Data level of replicates. Choices are ['level4', 'level3']. Default is 'level4'
+    :param feature_space: Common featurespaces to extract, see cmap_matrix. 'rid' overrides selection
+    :param rid: Row ids
+    :param table: Table address to query. Overrides 'data_level' parameter. Generally should not be used.
+    :param verbose: Print query and table address.
+    :param output: ['gctoo', 'numpy', 'arrow']. Return a GCToo object, a cmapBQ.utils.assembly.DenseMatrix (NumPy
+     values with rid and cid arrays) or a pyarrow Table with a 'rid' column and one column per cid.
+    :return: (GCToo object of replicate profiles, dict of {sig_id: list of replicate cids})
+    """
+    _check_matrix_output(output)
+    if data_level not in ["level3", "level4"]:
+        print("Unsupported data_level. select from ['level3', 'level4']")
+        raise ValueError
+
+    sig_id = parse_condition(sig_id)
+    config = cfg.get_default_config()
+    table_id = _get_numerical_table_id(
+        table=table,
+        data_level=data_level,
+        feature_space=feature_space,
+        rid=False
+    )
+
+    SIG_SAMPLES = (
+        "SELECT sig_id, sample_id FROM `{}`, UNNEST(SPLIT(distil_ids, '|')) AS sample_id "
+        "WHERE sig_id in UNNEST({})"
+    ).format(config.tables.siginfo, list(sig_id))
+
+    DECLARE = "DECLARE replicate_ids ARRAY<STRING> DEFAULT (SELECT ARRAY_AGG(DISTINCT sample_id) FROM ({}));".format(
+        SIG_SAMPLES
+    )
+    # Signature to sample mapping rows are appended to the matrix rows with a NULL rid
+    MATRIX = (
+        "SELECT cid, rid, value, CAST(NULL AS STRING) AS sig_id FROM `{}` "
+        "WHERE cid in UNNEST(replicate_ids) AND {}"
+    ).format(table_id, _get_row_condition(rid=rid, feature_space=feature_space))
+    MAPPING = (
+        "SELECT sample_id AS cid, CAST(NULL AS STRING) AS rid, CAST(NULL AS FLOAT64) AS value, sig_id "
+        "FROM ({})"
+    ).format(SIG_SAMPLES)
+
+    query = " ".join([DECLARE, MATRIX, "UNION ALL", MAPPING])
+
+    assert (
+            len(query) < 1024 * 10 ** 3
+    ), "Query length exceeds maximum allowed by BQ, keep under 1M characters"
+
+    if verbose:
+        print("Table: \n {}".format(table_id))
+        print("Query:\n {}".format(query))
+
+    import pyarrow.compute as pc
+    from .utils.assembly import MatrixAssembler
+
+    query_job = run_query(client, query)
+    result = _query_result(query_job, output="arrow")
+    _print_bytes_processed(query_job)
+
+    is_mapping = pc.is_null(result.column("rid"))
+    mapping = result.filter(is_mapping)
+    assembler = MatrixAssembler()
+    assembler.add(result.filter(pc.invert(is_mapping)).select(["cid", "rid", "value"]))
+    matrix = assembler.to_dense()
+
+    present = set(matrix.cids)
+    replicate_map = {}
+    for sig, cid in zip(mapping.column("sig_id").to_pylist(), mapping.column("cid").to_pylist()):
+        if cid in present:
+            replicate_map.setdefault(sig, []).append(cid)
+    return _matrix_output(matrix, output=output), replicate_map
+
+
+def _declare_id_array(name, id_field, table, CONDITIONS):
+    """
+    Script statement declaring an ARRAY<STRING> variable of ids selected from a metadata table. Filtering
+    a clustered matrix table on the variable prunes clusters, which a join does not.
+
+    :param name: variable name
+    :param id_field: field to collect
+    :param table: metadata table address
+    :param CONDITIONS: list of condition strings
+    :return: DECLARE statement
+    """
+    WHERE = ""
+    if CONDITIONS:
+        WHERE = " WHERE " + " AND ".join(CONDITIONS)
+    return "DECLARE {} ARRAY<STRING> DEFAULT (SELECT ARRAY_AGG(DISTINCT CAST({} AS STRING)) FROM `{}`{});".format(
+        name, id_field, table, WHERE
+    )
+
+
+def _groups_to_gctoo(result, group_by):
+    """
+    Pivot aggregated long results into a GCToo object with one column per group.
+
+    :param result: DataFrame with group_by fields, rid, value and nsample columns
+    :param group_by: list of group fields
+    :return: GCToo object
+    """
+    from cmapPy.pandasGEXpress.GCToo import GCToo
+    from .utils import long_to_gctx
 
-    result = query_job.result().to_dataframe()
+    result = result.copy()
+    result["cid"] = result[list(group_by)].astype(str).agg(":".join, axis=1)
 
+    gctoo = long_to_gctx(result)
+
+    col_metadata = result[["cid"] + list(group_by) + ["nsample"]]
+    col_metadata = col_metadata.groupby("cid", sort=False).agg(
+        dict([(field, "first") for field in group_by] + [("nsample", "max")])
+    )
+    col_metadata = col_metadata.reindex(gctoo.data_df.columns)
+    col_metadata.index.name = "cid"
+    col_metadata.columns.name = "chd"
+
+    return GCToo(gctoo.data_df, col_metadata_df=col_metadata)
+
+
+def _group_cids(result, group_by):
+    """
+    Arrow counterpart of the column ids built by _groups_to_gctoo, group values joined with ':'.
+
+    :param result: pyarrow Table with group_by fields, rid and value columns
+    :param group_by: list of group fields
+    :return: pyarrow Table with cid, rid and value columns
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    fields = [pc.fill_null(pc.cast(result.column(field), pa.string()), "None") for field in group_by]
+    return pa.table({
+        "cid": pc.binary_join_element_wise(*fields, ":"),
+        "rid": result.column("rid"),
+        "value": result.column("value"),
+    })
+
+
+def _profiles_to_long(profiles, value_name="value"):
+    """
+    Convert query profiles to a long DataFrame with columns qid, rid, value.
+
+    :param profiles: Pandas Series, DataFrame (rid x qid), GCToo or dict of {rid: value}
+    :return: Pandas DataFrame
+    """
+    import pandas as pd
+    from cmapPy.pandasGEXpress.GCToo import GCToo
+
+    if isinstance(profiles, GCToo):
+        profiles = profiles.data_df
+    elif isinstance(profiles, dict):
+        profiles = pd.Series(profiles)
+
+    if isinstance(profiles, pd.Series):
+        profiles = profiles.to_frame(name=profiles.name if profiles.name is not None else "query")
+
+    profiles_long = profiles.rename_axis(index="rid", columns="qid").stack().rename(value_name).reset_index()
+    profiles_long["rid"] = profiles_long["rid"].astype(str)
+    profiles_long["qid"] = profiles_long["qid"].astype(str)
+    return profiles_long[["qid", "rid", value_name]].dropna()
+
+
+def _struct_array_literal(df):
+    """
+    Format a DataFrame as a BigQuery ARRAY<STRUCT> literal. String columns are quoted, numeric columns are
+    written as FLOAT64.
+
+    :param df: Pandas DataFrame
+    :return: string
+    """
+    import pandas as pd
+
+    fields = []
+    for col in df.columns:
+        if pd.api.types.is_numeric_dtype(df[col]):
+            fields.append([repr(float(v)) for v in df[col]])
+        else:
+            fields.append([repr(str(v)) for v in df[col]])
+
+    structs = [
+        "STRUCT({})".format(", ".join("{} AS {}".format(v, col) for v, col in zip(values, df.columns)))
+        for values in zip(*fields)
+    ]
+    return "[{}]".format(", ".join(structs))
+
+
+def _cid_condition(cid, alias=None, prefix=""):
+    if not cid:
+        return ""
+    field = "cid" if alias is None else "{}.cid".format(alias)
+    return "{}{} in UNNEST({})".format(prefix, field, list(parse_condition(cid)))
+
+
+def get_table_info(client, table_id, output="pandas"):
+    """
+    Query a table address within client's permissions for schema.
+
+    :param client: Bigquery Client
+    :param table_id: table address as {dataset}.{table_id}
+    :param output: ['pandas', 'arrow']. Return a Pandas DataFrame or a pyarrow Table
+    :return: Pandas Dataframe of column names. Note: Not all column names are query-able but all will be returned from a given metadata table
+    """
+    tok = table_id.split(".")
+
+    if len(tok) > 1:
+        dataset_name = ".".join(tok[0:-1])
+        table_name = tok[-1]
+    else:
+        return NotImplementedError("table_id should be in {dataset}.{table_id} format")
+
+    QUERY = "SELECT column_name, data_type FROM `{}.INFORMATION_SCHEMA.COLUMNS` WHERE table_name='{}'".format(
+        dataset_name, table_name
+    )
+    table_desc = _fetch_result(client, QUERY, [table_id], output=output)
+    return table_desc
+
+
+def _build_query(table_id, cid=None, rid=None, feature_space="landmark", top_k=None):
+    """
+    Crafts and retrieves query from rid and cid conditions. Uses pandas GBQ read_gbq
+    to download records from BigQuery as a dataframe object.
+
+    :param table_id: Matrix table
+    :param cid: list of column ids (samples/sig_ids)
+    :param rid: list of row ids (gene space)
+    :param feature_space: Common featurespaces to extract. 'rid' overrides selection
+            Choices: ['landmark', 'bing', 'aig']
+            landmark: 978 landmark genes
+            bing: Best-inferred set of 10,174 genes
+            aig: All inferred genes including 12,328 genes
+            Default is landmark.
+    :param top_k: Only keep the top_k highest and lowest values of each cid
+    :return: Long-form DataFrame object
+    """
+    SELECT = "SELECT cid, rid, value"
+    FROM = "FROM `{}`".format(table_id)
+
+    CONDITIONS = []
+    if rid:
+        rids = parse_condition(rid)
+        CONDITIONS.append("rid in UNNEST({})".format(list(rids)))
+    else:
+        CONDITIONS.append(_get_feature_space_condition(feature_space))
+
+    if cid:
+        cids = parse_condition(cid)
+        CONDITIONS.append("cid in UNNEST({})".format(cids))
+
+    if CONDITIONS:
+        WHERE = "WHERE " + " AND ".join(CONDITIONS)
+    else:
+        WHERE = ""
+
+    QUERY = " ".join([SELECT, FROM, WHERE])
+
+    if top_k is not None:
+        QUERY = (
+            "SELECT cid, rid, value FROM ("
+            "SELECT cid, rid, value, "
+            "ROW_NUMBER() OVER (PARTITION BY cid ORDER BY value DESC) AS up_rank, "
+            "ROW_NUMBER() OVER (PARTITION BY cid ORDER BY value ASC) AS down_rank "
+            "FROM ({})) WHERE up_rank <= {} OR down_rank <= {}"
+        ).format(QUERY, int(top_k), int(top_k))
+
+    return QUERY
+
+def fmt_size(num, suffix='B'):
+    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Yi', suffix)
+
+def _build_and_launch_query(client, table_id, cid=None, rid=None, feature_space="landmark", verbose=False,
+                            top_k=None, reattach=False, large_result=False, output="pandas"):
+    """
+    Crafts and retrieves query from rid and cid conditions. Uses pandas GBQ read_gbq
+    to download records from BigQuery as a dataframe object.
+
+    :param table_id: Matrix table
+    :param cid: list of column ids (samples/sig_ids)
+    :param rid: list of row ids (gene space)
+    :param feature_space: Common featurespaces to extract. 'rid' overrides selection
+        Choices: ['landmark', 'bing', 'aig']
+        landmark: 978 landmark genes
+        bing: Best-inferred set of 10,174 genes
+        aig: All inferred genes including 12,328 genes
+        Default is landmark.
+    :param verbose: Shows extra information for debugging
+    :param top_k: Only keep the top_k highest and lowest values of each cid
+    :param reattach: Submit with a deterministic job id and reuse an existing job with that id, see run_query
+    :param large_result: Read the result through a materialized table, see read_large_query
+    :param output: ['pandas', 'arrow']
+    :return: Long-form DataFrame object or pyarrow Table
+    """
+
+    QUERY = _build_query(table_id=table_id,
+                         cid=cid,
+                         rid=rid,
+                         feature_space=feature_space,
+                         top_k=top_k)
+
+    if verbose:
+        print(QUERY)
+
+    if large_result:
+        return read_large_query(client, QUERY, output=output, reattach=reattach)
+
+    job_id, previous_job_id = _reattach_job_ids(client, QUERY) if reattach else (None, None)
+    query_job = run_query(client, QUERY, job_id=job_id, previous_job_id=previous_job_id)
+
+    result = _query_result(query_job, output=output)
+    _print_bytes_processed(query_job)
+
+    return result
+
+
+def _print_bytes_processed(query_job):
     try:
         print("Total bytes processed: {}".format(fmt_size(query_job.total_bytes_processed)))
         print("Total bytes billed: {}".format(fmt_size(query_job.total_bytes_processed)))
@@ -906,53 +2248,435 @@ def _build_and_launch_query(client, table_id, cid=None, rid=None, feature_space=
         print("Total bytes processed: {}".format(query_job.total_bytes_processed))
         print("Total bytes billed: {}".format(query_job.total_bytes_processed))
 
-    return result
 
-
-def _pivot_result(df_long):
+def _pivot_result(df_long, output="gctoo"):
     """
     Converts long-form DataFrame to GCToo object
 
-    :param df_long: long-form DataFrame
+    :param df_long: long-form DataFrame or pyarrow Table
+    :param output: ['gctoo', 'numpy', 'arrow'], see cmap_matrix
     :return: GCToo Object
     """
-    gctoo = long_to_gctx(df_long)
-    return gctoo
+    from .utils.assembly import MatrixAssembler
+
+    assembler = MatrixAssembler()
+    assembler.add(df_long)
+    return _matrix_output(assembler.to_dense(), output=output)
+
+
+def _check_matrix_output(output):
+    if output not in MATRIX_OUTPUTS:
+        print("output only takes {}".format(MATRIX_OUTPUTS))
+        raise ValueError
+
+
+def _matrix_output(matrix, output="gctoo"):
+    """
+    Convert a matrix result to the requested output type.
+
+    :param matrix: GCToo object or DenseMatrix
+    :param output: ['gctoo', 'numpy', 'arrow'], see cmap_matrix
+    :return: GCToo object, DenseMatrix or pyarrow Table
+    """
+    from cmapPy.pandasGEXpress.GCToo import GCToo
+    from .utils.assembly import DenseMatrix
+
+    _check_matrix_output(output)
+    if isinstance(matrix, GCToo):
+        if output == "gctoo":
+            return matrix
+        matrix = DenseMatrix.from_dataframe(matrix.data_df)
+
+    if output == "gctoo":
+        return matrix.to_gctoo()
+    elif output == "arrow":
+        return matrix.to_arrow()
+    return matrix
+
+
+def _select_columns(matrix, cid):
+    """
+    Columns of a matrix result for a list of cids, in the order of the matrix. Used to split coalesced requests.
+
+    :param matrix: GCToo object, DenseMatrix or pyarrow Table
+    :param cid: list of column ids
+    :return: matrix of the same type
+    """
+    import pandas as pd
+    from cmapPy.pandasGEXpress.GCToo import GCToo
+    from .utils.assembly import DenseMatrix
+
+    wanted = set(cid)
+    if isinstance(matrix, GCToo):
+        return GCToo(matrix.data_df[[c for c in matrix.data_df.columns if c in wanted]].copy())
+    if isinstance(matrix, DenseMatrix):
+        keep = pd.Index(matrix.cids).isin(wanted)
+        return DenseMatrix(matrix.values[:, keep].copy(order="F"), matrix.rids.copy(), matrix.cids[keep])
+    return matrix.select(["rid"] + [c for c in matrix.column_names[1:] if c in wanted])
+
+
+def _select_rows(result, field, ids):
+    """
+    Rows of a metadata result whose field is in ids. Used to split coalesced requests.
+
+    :param result: Pandas DataFrame or pyarrow Table
+    :param field: Id field
+    :param ids: list of ids
+    :return: Pandas DataFrame or pyarrow Table
+    """
+    import pandas as pd
+
+    if isinstance(result, pd.DataFrame):
+        return result[result[field].isin(ids)].reset_index(drop=True)
 
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    return result.filter(pc.is_in(result.column(field), value_set=pa.array(ids, type=pa.string())))
 
-def run_query(client, query):
+
+def _returns_field(return_fields, field):
+    if isinstance(return_fields, str) and return_fields in ["all", "priority"]:
+        return True
+    return field in parse_condition(return_fields)
+
+
+def run_query(client, query, job_id=None, output=None, previous_job_id=None):
     """
     Runs BigQuery queryjob
 
     :param client: BigQuery client object
     :param query: Query to run as a string
+    :param job_id: Optional job id, e.g. from query_job_id. If a job with this id is still running or has
+     finished with its results available, that job is returned instead of running the query again.
+    :param output: None returns the QueryJob. 'pandas' or 'arrow' wait for the job and return its result as a
+     Pandas DataFrame or pyarrow Table.
+    :param previous_job_id: Id of the same query in the previous job id window, see _reattach_job_ids. Checked
+     for a reusable job before job_id is submitted.
+    :return: QueryJob object, or the result if output is set
+    """
+    if job_id is None:
+        query_job = client.query(query)
+    else:
+        query_job = _run_or_reattach_query(client, query, job_id, previous_job_id=previous_job_id)
+
+    if output is None:
+        return query_job
+    return _query_result(query_job, output=output)
+
+
+def _query_result(query_job, output="pandas"):
+    """
+    Wait for a query job and download its result. Both formats are read with the BigQuery Storage API when
+    google-cloud-bigquery-storage is installed; 'arrow' skips building a DataFrame.
+
+    :param query_job: QueryJob
+    :param output: ['pandas', 'arrow']
+    :return: Pandas DataFrame or pyarrow Table
+    """
+    if output == "pandas":
+        return query_job.result().to_dataframe()
+    elif output == "arrow":
+        return query_job.result().to_arrow()
+    else:
+        print("output only takes ['pandas', 'arrow']")
+        raise ValueError
+
+
+# Anonymous result tables are kept for about 24 hours, so job ids are scoped to UTC day windows of that length.
+# Reruns in the first hours of a window also look for the job submitted under the previous window's id.
+_JOB_ID_WINDOW = 24 * 3600
+_PREVIOUS_WINDOW_PROBE = 6 * 3600
+_MAX_JOB_ATTEMPTS = 10
+
+
+def query_job_id(query, client=None, prefix="cmapBQ", timestamp=None):
+    """
+    Deterministic BigQuery job id for a query within the UTC day window (epoch aligned) containing timestamp.
+    Queries differing only in whitespace share an id. If client is given, its project and account are part of
+    the id, so principals running the same query do not reattach to each other's jobs.
+
+    :param query: Query string
+    :param client: BigQuery Client submitting the query
+    :param prefix: Job id prefix
+    :param timestamp: Unix time the id is computed for. Default is now
+    :return: job id string
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    text = cache.normalize_query(query)
+    if client is not None:
+        text = "{}|{}\n{}".format(getattr(client, "project", None), cache.client_principal(client), text)
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return "{}_{}_{}".format(prefix, digest[:40], int(timestamp // _JOB_ID_WINDOW))
+
+
+def _reattach_job_ids(client, query, prefix="cmapBQ", timestamp=None):
+    """
+    Job id for a query and, in the first hours of a window, the id it had in the previous window.
+
+    :return: (job_id, previous_job_id or None)
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    previous_job_id = None
+    if timestamp % _JOB_ID_WINDOW < _PREVIOUS_WINDOW_PROBE:
+        previous_job_id = query_job_id(query, client=client, prefix=prefix, timestamp=timestamp - _JOB_ID_WINDOW)
+    return query_job_id(query, client=client, prefix=prefix, timestamp=timestamp), previous_job_id
+
+
+def _attempt_job_id(job_id, attempt):
+    return job_id if attempt == 0 else "{}_{}".format(job_id, attempt)
+
+
+def _run_or_reattach_query(client, query, job_id, previous_job_id=None):
+    """
+    Submit the query under job_id. If a job with that id already exists and is pending, running or done with
+    results still in its anonymous destination table, that job is returned instead. Failed jobs cannot be
+    replaced under the same id, so later attempts use job_id_1, job_id_2, ... Jobs that cannot be read by
+    this client (Forbidden) are treated as not reusable.
+
+    :param previous_job_id: Id the query had in the previous window. A reusable job under it is returned before
+     submitting.
     :return: QueryJob object
     """
+    from google.api_core.exceptions import Conflict, Forbidden, NotFound
+
+    if previous_job_id is not None:
+        job = _find_reusable_job(client, previous_job_id)
+        if job is not None:
+            return job
+
+    for attempt in range(_MAX_JOB_ATTEMPTS):
+        attempt_id = _attempt_job_id(job_id, attempt)
+        try:
+            return client.query(query, job_id=attempt_id)
+        except Conflict:
+            pass
+
+        try:
+            job = client.get_job(attempt_id)
+        except NotFound:
+            # Reported as existing but not visible yet
+            continue
+        except Forbidden:
+            print("BigQuery job {} is not readable, trying the next job id".format(attempt_id))
+            continue
+        if _job_reusable(client, job):
+            print("Reattaching to BigQuery job {} ({})".format(attempt_id, job.state))
+            return job
+
+    print("Jobs {} to {}_{} failed or expired, submitting without reattach".format(
+        job_id, job_id, _MAX_JOB_ATTEMPTS - 1
+    ))
     return client.query(query)
 
 
-def _run_query_create_log(query, client, destination_table=None):
+def _find_reusable_job(client, job_id):
     """
-    Runs BigQuery queryjob
+    Look up job_id, job_id_1, ... and return the first reusable job. Stops at the first id that does not exist.
+
+    :return: QueryJob object or None
+    """
+    from google.api_core.exceptions import Forbidden, NotFound
+
+    for attempt in range(_MAX_JOB_ATTEMPTS):
+        attempt_id = _attempt_job_id(job_id, attempt)
+        try:
+            job = client.get_job(attempt_id)
+        except (NotFound, Forbidden):
+            return None
+        if _job_reusable(client, job):
+            print("Reattaching to BigQuery job {} ({})".format(attempt_id, job.state))
+            return job
+    return None
+
+
+def _job_reusable(client, job):
+    from google.api_core.exceptions import Forbidden, NotFound
+
+    if job.state != "DONE":
+        return True
+    if job.error_result is not None:
+        return False
+    if job.destination is None:
+        # A finished CREATE TABLE job has no destination, its table was already looked for and is gone
+        return False
+    try:
+        client.get_table(job.destination)
+    except (NotFound, Forbidden):
+        return False
+    return True
+
+
+def _run_cached_query(client, query, tables):
+    """
+    Runs BigQuery queryjob through the query result cache. See cmapBQ.cache.
 
+    :param client: BigQuery client object
     :param query: Query to run as a string
+    :param tables: list of table addresses read by the query
+    :return: Pandas DataFrame
+    """
+    query_cache = cache.get_query_cache()
+    if query_cache is None:
+        return run_query(client, query).result().to_dataframe()
+    return query_cache.get_or_run(
+        client, query, tables, lambda: run_query(client, query).result().to_dataframe()
+    )
+
+
+def _fetch_result(client, query, tables, output="pandas"):
+    """
+    Run query and return the full result in the requested format. Pandas results are read through the
+    query result cache and may be the same object returned to an earlier call, see cmapBQ.cache.
+
     :param client: BigQuery client object
-    :return: QueryJob object
+    :param query: Query to run as a string
+    :param tables: list of table addresses read by the query
+    :param output: ['pandas', 'arrow']
+    :return: Pandas DataFrame or pyarrow Table
+    """
+    if output == "pandas":
+        return _run_cached_query(client, query, tables)
+    return run_query(client, query, output=output)
+
+
+def _iter_query_pages(client, query, page_size=None, output="pandas"):
+    """
+    Run query and return an iterator over the result pages. Pages are downloaded as they are consumed.
+
+    :param client: BigQuery client object
+    :param query: Query to run as a string
+    :param page_size: Number of rows per page
+    :param output: ['pandas', 'arrow']. Yields Pandas DataFrames or pyarrow RecordBatches
+    :return: Generator of pages
+    """
+    if output not in ["pandas", "arrow"]:
+        print("output only takes ['pandas', 'arrow']")
+        raise ValueError
+
+    rows = run_query(client, query).result(page_size=page_size)
+    if output == "arrow":
+        return rows.to_arrow_iterable()
+    return rows.to_dataframe_iterable()
+
+
+def read_large_query(client, query, output="pandas", keep_table=False, verbose=False, reattach=False):
+    """
+    Run a query with a large result. The result is materialized into the dataset set with
+    cmapBQ.config.set_materialization, read back over parallel BigQuery Storage API read streams and the
+    table is deleted. Materialized tables are created with the configured expiration, so they expire even if
+    the run is interrupted before cleanup.
+
+    :param client: BigQuery Client
+    :param query: Query to run as a string. Must be a single SELECT statement.
+    :param output: ['pandas', 'arrow']
+    :param keep_table: Do not delete the materialized table. It still expires.
+    :param verbose: Print query
+    :param reattach: Name the materialized table and its CREATE TABLE job after query_job_id. A rerun reads
+     the table if an earlier run of the query (this or the previous UTC day) left it, or waits for that run's
+     job if it is still running, instead of executing the query again. Default is False.
+    :return: Pandas DataFrame or pyarrow Table
     """
+    if output not in ["pandas", "arrow"]:
+        print("output only takes ['pandas', 'arrow']")
+        raise ValueError
 
-    # Job config
-    job_config = bigquery.QueryJobConfig()
-    if destination_table is not None:
-        job_config.destination = destination_table
+    if verbose:
+        print(query)
+
+    if reattach:
+        query_job, table_id = _reattach_create_log(client, query)
     else:
-        timestamp_name = datetime.now().strftime("query_%Y%m%d%H%M%S")
-        project = "cmap-big-table"
-        dataset = "cmap_query"
-        dest_tbl = ".".join([project, dataset, timestamp_name])
-        job_config.destination = dest_tbl
+        query_job, table_id = _run_query_create_log(query, client)
+    try:
+        if query_job is not None:
+            query_job.result()
+            _print_bytes_processed(query_job)
+        result = _read_table_streams(client, table_id)
+    finally:
+        if not keep_table:
+            client.delete_table(table_id, not_found_ok=True)
+
+    if output == "arrow":
+        return result
+    return result.to_pandas()
+
+
+def _read_table_streams(client, table_id):
+    """
+    Read a table with the BigQuery Storage API. Read streams are downloaded concurrently by a storage client
+    the BigQuery client creates from its own credentials.
+
+    :param client: BigQuery Client
+    :param table_id: Table address
+    :return: pyarrow Table
+    """
+    return client.list_rows(table_id).to_arrow(create_bqstorage_client=True)
+
+
+def _get_materialization():
+    config = cfg.get_default_config()
+    materialization = getattr(config, "materialization", None)
+    if materialization is None:
+        print(
+            "No dataset configured for large results. Run "
+            "cmapBQ.config.set_materialization('project.dataset') with a dataset you can create tables in"
+        )
+        raise ValueError
+    return materialization
 
-    job_config.create_disposition = "CREATE_IF_NEEDED"
-    return client.query(query, job_config=job_config)
+
+def _reattach_create_log(client, query):
+    """
+    Materialize a query under deterministic table and job names, see read_large_query. An existing table from
+    this or the previous window is returned without running a job.
+
+    :return: (QueryJob object or None if the table exists, destination table address)
+    """
+    from google.api_core.exceptions import NotFound
+
+    materialization = _get_materialization()
+    # Prefixed so the CREATE TABLE job does not take the id of the same SELECT run directly
+    job_id, previous_job_id = _reattach_job_ids(client, query, prefix="cmapBQ_table")
+    for candidate in [job_id, previous_job_id]:
+        if candidate is None:
+            continue
+        table_id = ".".join([materialization.dataset, "query_{}".format(candidate)])
+        try:
+            client.get_table(table_id)
+        except NotFound:
+            continue
+        print("Reading materialized table {} from an earlier run".format(table_id))
+        return None, table_id
+
+    table_id = ".".join([materialization.dataset, "query_{}".format(job_id)])
+    return _run_query_create_log(query, client, destination_table=table_id, job_id=job_id)
+
+
+def _run_query_create_log(query, client, destination_table=None, job_id=None):
+    """
+    Materialize a query into a new table with CREATE TABLE ... AS. The table is created with the configured
+    expiration by the same statement, so it expires even if the result is never read.
+
+    :param query: Query to run as a string. Must be a single SELECT statement.
+    :param client: BigQuery client object
+    :param destination_table: Table to write to. Default is a new table in the configured materialization
+     dataset, see cmapBQ.config.set_materialization
+    :param job_id: Submit with this job id, reusing a running job with that id, see run_query
+    :return: (QueryJob object, destination table address)
+    """
+    materialization = _get_materialization()
+    if destination_table is None:
+        table_name = "query_{}_{}".format(datetime.now().strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex[:8])
+        destination_table = ".".join([materialization.dataset, table_name])
+
+    QUERY = (
+        "CREATE TABLE `{}` "
+        "OPTIONS(expiration_timestamp=TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL {} HOUR)) "
+        "AS {}"
+    ).format(destination_table, int(materialization.expiration_hours), query)
+    return run_query(client, QUERY, job_id=job_id), destination_table
 
 
 def _extract_matrix_GCS(query, destination_table=None, storage_uri=None, out_path=None):
@@ -993,15 +2717,20 @@ def _export_table(query_job, client, storage_uri=None):
 
     :param query_job: QueryJob object from which to extract results
     :param client: BigQuery Client Object
-    :param storage_uri: location in GCS to extract table
+    :param storage_uri: location in GCS to extract table. Default is the configured bucket.
     :return: ExtractJob object
     """
-    result_bucket = "clue_queries"
+    from google.cloud import bigquery
+
     res = query_job.result()
     # print(res)
     if storage_uri is not None:
         storage_uri = storage_uri
     else:
+        result_bucket = _get_materialization().bucket
+        if result_bucket is None:
+            print("No GCS bucket configured, pass storage_uri or set bucket with cmapBQ.config.set_materialization")
+            raise ValueError
         timestamp_name = datetime.now().strftime("query_%Y%m%d%H%M%S")
         filename = "result-*.csv"
         storage_uri = "gs://{}/{}/{}".format(result_bucket, timestamp_name, filename)
@@ -1028,11 +2757,14 @@ def _download_from_extract_job(extract_job, destination_path):
     # source_blob_name = "storage-object-name"
     # destination_file_name = "local/path/to/file"
 
+    from google.cloud import storage
+
     storage_client = storage.Client()
 
-    bucket = storage_client.bucket("clue_queries")
     location = extract_job.destination_uris[0]
-    blob_prefix = re.findall("query_[0-9]+/", location)
+    bucket_name, blob_path = re.match("gs://([^/]+)/(.*)", location).groups()
+    bucket = storage_client.bucket(bucket_name)
+    blob_prefix = blob_path.split("*")[0]
     blobs = [_ for _ in bucket.list_blobs(prefix=blob_prefix)]
 
     filelist = []
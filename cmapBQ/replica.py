@@ -0,0 +1,245 @@
+import os
+import time
+from datetime import datetime
+
+import yaml
+import numpy as np
+import pandas as pd
+
+from cmapPy.pandasGEXpress.GCToo import GCToo
+
+from .utils import read_ids, write_ids
+
+
+_VALUES_FILE = "values.npy"
+_RID_FILE = "rid.txt"
+_CID_FILE = "cid.txt"
+_INFO_FILE = "replica.yaml"
+
+# Seconds a replica's staleness check against its source table is reused
+_MODIFIED_TTL = 300
+
+_open_replicas = {}
+_checked_replicas = {}
+
+
+class Replica:
+    """
+    Local copy of a matrix table. Values are a float32 (cid, rid) array memory-mapped from disk, so each
+    signature is contiguous and column lookups only touch the pages they read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _INFO_FILE), "r") as fh:
+            self.info = yaml.safe_load(fh)
+
+        self.rids = read_ids(os.path.join(path, _RID_FILE))
+        self.cids = read_ids(os.path.join(path, _CID_FILE))
+        self.rid_index = {rid: i for i, rid in enumerate(self.rids)}
+        self.cid_index = {cid: i for i, cid in enumerate(self.cids)}
+        self.values = np.load(os.path.join(path, _VALUES_FILE), mmap_mode="r")
+
+    @property
+    def table(self):
+        return self.info["table"]
+
+    @property
+    def feature_space(self):
+        return self.info["feature_space"]
+
+    @property
+    def partial(self):
+        """
+        True if the replica was built for a subset of the table's cids
+        """
+        return bool(self.info.get("partial", False))
+
+    @property
+    def source_modified(self):
+        """
+        Last-modified time of the source table when the replica was built, or None if it was not recorded
+        """
+        return self.info.get("source_modified")
+
+    @property
+    def complete(self):
+        """
+        True if the replica is known to hold every cid of its source table, so cids it does not hold are not
+        in the table either
+        """
+        return not self.partial and self.source_modified is not None
+
+    def missing(self, cid):
+        """
+        :param cid: list of column ids
+        :return: list of ids not held by the replica
+        """
+        return [c for c in cid if c not in self.cid_index]
+
+    def get(self, cid=None, rid=None):
+        """
+        Slice the replica. Ids not present in the replica are dropped. Rows and columns are sorted, as in
+        cmap_matrix results read from BigQuery.
+
+        :param cid: list of column ids. Default returns all.
+        :param rid: list of row ids. Default returns all.
+        :return: GCToo object
+        """
+        cids = sorted(set(self.cids if cid is None else [str(c) for c in cid if str(c) in self.cid_index]))
+        rids = sorted(set(self.rids if rid is None else [str(r) for r in rid if str(r) in self.rid_index]))
+        col_idx = [self.cid_index[c] for c in cids]
+        row_idx = [self.rid_index[r] for r in rids]
+
+        values = np.array(self.values[col_idx][:, row_idx].T)
+        data_df = pd.DataFrame(values, index=pd.Index(rids, name="rid"), columns=pd.Index(cids, name="cid"))
+        return GCToo(data_df)
+
+
+def open_replica(path):
+    """
+    Open a replica directory. Opened replicas are reused until the directory changes.
+
+    :param path: replica directory
+    :return: Replica
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    mtime = os.path.getmtime(os.path.join(path, _INFO_FILE))
+    if path not in _open_replicas or _open_replicas[path][0] != mtime:
+        _open_replicas[path] = (mtime, Replica(path))
+    return _open_replicas[path][1]
+
+
+def get_replica(table_id, config=None, client=None):
+    """
+    Return the replica registered for a table in the config, if any. If client is given, a replica built
+    before the last update of the table is skipped.
+
+    :param table_id: Matrix table address
+    :param config: Configuration object. Default reads ~/.cmapBQ/config.txt
+    :param client: BigQuery Client used to look up the table's last-modified time
+    :return: Replica or None
+    """
+    if config is None:
+        import cmapBQ.config as cfg
+        config = cfg.get_default_config()
+
+    replicas = getattr(config, "replicas", None)
+    if not replicas or table_id not in replicas:
+        return None
+
+    path = replicas[table_id]
+    if not os.path.exists(os.path.join(os.path.expanduser(path), _INFO_FILE)):
+        print("Replica for {} not found at {}, querying BigQuery".format(table_id, path))
+        return None
+
+    replica = open_replica(path)
+    if client is not None and not _is_current(client, replica):
+        print("Replica at {} is older than {}, querying BigQuery. Rebuild it with the replicate tool".format(
+            replica.path, table_id
+        ))
+        return None
+    return replica
+
+
+def _is_current(client, replica):
+    """
+    Compare the source table's last-modified time to the one recorded in the replica. Lookups are reused
+    for _MODIFIED_TTL seconds.
+    """
+    if replica.source_modified is None:
+        # Built before modification times were recorded
+        return True
+
+    now = time.time()
+    checked = _checked_replicas.get(replica.path)
+    if checked is not None and checked[0] is replica and now - checked[1] < _MODIFIED_TTL:
+        return checked[2]
+
+    modified = _get_table_modified(client, replica.table)
+    # Tables without metadata access cannot be checked
+    current = modified is None or modified == replica.source_modified
+    _checked_replicas[replica.path] = (replica, now, current)
+    return current
+
+
+def _get_table_modified(client, table_id):
+    try:
+        modified = client.get_table(table_id).modified
+    except Exception:
+        return None
+    return None if modified is None else str(modified)
+
+
+def build_replica(client, path, data_level="level5", feature_space="landmark", table=None, cid=None,
+                  chunk_size=10000, verbose=False):
+    """
+    Export a matrix table into a local replica directory.
+
+    :param client: BigQuery Client
+    :param path: Output directory
+    :param data_level: Data level to replicate. Choices are ['level5', 'level4', 'level3']
+    :param feature_space: Feature space to replicate, see cmap_matrix. Default is landmark.
+    :param table: Table address to replicate. Overrides 'data_level' parameter.
+    :param cid: Optional list of column ids to replicate. Default replicates every cid in the table. cmap_matrix
+     queries BigQuery for cids missing from a partial replica.
+    :param chunk_size: Number of columns per query. Default 10,000
+    :param verbose: Print queries
+    :return: path to replica
+    """
+    from cmapBQ.query import _get_numerical_table_id, iter_cmap_matrix, run_query
+    from cmapBQ.utils import parse_condition
+
+    table_id = _get_numerical_table_id(
+        table=table, data_level=data_level, feature_space=feature_space, rid=False
+    )
+    # Read before exporting, so an update during the export also marks the replica as stale
+    source_modified = _get_table_modified(client, table_id)
+
+    if cid is None:
+        print("Listing column ids in {}".format(table_id))
+        query = "SELECT DISTINCT cid FROM `{}` ORDER BY cid".format(table_id)
+        cids = run_query(client, query).result().to_dataframe()["cid"].astype(str).tolist()
+    else:
+        cids = [str(c) for c in parse_condition(cid)]
+    cid_index = {c: i for i, c in enumerate(cids)}
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    values = None
+    rids = None
+    for gctoo in iter_cmap_matrix(client, table=table_id, feature_space=feature_space, cid=cids,
+                                  chunk_size=chunk_size, verbose=verbose):
+        if values is None:
+            rids = [str(r) for r in gctoo.data_df.index]
+            values = np.lib.format.open_memmap(
+                os.path.join(path, _VALUES_FILE), mode="w+", dtype=np.float32, shape=(len(cids), len(rids))
+            )
+            values[:] = np.nan
+        block = gctoo.data_df.reindex(rids)
+        values[[cid_index[str(c)] for c in block.columns]] = block.values.T.astype(np.float32)
+
+    if values is None:
+        print("No data returned for {}".format(table_id))
+        raise ValueError
+    values.flush()
+    del values
+
+    write_ids(os.path.join(path, _RID_FILE), rids)
+    write_ids(os.path.join(path, _CID_FILE), cids)
+
+    info = {
+        "table": table_id,
+        "feature_space": feature_space,
+        "shape": [len(cids), len(rids)],
+        "dtype": "float32",
+        "partial": cid is not None,
+        "source_modified": source_modified,
+        "created": datetime.now().strftime("%c"),
+    }
+    # Written last, a replica without replica.yaml is incomplete
+    with open(os.path.join(path, _INFO_FILE), "w") as fh:
+        yaml.dump(info, fh)
+
+    return path
@@ -0,0 +1,22 @@
+import pytest
+
+import cmapBQ.cache as cache
+import cmapBQ.coalescing as coalescing
+import cmapBQ.config as cfg
+import cmapBQ.query as query
+
+
+@pytest.fixture(autouse=True)
+def cmapbq_home(tmp_path, monkeypatch):
+    """
+    Run each test against a default config in a temporary home directory, with fresh module state.
+    """
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.delenv("GOOGLE_APPLICATION_CREDENTIALS", raising=False)
+    cfg.setup_credentials("unused.json")
+    monkeypatch.setattr(query, "_feature_space_genes", {})
+    cache.configure_cache()
+    coalescing.configure_coalescing(enabled=False)
+    yield tmp_path
+    cache.configure_cache()
+    coalescing.configure_coalescing(enabled=False)
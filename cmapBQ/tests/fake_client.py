@@ -0,0 +1,215 @@
+"""
+In-memory stand-in for google.cloud.bigquery.Client. Queries are answered from small pandas tables by
+applying their 'field in UNNEST([...])' conditions, top-k ranking and LIMIT, which covers the queries cmapBQ builds for
+metadata and matrix tables. Queries it cannot answer can be served by setting FakeClient.handler.
+"""
+import re
+import ast
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from google.api_core.exceptions import Conflict, NotFound
+
+
+def make_tables(nsig=40, ngene=12):
+    """
+    :return: dict of table name to Pandas DataFrame, named like the default config tables
+    """
+    rng = np.random.default_rng(0)
+    genes = pd.DataFrame({
+        "gene_id": np.arange(1, ngene + 1),
+        "gene_symbol": ["G{}".format(i) for i in range(1, ngene + 1)],
+        "feature_space": ["landmark"] * (ngene // 2) + ["inferred"] * (ngene - ngene // 2),
+    })
+    siginfo = pd.DataFrame({
+        "sig_id": ["sig{}".format(i) for i in range(nsig)],
+        "pert_id": ["BRD-{}".format(i % 5) for i in range(nsig)],
+        "cmap_name": ["cpd{}".format(i % 5) for i in range(nsig)],
+        "pert_type": "trt_cp",
+        "cell_iname": ["cell{}".format(i % 3) for i in range(nsig)],
+    })
+    level5 = pd.DataFrame(
+        [(sig, str(gene), float(rng.normal())) for sig in siginfo.sig_id for gene in genes.gene_id],
+        columns=["cid", "rid", "value"],
+    )
+    return {"geneinfo": genes, "siginfo": siginfo, "L1000_Level5": level5}
+
+
+class FakeCredentials:
+    def __init__(self, service_account_email):
+        self.service_account_email = service_account_email
+
+
+class FakeTable:
+    def __init__(self, table_id, modified=None, expires=None):
+        self.table_id = table_id
+        self.modified = modified or datetime(2021, 1, 1, tzinfo=timezone.utc)
+        self.expires = expires
+
+
+class FakeResult:
+    def __init__(self, df, page_size=None):
+        self.df = df
+        self.total_rows = len(df)
+        self.page_size = page_size
+        self.to_dataframe_calls = 0
+        self.to_arrow_calls = 0
+
+    def to_dataframe(self, **kwargs):
+        self.to_dataframe_calls += 1
+        return self.df.copy()
+
+    def to_arrow(self, **kwargs):
+        import pyarrow as pa
+
+        self.to_arrow_calls += 1
+        return pa.Table.from_pandas(self.df, preserve_index=False)
+
+    def to_dataframe_iterable(self, **kwargs):
+        n = self.page_size or max(len(self.df), 1)
+        for i in range(0, len(self.df), n):
+            yield self.df.iloc[i:i + n].reset_index(drop=True)
+
+
+class FakeJob:
+    total_bytes_processed = 1024
+    total_bytes_billed = 1024
+
+    def __init__(self, client, query, df, job_id, destination=None):
+        self.client = client
+        self.query = query
+        self.df = df
+        self.job_id = job_id
+        self.state = "DONE"
+        self.error_result = None
+        self.destination = destination
+        self.results = []
+
+    def result(self, page_size=None, **kwargs):
+        result = FakeResult(self.df, page_size=page_size)
+        self.results.append(result)
+        return result
+
+    def done(self):
+        return True
+
+
+class FakeClient:
+    """
+    :param tables: dict of table name to Pandas DataFrame. Tables are matched on the last part of their address,
+     with matrix tables' clustering suffix (_cid, _rid, _landmark) removed.
+    :param project: Project id
+    :param credentials: Credentials object, see FakeCredentials
+    """
+
+    def __init__(self, tables=None, project="test-project", credentials=None):
+        self.tables = make_tables() if tables is None else tables
+        self.project = project
+        self._credentials = credentials or FakeCredentials("reader@test-project.iam.gserviceaccount.com")
+        self.handler = None
+        self.delay = 0
+        self.queries = []
+        self.submitted = []
+        self.jobs = {}
+        self.table_info = {}
+        self.created = {}
+        self.deleted = []
+        self.calls = {"query": 0, "get_job": 0, "get_table": 0}
+        self._lock = threading.Lock()
+
+    def query(self, query, job_config=None, job_id=None, **kwargs):
+        with self._lock:
+            self.calls["query"] += 1
+            if job_id is not None and job_id in self.jobs:
+                raise Conflict("Already Exists: Job {}".format(job_id))
+            self.queries.append(query)
+            self.submitted.append(job_id)
+
+        if self.delay:
+            import time
+            time.sleep(self.delay)
+        job_id = job_id or "job_{}".format(len(self.submitted))
+        destination = "{}._anon.{}".format(self.project, job_id)
+
+        create = re.match(r"CREATE TABLE `([^`]+)` OPTIONS\(expiration_timestamp=(.*?)\) AS (.*)$", query, re.S)
+        if create is not None:
+            # DDL jobs have no destination, the created table holds the result
+            destination, query = create.group(1), create.group(3)
+            with self._lock:
+                self.table_info[destination] = FakeTable(destination, expires=create.group(2))
+
+        df = self.handler(query) if self.handler is not None else self.run(query)
+        if create is not None:
+            with self._lock:
+                self.created[destination] = df
+            df, destination = df.iloc[0:0], None
+
+        job = FakeJob(self, query, df, job_id, destination=destination)
+        with self._lock:
+            self.jobs[job_id] = job
+            if destination is not None:
+                self.table_info.setdefault(destination, FakeTable(destination))
+        return job
+
+    def get_job(self, job_id, **kwargs):
+        with self._lock:
+            self.calls["get_job"] += 1
+            if job_id not in self.jobs:
+                raise NotFound("Not found: Job {}".format(job_id))
+            return self.jobs[job_id]
+
+    def get_table(self, table, **kwargs):
+        table_id = str(table).replace("`", "")
+        with self._lock:
+            self.calls["get_table"] += 1
+            if table_id in self.table_info:
+                return self.table_info[table_id]
+        if _table_name(table_id.split(".")[-1]) in self.tables:
+            return FakeTable(table_id)
+        raise NotFound("Not found: Table {}".format(table_id))
+
+    def list_rows(self, table, **kwargs):
+        return FakeResult(self.created[str(table)])
+
+    def delete_table(self, table, not_found_ok=False, **kwargs):
+        with self._lock:
+            self.deleted.append(str(table))
+            self.created.pop(str(table), None)
+            self.table_info.pop(str(table), None)
+
+    def run(self, query):
+        if "INFORMATION_SCHEMA" in query:
+            name = re.search(r"table_name='(\w+)'", query).group(1)
+            columns = self.tables[name].columns
+            return pd.DataFrame({"column_name": list(columns), "data_type": ["STRING"] * len(columns)})
+
+        head = query.split("WHERE")[0]
+        # Metadata queries name their table without backticks
+        names = re.findall(r"`[\w\-.]*?\.(\w+)`", head) or re.findall(r"FROM [\w\-]+\.\w+\.(\w+)", head)
+        df = self.tables[_table_name(names[-1])]
+        for field, values in re.findall(r"(\w+) in UNNEST\((\[.*?\])\)", query):
+            if field in df.columns:
+                values = [str(value) for value in ast.literal_eval(values)]
+                df = df[df[field].astype(str).isin(values)]
+
+        select = re.match(r"SELECT (DISTINCT )?([\w, ]+?) FROM", query)
+        if select is not None and select.group(2).strip() != "*":
+            df = df[[field.strip() for field in select.group(2).split(",")]]
+            if select.group(1):
+                df = df.drop_duplicates()
+        top_k = re.search(r"up_rank <= (\d+) OR down_rank <= (\d+)", query)
+        if top_k is not None:
+            k = int(top_k.group(1))
+            up = df.groupby("cid")["value"].rank(method="first", ascending=False)
+            down = df.groupby("cid")["value"].rank(method="first", ascending=True)
+            df = df[(up <= k) | (down <= k)]
+        limit = re.search(r"LIMIT (\d+)", query)
+        if limit is not None:
+            df = df.head(int(limit.group(1)))
+        return df.reset_index(drop=True)
+
+
+def _table_name(name):
+    return re.sub(r"_(cid|rid|landmark)$", "", name)
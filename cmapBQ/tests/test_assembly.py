@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from cmapBQ.utils.assembly import DenseMatrix, MatrixAssembler
+
+
+def _long(pairs):
+    return pd.DataFrame(
+        [(cid, rid, value) for (cid, rid), value in pairs.items()], columns=["cid", "rid", "value"]
+    )
+
+
+def _values(nrid, ncid):
+    return {
+        ("c{}".format(c), "r{}".format(r)): float(10 * r + c) for c in range(ncid) for r in range(nrid)
+    }
+
+
+def test_chunks_assemble_in_sorted_order():
+    values = _values(nrid=3, ncid=4)
+    assembler = MatrixAssembler(cid=["c3", "c1", "c0", "c2"])
+    chunk = _long(values)
+    assembler.add(chunk[chunk.cid.isin(["c3", "c1"])].iloc[::-1])
+    assembler.add(chunk[chunk.cid.isin(["c0", "c2"])])
+
+    dense = assembler.to_dense()
+    assert dense.shape == (3, 4)
+    assert list(dense.rids) == ["r0", "r1", "r2"]
+    assert list(dense.cids) == ["c0", "c1", "c2", "c3"]
+    for (cid, rid), value in values.items():
+        assert dense.values[list(dense.rids).index(rid), list(dense.cids).index(cid)] == value
+    assert dense.values.flags.f_contiguous
+
+
+def test_matches_pivot():
+    values = _values(nrid=5, ncid=6)
+    long_df = _long(values).sample(frac=1, random_state=0)
+    assembler = MatrixAssembler()
+    assembler.add(long_df)
+
+    expected = long_df.pivot(index="rid", columns="cid", values="value")
+    pd.testing.assert_frame_equal(assembler.to_dataframe(), expected, check_names=False)
+
+
+def test_unseen_ids_are_dropped():
+    values = _values(nrid=2, ncid=2)
+    assembler = MatrixAssembler(rid=["r0", "r1", "r9"], cid=["c0", "c1", "c9"])
+    assembler.add(_long(values))
+
+    assert assembler.shape == (3, 3)
+    dense = assembler.to_dense()
+    assert dense.shape == (2, 2)
+    assert list(dense.rids) == ["r0", "r1"]
+    assert list(dense.cids) == ["c0", "c1"]
+    assert not np.isnan(dense.values).any()
+
+
+def test_missing_values_are_nan():
+    assembler = MatrixAssembler(cid=["c0", "c1"])
+    assembler.add(_long({("c0", "r0"): 1.0, ("c1", "r1"): 2.0}))
+
+    data_df = assembler.to_dataframe()
+    assert data_df.loc["r0", "c0"] == 1.0
+    assert np.isnan(data_df.loc["r1", "c0"])
+
+
+def test_ids_outside_expected_axis_extend_it():
+    assembler = MatrixAssembler(rid=["r1"], cid=["c1"])
+    assembler.add(_long({("c1", "r1"): 1.0}))
+    assembler.add(_long({("c0", "r0"): 2.0}))
+
+    data_df = assembler.to_dataframe()
+    assert list(data_df.index) == ["r0", "r1"]
+    assert list(data_df.columns) == ["c0", "c1"]
+    assert data_df.loc["r1", "c1"] == 1.0
+    assert data_df.loc["r0", "c0"] == 2.0
+
+
+def test_arrow_chunks():
+    values = _values(nrid=3, ncid=3)
+    pandas_assembler, arrow_assembler = MatrixAssembler(), MatrixAssembler()
+    pandas_assembler.add(_long(values))
+    arrow_assembler.add(pa.Table.from_pandas(_long(values), preserve_index=False))
+
+    pd.testing.assert_frame_equal(arrow_assembler.to_dataframe(), pandas_assembler.to_dataframe())
+
+
+def test_empty():
+    dense = MatrixAssembler().to_dense()
+    assert dense.shape == (0, 0)
+
+
+def test_dense_matrix_conversions():
+    data_df = pd.DataFrame(
+        [[1.0, 2.0], [3.0, 4.0]],
+        index=pd.Index(["r0", "r1"], name="rid"),
+        columns=pd.Index(["c0", "c1"], name="cid"),
+    )
+    dense = DenseMatrix.from_dataframe(data_df)
+
+    pd.testing.assert_frame_equal(dense.to_dataframe(), data_df)
+    pd.testing.assert_frame_equal(dense.to_gctoo().data_df, data_df)
+    table = dense.to_arrow()
+    assert table.column_names == ["rid", "c0", "c1"]
+    assert table.column("c1").to_pylist() == [2.0, 4.0]
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_dtype(dtype):
+    assembler = MatrixAssembler(dtype=dtype)
+    assembler.add(_long({("c0", "r0"): 1.0}))
+    assert assembler.to_dense().values.dtype == np.dtype(dtype)
@@ -0,0 +1,39 @@
+import pytest
+import yaml
+
+from cmapBQ.tools.batch import _job_path, read_manifest
+
+
+def _write_manifest(tmp_path, jobs):
+    path = tmp_path / "manifest.yaml"
+    path.write_text(yaml.safe_dump({"jobs": jobs}))
+    return str(path)
+
+
+def test_read_manifest(tmp_path):
+    path = _write_manifest(tmp_path, [
+        {"name": "a375_matrix.v2", "tool": "cmap_matrix", "args": {"cid": ["s1"]}},
+        {"tool": "cmap_compounds"},
+    ])
+    max_workers, jobs = read_manifest(path)
+    assert max_workers == 1
+    assert [job["name"] for job in jobs] == ["a375_matrix.v2", "cmap_compounds_1"]
+
+
+@pytest.mark.parametrize("name", ["../escape", "a/b", "..", "/tmp/abs", ".hidden", ""])
+def test_read_manifest_rejects_unsafe_job_names(tmp_path, name):
+    path = _write_manifest(tmp_path, [{"name": name, "tool": "cmap_matrix"}])
+    with pytest.raises(ValueError):
+        read_manifest(path)
+
+
+def test_read_manifest_rejects_unsafe_tool(tmp_path):
+    path = _write_manifest(tmp_path, [{"name": "job", "tool": "os.path"}])
+    with pytest.raises(ValueError):
+        read_manifest(path)
+
+
+def test_job_path_stays_in_output_folder(tmp_path):
+    assert _job_path(str(tmp_path), "job") == str((tmp_path / "job").resolve())
+    with pytest.raises(ValueError):
+        _job_path(str(tmp_path), "../job")
@@ -0,0 +1,170 @@
+import os
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from cmapBQ.cache import QueryCache, client_identity
+from cmapBQ.tests.fake_client import FakeClient, FakeCredentials, FakeTable
+
+TABLE = "project.dataset.siginfo"
+
+
+class Runner:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return pd.DataFrame({"sig_id": ["a", "b"], "call": [self.calls, self.calls]})
+
+
+def test_cached_result_is_reused():
+    client, run = FakeClient(), Runner()
+    query_cache = QueryCache()
+
+    first = query_cache.get_or_run(client, "SELECT *  FROM t", [TABLE], run)
+    second = query_cache.get_or_run(client, "SELECT * FROM t", [TABLE], run)
+
+    assert run.calls == 1
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_lru_eviction():
+    client, run = FakeClient(), Runner()
+    query_cache = QueryCache(maxsize=2)
+
+    for query in ["q1", "q2", "q1", "q3"]:
+        query_cache.get_or_run(client, query, [TABLE], run)
+    assert run.calls == 3
+
+    # q1 was used more recently than q2, so q2 was evicted
+    query_cache.get_or_run(client, "q1", [TABLE], run)
+    assert run.calls == 3
+    query_cache.get_or_run(client, "q2", [TABLE], run)
+    assert run.calls == 4
+
+
+def test_ttl_expiry():
+    client, run = FakeClient(), Runner()
+    query_cache = QueryCache(ttl=0.05)
+
+    query_cache.get_or_run(client, "q", [TABLE], run)
+    query_cache.get_or_run(client, "q", [TABLE], run)
+    assert run.calls == 1
+
+    time.sleep(0.1)
+    result = query_cache.get_or_run(client, "q", [TABLE], run)
+    assert run.calls == 2
+    assert list(result["call"]) == [2, 2]
+
+
+def test_table_update_invalidates_after_modified_ttl():
+    client, run = FakeClient(), Runner()
+    client.table_info[TABLE] = FakeTable(TABLE, modified=datetime(2021, 1, 1, tzinfo=timezone.utc))
+    query_cache = QueryCache(modified_ttl=0.05)
+
+    query_cache.get_or_run(client, "q", [TABLE], run)
+    client.table_info[TABLE] = FakeTable(TABLE, modified=datetime(2022, 1, 1, tzinfo=timezone.utc))
+
+    # Modified time is reused within modified_ttl, so the update is not seen yet
+    lookups = client.calls["get_table"]
+    query_cache.get_or_run(client, "q", [TABLE], run)
+    assert run.calls == 1
+    assert client.calls["get_table"] == lookups
+
+    time.sleep(0.1)
+    query_cache.get_or_run(client, "q", [TABLE], run)
+    assert run.calls == 2
+    assert client.calls["get_table"] == lookups + 1
+
+
+def test_disk_tier_round_trip(tmp_path):
+    client, run = FakeClient(), Runner()
+    cache_dir = str(tmp_path / "cache")
+
+    result = QueryCache(cache_dir=cache_dir).get_or_run(client, "q", [TABLE], run)
+    assert len([fn for fn in os.listdir(cache_dir) if fn.endswith(".arrow")]) == 1
+
+    # A new cache, e.g. in another process, reads the result from disk
+    restored = QueryCache(cache_dir=cache_dir).get_or_run(client, "q", [TABLE], run)
+    assert run.calls == 1
+    pd.testing.assert_frame_equal(result, restored)
+
+
+def test_expired_disk_entry_is_removed(tmp_path):
+    client, run = FakeClient(), Runner()
+    cache_dir = str(tmp_path / "cache")
+    QueryCache(cache_dir=cache_dir, ttl=60).get_or_run(client, "q", [TABLE], run)
+
+    path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    old = time.time() - 120
+    os.utime(path, (old, old))
+
+    QueryCache(cache_dir=cache_dir, ttl=60).get_or_run(client, "q", [TABLE], run)
+    assert run.calls == 2
+
+
+def test_clients_with_different_credentials_do_not_share_results():
+    run = Runner()
+    query_cache = QueryCache()
+    reader = FakeClient(credentials=FakeCredentials("reader@project.iam.gserviceaccount.com"))
+    other = FakeClient(credentials=FakeCredentials("other@project.iam.gserviceaccount.com"))
+    same = FakeClient(credentials=FakeCredentials("reader@project.iam.gserviceaccount.com"))
+
+    query_cache.get_or_run(reader, "q", [TABLE], run)
+    query_cache.get_or_run(other, "q", [TABLE], run)
+    assert run.calls == 2
+
+    query_cache.get_or_run(same, "q", [TABLE], run)
+    assert run.calls == 2
+
+
+def test_client_identity_includes_project():
+    credentials = FakeCredentials("reader@project.iam.gserviceaccount.com")
+    a = FakeClient(project="a", credentials=credentials)
+    b = FakeClient(project="b", credentials=credentials)
+    assert client_identity(a) != client_identity(b)
+
+
+class LargeRunner(Runner):
+    def __call__(self):
+        self.calls += 1
+        return pd.DataFrame({"sig_id": ["s{}".format(i) for i in range(1000)], "call": self.calls})
+
+
+def test_result_is_not_copied():
+    client, run = FakeClient(), Runner()
+    query_cache = QueryCache()
+
+    first = query_cache.get_or_run(client, "q", [TABLE], run)
+    assert query_cache.get_or_run(client, "q", [TABLE], run) is first
+
+
+def test_results_over_max_result_bytes_are_not_cached(tmp_path):
+    client, run = FakeClient(), LargeRunner()
+    cache_dir = str(tmp_path / "cache")
+    query_cache = QueryCache(cache_dir=cache_dir, max_result_bytes=10000)
+
+    query_cache.get_or_run(client, "q", [TABLE], run)
+    query_cache.get_or_run(client, "q", [TABLE], run)
+    assert run.calls == 2
+    assert os.listdir(cache_dir) == []
+
+    query_cache.get_or_run(client, "small", [TABLE], Runner())
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_max_bytes_evicts_least_recently_used():
+    client, run = FakeClient(), LargeRunner()
+    nbytes = int(run().memory_usage(index=True, deep=True).sum())
+    query_cache = QueryCache(max_bytes=int(2.5 * nbytes))
+
+    for query in ["q1", "q2", "q1", "q3"]:
+        query_cache.get_or_run(client, query, [TABLE], run)
+    assert run.calls == 4
+
+    query_cache.get_or_run(client, "q1", [TABLE], run)
+    assert run.calls == 4
+    query_cache.get_or_run(client, "q2", [TABLE], run)
+    assert run.calls == 5
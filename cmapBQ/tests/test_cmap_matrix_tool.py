@@ -0,0 +1,25 @@
+import pytest
+
+from cmapBQ.tools import cmap_matrix as tool
+from cmapBQ.tests.fake_client import FakeClient
+
+CID = "sig0,sig1,sig2,sig3,sig4"
+
+
+def _run(tmp_path, file_format, *argv):
+    out_path = tmp_path / "run{}".format(len(list(tmp_path.iterdir())))
+    out_path.mkdir()
+    args = tool.parse_args(["--cid", CID, "--chunk_size", "2", "--format", file_format] + list(argv)
+                           + ["--out", str(out_path), "--create_subdir", "false"])
+    return tool.run(FakeClient(), args, str(out_path))
+
+
+@pytest.mark.parametrize("file_format, sharded", [("gctx", "false"), ("parquet", "false"), ("parquet", "true")])
+def test_limit_applies_to_every_format(tmp_path, file_format, sharded):
+    with pytest.raises(AssertionError):
+        _run(tmp_path, file_format, "--sharded", sharded, "--limit", "4")
+
+    output = _run(tmp_path, file_format, "--sharded", sharded, "--limit", "5")
+    assert "_n5x" in output
+    output = _run(tmp_path, file_format, "--sharded", sharded, "--limit", "0")
+    assert "_n5x" in output
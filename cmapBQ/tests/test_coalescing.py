@@ -0,0 +1,150 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+import cmapBQ.coalescing as coalescing
+from cmapBQ.query import cmap_matrix, cmap_sig
+from cmapBQ.tests.fake_client import FakeClient
+
+REQUESTS = [["sig1", "sig2"], ["sig3"], ["sig2", "sig5", "sig7"]]
+SIG_FIELDS = ["sig_id", "pert_id", "cell_iname"]
+
+
+def _matrix_queries(client):
+    return [query for query in client.queries if "L1000_Level5" in query]
+
+
+def _sig_queries(client):
+    return [query for query in client.queries if "siginfo" in query and "INFORMATION_SCHEMA" not in query]
+
+
+def _concurrent(fn, requests):
+    """Call fn for each request from its own thread, starting them together"""
+    barrier = threading.Barrier(len(requests))
+
+    def call(ids):
+        barrier.wait()
+        return fn(ids)
+
+    with ThreadPoolExecutor(len(requests)) as pool:
+        futures = [pool.submit(call, ids) for ids in requests]
+        return [future.result() for future in futures]
+
+
+def _matrix(client, ids, output="gctoo"):
+    return cmap_matrix(client, cid=ids, use_replica=False, output=output)
+
+
+@pytest.mark.parametrize("output", ["gctoo", "numpy", "arrow"])
+def test_concurrent_matrix_requests_share_one_query(output):
+    coalescer = coalescing.configure_coalescing(window=0.2)
+    client = FakeClient()
+
+    results = _concurrent(lambda ids: _matrix(client, ids, output=output), REQUESTS)
+
+    assert len(_matrix_queries(client)) == 1
+    assert (coalescer.requests, coalescer.batches) == (3, 1)
+
+    coalescing.configure_coalescing(enabled=False)
+    for ids, result in zip(REQUESTS, results):
+        expected = _matrix(client, ids, output=output)
+        if output == "gctoo":
+            pd.testing.assert_frame_equal(result.data_df, expected.data_df)
+        elif output == "numpy":
+            assert list(result.cids) == list(expected.cids) == sorted(ids)
+            assert list(result.rids) == list(expected.rids)
+            assert (result.values == expected.values).all()
+        else:
+            assert result.equals(expected)
+            assert result.column_names == ["rid"] + sorted(ids)
+
+
+def test_concurrent_sig_requests_share_one_query():
+    coalescer = coalescing.configure_coalescing(window=0.2)
+    client = FakeClient()
+
+    results = _concurrent(lambda ids: cmap_sig(client, sig_id=ids, return_fields=SIG_FIELDS), REQUESTS)
+
+    assert len(_sig_queries(client)) == 1
+    assert coalescer.batches == 1
+    for ids, result in zip(REQUESTS, results):
+        assert sorted(result["sig_id"]) == sorted(ids)
+
+
+def test_sig_requests_with_different_filters_are_not_merged():
+    coalescing.configure_coalescing(window=0.2)
+    client = FakeClient()
+
+    results = _concurrent(
+        lambda args: cmap_sig(client, sig_id=["sig1", "sig2", "sig6"], cell_iname=args, return_fields=SIG_FIELDS),
+        [["cell1"], ["cell0"]],
+    )
+
+    assert len(_sig_queries(client)) == 2
+    assert list(results[0]["sig_id"]) == ["sig1"]
+    assert list(results[1]["sig_id"]) == ["sig6"]
+
+
+def test_max_ids_splits_batches():
+    coalescer = coalescing.configure_coalescing(window=0.2, max_ids=4)
+    client = FakeClient()
+    requests = [["sig1", "sig2", "sig3"], ["sig4", "sig5"], ["sig6", "sig7", "sig8"]]
+
+    results = _concurrent(lambda ids: _matrix(client, ids), requests)
+
+    assert coalescer.batches == len(_matrix_queries(client)) == 3
+    for ids, result in zip(requests, results):
+        assert list(result.data_df.columns) == ids
+
+
+def test_max_ids_fills_batch():
+    coalescer = coalescing.configure_coalescing(window=0.2, max_ids=4)
+    client = FakeClient()
+
+    _concurrent(lambda ids: _matrix(client, ids), [["sig1", "sig2"], ["sig2", "sig3", "sig4"]])
+
+    assert coalescer.batches == len(_matrix_queries(client)) == 1
+
+
+def test_request_covered_by_running_batch_waits_for_it():
+    coalescer = coalescing.configure_coalescing(window=0.05)
+    client = FakeClient()
+    client.delay = 0.3
+
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(_matrix, client, ["sig1", "sig2"])
+        while coalescer.batches == 0:
+            time.sleep(0.01)
+        second = pool.submit(_matrix, client, ["sig2"])
+        first, second = first.result(), second.result()
+
+    assert len(_matrix_queries(client)) == 1
+    assert list(second.data_df.columns) == ["sig2"]
+    pd.testing.assert_series_equal(second.data_df["sig2"], first.data_df["sig2"])
+
+
+def test_failed_query_raises_in_every_caller():
+    coalescer = coalescing.configure_coalescing(window=0.2)
+    client = FakeClient()
+
+    def handler(query):
+        if "L1000_Level5" in query:
+            raise RuntimeError("query failed")
+        return client.run(query)
+    client.handler = handler
+
+    def call(ids):
+        try:
+            _matrix(client, ids)
+        except RuntimeError as e:
+            return e
+        return None
+
+    errors = _concurrent(call, REQUESTS)
+
+    assert coalescer.batches == 1
+    assert all(isinstance(error, RuntimeError) for error in errors)
+    assert len(_matrix_queries(client)) == 1
@@ -0,0 +1,13 @@
+import sys
+import subprocess
+
+import pytest
+
+HEAVY_MODULES = ["google.cloud.bigquery", "pandas", "numpy", "pyarrow", "cmapPy"]
+
+
+@pytest.mark.parametrize("module", ["cmapBQ.query", "cmapBQ.cli", "cmapBQ.tools.cmap_matrix"])
+def test_import_does_not_load_heavy_dependencies(module):
+    snippet = "import sys, {}; print(','.join(m for m in {!r} if m in sys.modules))".format(module, HEAVY_MODULES)
+    out = subprocess.run([sys.executable, "-c", snippet], stdout=subprocess.PIPE, check=True).stdout
+    assert out.decode().strip() == ""
@@ -0,0 +1,126 @@
+import pytest
+
+import cmapBQ.config as cfg
+from cmapBQ.query import cmap_matrix, read_large_query
+from cmapBQ.tests.fake_client import FakeClient
+
+QUERY = "SELECT sig_id, pert_id FROM `cmap-big-table.cmap_lincs_public_views.siginfo` WHERE sig_id in UNNEST(['sig1', 'sig2'])"
+
+
+def test_requires_materialization_dataset():
+    with pytest.raises(ValueError):
+        read_large_query(FakeClient(), QUERY)
+
+
+def test_table_is_created_with_expiration_and_deleted():
+    cfg.set_materialization("scratch-project.results", expiration_hours=6)
+    client = FakeClient()
+
+    result = read_large_query(client, QUERY)
+
+    assert sorted(result["sig_id"]) == ["sig1", "sig2"]
+    submitted = client.queries[0]
+    assert submitted.startswith("CREATE TABLE `scratch-project.results.query_")
+    assert "INTERVAL 6 HOUR" in submitted
+    assert submitted.endswith("AS " + QUERY)
+    assert client.deleted == [submitted.split("`")[1]]
+
+
+def test_keep_table():
+    cfg.set_materialization("scratch-project.results")
+    client = FakeClient()
+
+    result = read_large_query(client, QUERY, output="arrow", keep_table=True)
+
+    assert result.num_rows == 2
+    assert client.deleted == []
+    (table_id,) = client.created
+    assert client.table_info[table_id].expires is not None
+
+
+def test_table_is_deleted_if_read_fails(monkeypatch):
+    cfg.set_materialization("scratch-project.results")
+    client = FakeClient()
+
+    def fail(table, **kwargs):
+        raise RuntimeError("read failed")
+    monkeypatch.setattr(client, "list_rows", fail)
+
+    with pytest.raises(RuntimeError):
+        read_large_query(client, QUERY)
+    assert len(client.deleted) == 1
+
+
+def test_cmap_matrix_large_result():
+    cfg.set_materialization("scratch-project.results")
+    client = FakeClient()
+    cid = ["sig{}".format(i) for i in range(7)]
+
+    large = cmap_matrix(client, cid=cid, chunk_size=3, large_result=True, use_replica=False).data_df
+    direct = cmap_matrix(client, cid=cid, chunk_size=3, use_replica=False).data_df
+
+    assert large.equals(direct)
+    assert len(client.deleted) == 3
+
+
+def test_reattach_names_table_after_job_id():
+    cfg.set_materialization("scratch-project.results")
+    client = FakeClient()
+
+    read_large_query(client, QUERY, reattach=True)
+
+    (job_id,) = client.submitted
+    assert job_id.startswith("cmapBQ_table_")
+    assert client.deleted == ["scratch-project.results.query_{}".format(job_id)]
+
+
+def test_reattach_reads_table_left_by_earlier_run():
+    cfg.set_materialization("scratch-project.results")
+    client = FakeClient()
+    first = read_large_query(client, QUERY, reattach=True, keep_table=True)
+
+    rerun = read_large_query(client, QUERY, reattach=True)
+
+    assert len(client.submitted) == 1
+    assert rerun.equals(first)
+    assert len(client.deleted) == 1
+
+
+def test_reattach_waits_for_running_job():
+    cfg.set_materialization("scratch-project.results")
+    client = FakeClient()
+    read_large_query(client, QUERY, reattach=True, keep_table=True)
+    (job_id,) = client.submitted
+    # Still running, its table is not created yet
+    client.jobs[job_id].state = "RUNNING"
+    del client.table_info["scratch-project.results.query_{}".format(job_id)]
+
+    result = read_large_query(client, QUERY, reattach=True)
+
+    assert client.submitted == [job_id]
+    assert sorted(result["sig_id"]) == ["sig1", "sig2"]
+
+
+def test_reattach_resubmits_after_table_is_deleted():
+    cfg.set_materialization("scratch-project.results")
+    client = FakeClient()
+    read_large_query(client, QUERY, reattach=True)
+    (job_id,) = client.submitted
+
+    result = read_large_query(client, QUERY, reattach=True)
+
+    assert client.submitted == [job_id, job_id + "_1"]
+    assert sorted(result["sig_id"]) == ["sig1", "sig2"]
+
+
+def test_large_result_and_direct_jobs_do_not_share_ids():
+    cfg.set_materialization("scratch-project.results")
+    client = FakeClient()
+    cid = ["sig1", "sig2"]
+
+    cmap_matrix(client, cid=cid, large_result=True, use_replica=False)
+    cmap_matrix(client, cid=cid, use_replica=False)
+
+    matrix_jobs = [job_id for job_id, query in zip(client.submitted, client.queries) if "L1000_Level5" in query]
+    assert len(matrix_jobs) == 2
+    assert not any(job_id.endswith("_1") for job_id in matrix_jobs)
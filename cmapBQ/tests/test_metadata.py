@@ -0,0 +1,96 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from cmapBQ.query import cmap_cell, cmap_compounds, cmap_genes, cmap_sig
+from cmapBQ.tests.fake_client import FakeClient, make_tables
+
+
+def _client():
+    tables = make_tables()
+    tables["cellinfo"] = pd.DataFrame({
+        "cell_iname": ["A375", "MCF7", "PC3"],
+        "cell_type": ["tumor", "tumor", "tumor"],
+        "primary_disease": ["skin cancer", "breast cancer", "prostate cancer"],
+        "donor_age": [54, 69, 62],
+    })
+    tables["compoundinfo"] = pd.DataFrame({
+        "pert_id": ["BRD-0", "BRD-1", "BRD-1"],
+        "cmap_name": ["cpd0", "cpd1", "cpd1"],
+        "target": ["EGFR", "MTOR", "PIK3CA"],
+        "moa": ["EGFR inhibitor", "MTOR inhibitor", "MTOR inhibitor"],
+    })
+    return FakeClient(tables=tables)
+
+
+def _data_queries(client):
+    return [q for q in client.queries if "INFORMATION_SCHEMA" not in q]
+
+
+QUERIES = [
+    (cmap_sig, {"sig_id": ["sig1"]}, ["sig_id", "cell_iname"]),
+    (cmap_genes, {"gene_id": ["1"]}, ["gene_symbol", "gene_id"]),
+    (cmap_cell, {"cell_iname": ["A375"]}, ["primary_disease"]),
+    (cmap_compounds, {"pert_id": ["BRD-1"]}, ["target", "pert_id"]),
+]
+
+
+@pytest.mark.parametrize("fn, kwargs, fields", QUERIES)
+def test_unknown_return_fields_fail_before_querying(fn, kwargs, fields, capsys):
+    client = _client()
+    with pytest.raises(ValueError):
+        fn(client, return_fields=fields + ["not_a_field"], **kwargs)
+
+    assert _data_queries(client) == []
+    assert "not_a_field" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("fn, kwargs, fields", QUERIES)
+def test_invalid_field_names_are_rejected_without_queries(fn, kwargs, fields):
+    client = _client()
+    with pytest.raises(ValueError):
+        fn(client, return_fields=["pert_id FROM x; --"], **kwargs)
+    assert client.queries == []
+
+
+@pytest.mark.parametrize("fn, kwargs, fields", QUERIES)
+def test_known_return_fields_are_selected(fn, kwargs, fields):
+    result = fn(_client(), return_fields=fields, **kwargs)
+    assert list(result.columns) == fields
+    assert len(result) >= 1
+
+
+def test_categorical_fields_pandas():
+    client = _client()
+    fields = ["sig_id", "pert_id", "pert_type", "cell_iname"]
+
+    result = cmap_sig(client, sig_id=["sig1", "sig2", "sig4"], return_fields=fields)
+    plain = cmap_sig(client, sig_id=["sig1", "sig2", "sig4"], return_fields=fields, categorical=False)
+
+    assert isinstance(result["cell_iname"].dtype, pd.CategoricalDtype)
+    assert isinstance(result["pert_type"].dtype, pd.CategoricalDtype)
+    assert result["sig_id"].dtype == object and result["pert_id"].dtype == object
+    assert (plain.dtypes == object).all()
+    pd.testing.assert_frame_equal(result.astype(object), plain)
+
+
+def test_categorical_fields_arrow():
+    client = _client()
+
+    result = cmap_cell(client, return_fields=["cell_iname", "cell_type", "donor_age"], output="arrow")
+    plain = cmap_cell(client, return_fields=["cell_iname", "cell_type", "donor_age"], output="arrow",
+                      categorical=False)
+
+    assert pa.types.is_dictionary(result.schema.field("cell_iname").type)
+    assert pa.types.is_dictionary(result.schema.field("cell_type").type)
+    assert pa.types.is_integer(result.schema.field("donor_age").type)
+    assert not pa.types.is_dictionary(plain.schema.field("cell_iname").type)
+    assert result.column("cell_iname").to_pylist() == plain.column("cell_iname").to_pylist()
+
+
+def test_categorical_skips_non_string_fields():
+    client = _client()
+    result = cmap_genes(client, return_fields=["gene_id", "feature_space"])
+
+    assert isinstance(result["feature_space"].dtype, pd.CategoricalDtype)
+    assert pd.api.types.is_integer_dtype(result["gene_id"])
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cmapBQ.query import cmap_aggregate, cmap_replicates
+from cmapBQ.tests.fake_client import FakeClient
+
+
+def _aggregate_result(query):
+    rows = []
+    for pert_id, cell_iname, nsample in [("BRD-B", "A375", 3), ("BRD-A", "MCF7", 2), ("BRD-A", "A375", 4)]:
+        for gene in ["20", "3", "100"]:
+            rows.append((pert_id, cell_iname, gene, float(len(rows)), nsample))
+    return pd.DataFrame(rows, columns=["pert_id", "cell_iname", "rid", "value", "nsample"]).iloc[::-1]
+
+
+def _replicates_result(query):
+    matrix = [
+        ("rep{}".format(c), str(gene), float(10 * c + gene), None) for c in range(4) for gene in [5, 1, 12]
+    ]
+    # rep9 has no matrix rows and is left out of the mapping
+    mapping = [("rep0", "sig0"), ("rep1", "sig0"), ("rep2", "sig1"), ("rep3", "sig1"), ("rep9", "sig1")]
+    rows = matrix + [(cid, None, None, sig) for cid, sig in mapping]
+    return pd.DataFrame(rows, columns=["cid", "rid", "value", "sig_id"])
+
+
+def _client(handler):
+    client = FakeClient()
+    client.handler = handler
+    return client
+
+
+def _last_result(client):
+    return list(client.jobs.values())[-1].results[-1]
+
+
+def _dataframes(client, run):
+    """Run with each output type and return the data as DataFrames, checking how results were read"""
+    gctoo = run(client, "gctoo")
+
+    dense = run(client, "numpy")
+    result = _last_result(client)
+    assert (result.to_dataframe_calls, result.to_arrow_calls) == (0, 1)
+
+    table = run(client, "arrow")
+    result = _last_result(client)
+    assert (result.to_dataframe_calls, result.to_arrow_calls) == (0, 1)
+
+    arrow_df = table.to_pandas().set_index("rid")
+    return gctoo.data_df, dense.to_dataframe(), arrow_df
+
+
+def _assert_same_values(expected, dense_df, arrow_df):
+    assert list(dense_df.index) == list(expected.index) == list(arrow_df.index)
+    assert list(dense_df.columns) == list(expected.columns) == list(arrow_df.columns)
+    np.testing.assert_array_equal(dense_df.values, expected.values)
+    np.testing.assert_array_equal(arrow_df.values, expected.values)
+
+
+def test_aggregate_outputs_match():
+    client = _client(_aggregate_result)
+
+    def run(client, output):
+        return cmap_aggregate(
+            client, group_by=("pert_id", "cell_iname"), conditions={"pert_id": ["BRD-A", "BRD-B"]}, output=output
+        )
+
+    expected, dense_df, arrow_df = _dataframes(client, run)
+
+    assert list(expected.columns) == ["BRD-A:A375", "BRD-A:MCF7", "BRD-B:A375"]
+    _assert_same_values(expected, dense_df, arrow_df)
+
+
+def test_aggregate_gctoo_keeps_group_metadata():
+    gctoo = cmap_aggregate(
+        _client(_aggregate_result), group_by=("pert_id", "cell_iname"), conditions={"pert_id": ["BRD-A"]}
+    )
+    assert gctoo.col_metadata_df.loc["BRD-A:MCF7", "nsample"] == 2
+    assert gctoo.col_metadata_df.loc["BRD-B:A375", "cell_iname"] == "A375"
+
+
+def test_replicates_outputs_match():
+    client = _client(_replicates_result)
+    maps = []
+
+    def run(client, output):
+        matrix, replicate_map = cmap_replicates(client, sig_id=["sig0", "sig1"], output=output)
+        maps.append(replicate_map)
+        return matrix
+
+    expected, dense_df, arrow_df = _dataframes(client, run)
+
+    long_df = _replicates_result(None).dropna(subset=["rid"])
+    pivot = long_df.pivot(index="rid", columns="cid", values="value")
+    assert list(expected.columns) == ["rep0", "rep1", "rep2", "rep3"]
+    _assert_same_values(pivot, expected, arrow_df)
+    _assert_same_values(pivot, dense_df, arrow_df)
+    assert maps[0] == maps[1] == maps[2] == {"sig0": ["rep0", "rep1"], "sig1": ["rep2", "rep3"]}
+
+
+@pytest.mark.parametrize("output", ["pandas", "dense"])
+def test_unknown_output_is_rejected_before_querying(output):
+    client = _client(_aggregate_result)
+    with pytest.raises(ValueError):
+        cmap_aggregate(client, conditions={"pert_id": ["BRD-A"]}, output=output)
+    with pytest.raises(ValueError):
+        cmap_replicates(client, sig_id=["sig0"], output=output)
+    assert client.queries == []
@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from cmapBQ.utils.pipeline import run_pipeline
+
+
+def test_outputs_in_input_order():
+    def slow_first(i):
+        time.sleep(0.02 if i == 0 else 0)
+        return i * 2
+
+    assert list(run_pipeline(range(5), [slow_first, lambda i: i + 1])) == [1, 3, 5, 7, 9]
+
+
+@pytest.mark.parametrize("queue_size", [0, 1, 3])
+def test_queue_size(queue_size):
+    assert list(run_pipeline(range(4), [str, len], queue_size=queue_size)) == [1, 1, 1, 1]
+
+
+def test_queue_bounds_items_in_flight():
+    produced = []
+    consumed = []
+
+    def produce(i):
+        produced.append(i)
+        return i
+
+    for item in run_pipeline(range(20), [produce], queue_size=2):
+        time.sleep(0.01)
+        consumed.append(item)
+        # Queue of 2, one item held by the stage waiting to put and the one just consumed
+        assert len(produced) - len(consumed) <= 3
+
+    assert consumed == list(range(20))
+
+
+def test_stages_overlap():
+    def slow(i):
+        time.sleep(0.05)
+        return i
+
+    start = time.perf_counter()
+    list(run_pipeline(range(6), [slow, slow], queue_size=2))
+    elapsed = time.perf_counter() - start
+    # Two stages in series would take 0.6s
+    assert elapsed < 0.5
+
+
+def test_stage_exception_is_raised_to_consumer():
+    def fail_on_three(i):
+        if i == 3:
+            raise KeyError("chunk 3")
+        return i
+
+    received = []
+    with pytest.raises(KeyError, match="chunk 3"):
+        for item in run_pipeline(range(10), [fail_on_three, lambda i: i]):
+            received.append(item)
+    assert received == [0, 1, 2]
+
+
+def test_consumer_exit_stops_stages():
+    produced = []
+
+    def produce(i):
+        produced.append(i)
+        return i
+
+    items = run_pipeline(range(1000), [produce], queue_size=1)
+    assert next(items) == 0
+    items.close()
+
+    time.sleep(0.3)
+    count = len(produced)
+    time.sleep(0.2)
+    assert len(produced) == count < 10
@@ -0,0 +1,79 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+import cmapBQ.config as cfg
+import cmapBQ.query as query
+from cmapBQ.query import cmap_matrix, get_feature_space_genes
+from cmapBQ.tests.fake_client import FakeClient, FakeTable
+
+CIDS = ["sig3", "sig1", "sig7"]
+
+
+@pytest.mark.parametrize("cid", [CIDS, ["sig2"]])
+def test_top_k_matches_dense_result(cid):
+    client = FakeClient()
+    k = 2
+
+    sparse = cmap_matrix(client, cid=cid, top_k=k, use_replica=False)
+    dense = cmap_matrix(client, cid=cid, use_replica=False).data_df
+
+    genes = get_feature_space_genes(client, "landmark")
+    assert sparse.shape == (len(cid), len(genes))
+    assert list(sparse.rids) == genes == list(dense.index)
+    assert list(sparse.cids) == sorted(cid)
+
+    for c in cid:
+        column = dense[c]
+        expected = sorted(set(column.nlargest(k).index) | set(column.nsmallest(k).index))
+        top = sparse.row(c).sort_index()
+        assert list(top.index) == expected
+        np.testing.assert_allclose(top.values, column[expected].values, rtol=1e-6)
+
+
+def test_top_k_uses_requested_rids():
+    client = FakeClient()
+    sparse = cmap_matrix(client, cid=CIDS, rid=["5", "10", "2"], top_k=1, use_replica=False)
+
+    assert list(sparse.rids) == ["10", "2", "5"]
+    assert sparse.shape == (3, 3)
+
+
+def _gene_queries(client):
+    return [q for q in client.queries if "geneinfo" in q]
+
+
+def _set_geneinfo_modified(client, year):
+    table = cfg.get_default_config().tables.geneinfo.replace("`", "")
+    client.table_info[table] = FakeTable(table, modified=datetime(year, 1, 1, tzinfo=timezone.utc))
+
+
+def test_feature_space_genes_are_memoized():
+    client = FakeClient()
+    _set_geneinfo_modified(client, 2021)
+
+    assert get_feature_space_genes(client, "landmark") == ["1", "2", "3", "4", "5", "6"]
+    get_feature_space_genes(client, "landmark")
+    assert len(_gene_queries(client)) == 1
+
+
+def test_geneinfo_update_refreshes_feature_space_genes(monkeypatch):
+    client = FakeClient()
+    _set_geneinfo_modified(client, 2021)
+    get_feature_space_genes(client, "landmark")
+
+    genes = client.tables["geneinfo"]
+    client.tables["geneinfo"] = genes.assign(feature_space=["landmark"] * 7 + ["inferred"] * (len(genes) - 7))
+    _set_geneinfo_modified(client, 2022)
+
+    # The modified time is not checked again within the TTL
+    assert len(get_feature_space_genes(client, "landmark")) == 6
+
+    monkeypatch.setattr(query, "_FEATURE_SPACE_MODIFIED_TTL", 0)
+    assert get_feature_space_genes(client, "landmark") == ["1", "2", "3", "4", "5", "6", "7"]
+    assert len(_gene_queries(client)) == 2
+
+    # An unchanged modified time keeps the memoized list
+    get_feature_space_genes(client, "landmark")
+    assert len(_gene_queries(client)) == 2
@@ -0,0 +1,141 @@
+import pytest
+from google.api_core.exceptions import Forbidden
+
+from cmapBQ.query import (
+    _JOB_ID_WINDOW, _MAX_JOB_ATTEMPTS, _PREVIOUS_WINDOW_PROBE, _reattach_job_ids, query_job_id, run_query
+)
+from cmapBQ.tests.fake_client import FakeClient, FakeCredentials
+
+QUERY = "SELECT cid, rid, value FROM `project.dataset.L1000_Level5_cid` WHERE cid in UNNEST(['sig1'])"
+
+
+def test_job_id_is_stable_within_window():
+    start = 100 * _JOB_ID_WINDOW
+    assert query_job_id(QUERY, timestamp=start) == query_job_id(QUERY + "  ", timestamp=start + _JOB_ID_WINDOW - 1)
+    assert query_job_id(QUERY, timestamp=start) != query_job_id(QUERY, timestamp=start + _JOB_ID_WINDOW)
+    assert query_job_id(QUERY, timestamp=start) != query_job_id(QUERY + " LIMIT 1", timestamp=start)
+
+
+def test_first_submission_does_not_look_up_jobs():
+    client = FakeClient()
+    job = run_query(client, QUERY, job_id="job")
+
+    assert job.job_id == "job"
+    assert client.calls == {"query": 1, "get_job": 0, "get_table": 0}
+
+
+def test_done_job_is_reused():
+    client = FakeClient()
+    first = run_query(client, QUERY, job_id="job")
+    second = run_query(client, QUERY, job_id="job")
+
+    assert second is first
+    assert client.submitted == ["job"]
+    assert client.calls["get_job"] == 1
+
+
+def test_running_job_is_reused():
+    client = FakeClient()
+    first = run_query(client, QUERY, job_id="job")
+    first.state = "RUNNING"
+    client.table_info.clear()
+
+    assert run_query(client, QUERY, job_id="job") is first
+    assert client.calls["get_table"] == 0
+
+
+def test_expired_destination_table_resubmits():
+    client = FakeClient()
+    first = run_query(client, QUERY, job_id="job")
+    del client.table_info[first.destination]
+
+    second = run_query(client, QUERY, job_id="job")
+    assert second is not first
+    assert client.submitted == ["job", "job_1"]
+
+    # The replacement is found on the next rerun
+    assert run_query(client, QUERY, job_id="job") is second
+
+
+def test_failed_job_resubmits():
+    client = FakeClient()
+    run_query(client, QUERY, job_id="job").error_result = {"reason": "backendError"}
+
+    run_query(client, QUERY, job_id="job")
+    assert client.submitted == ["job", "job_1"]
+
+
+def test_attempts_exhausted_submits_without_job_id(capsys):
+    client = FakeClient()
+    for attempt in range(_MAX_JOB_ATTEMPTS):
+        attempt_id = "job" if attempt == 0 else "job_{}".format(attempt)
+        run_query(client, QUERY, job_id=attempt_id).error_result = {"reason": "backendError"}
+
+    job = run_query(client, QUERY, job_id="job")
+
+    assert job.job_id not in client.submitted[:_MAX_JOB_ATTEMPTS]
+    assert client.submitted[-1] is None
+    assert "submitting without reattach" in capsys.readouterr().out
+
+
+def test_job_id_includes_client_principal():
+    start = 100 * _JOB_ID_WINDOW
+    alice = FakeClient(credentials=FakeCredentials("alice@test-project.iam.gserviceaccount.com"))
+    alice_again = FakeClient(credentials=FakeCredentials("alice@test-project.iam.gserviceaccount.com"))
+    bob = FakeClient(credentials=FakeCredentials("bob@test-project.iam.gserviceaccount.com"))
+
+    assert query_job_id(QUERY, alice, timestamp=start) == query_job_id(QUERY, alice_again, timestamp=start)
+    assert query_job_id(QUERY, alice, timestamp=start) != query_job_id(QUERY, bob, timestamp=start)
+    assert query_job_id(QUERY, alice, timestamp=start) != query_job_id(QUERY, timestamp=start)
+
+
+def test_previous_window_is_probed_after_midnight():
+    start = 100 * _JOB_ID_WINDOW
+    client = FakeClient()
+
+    late_id, late_previous = _reattach_job_ids(client, QUERY, timestamp=start - 60)
+    assert late_previous is None
+    job = run_query(client, QUERY, job_id=late_id)
+
+    job_id, previous_job_id = _reattach_job_ids(client, QUERY, timestamp=start + 60)
+    assert previous_job_id == late_id != job_id
+    assert run_query(client, QUERY, job_id=job_id, previous_job_id=previous_job_id) is job
+    assert client.submitted == [late_id]
+
+    assert _reattach_job_ids(client, QUERY, timestamp=start + _PREVIOUS_WINDOW_PROBE)[1] is None
+
+
+def test_unusable_previous_window_job_submits_current_id():
+    client = FakeClient()
+    run_query(client, QUERY, job_id="yesterday").error_result = {"reason": "backendError"}
+
+    job = run_query(client, QUERY, job_id="today", previous_job_id="yesterday")
+    assert job.job_id == "today"
+
+    fresh = FakeClient()
+    assert run_query(fresh, QUERY, job_id="today", previous_job_id="yesterday").job_id == "today"
+    assert fresh.calls["get_job"] == 1
+
+
+def _forbid(client, method):
+    def forbidden(*args, **kwargs):
+        raise Forbidden("Access Denied")
+    setattr(client, method, forbidden)
+
+
+@pytest.mark.parametrize("method", ["get_job", "get_table"])
+def test_forbidden_job_is_not_reused(method):
+    client = FakeClient()
+    first = run_query(client, QUERY, job_id="job")
+    _forbid(client, method)
+
+    second = run_query(client, QUERY, job_id="job")
+    assert second is not first
+    assert client.submitted == ["job", "job_1"]
+
+
+def test_forbidden_previous_window_job_is_skipped():
+    client = FakeClient()
+    _forbid(client, "get_job")
+
+    assert run_query(client, QUERY, job_id="today", previous_job_id="yesterday").job_id == "today"
@@ -0,0 +1,119 @@
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+import yaml
+
+import cmapBQ.config as cfg
+from cmapBQ.query import cmap_matrix
+from cmapBQ.replica import build_replica, open_replica
+from cmapBQ.tests.fake_client import FakeClient, FakeTable
+
+TABLE = "cmap-big-table.cmap_lincs_public_views.L1000_Level5_landmark"
+
+
+def _build(client, tmp_path, cid=None):
+    path = build_replica(client, str(tmp_path / "replica"), cid=cid)
+    cfg.register_replica(open_replica(path).table, path)
+    return path
+
+
+def _reference(client, cid):
+    return cmap_matrix(client, cid=cid, use_replica=False).data_df
+
+
+def _assert_matches_reference(data_df, expected):
+    """Same axes in the same order as the BigQuery result, and the same values up to float32 precision"""
+    assert list(data_df.index) == list(expected.index)
+    assert list(data_df.columns) == list(expected.columns)
+    np.testing.assert_allclose(data_df.values, expected.values, rtol=1e-6)
+
+
+def test_replica_round_trip(tmp_path):
+    client = FakeClient()
+    path = _build(client, tmp_path)
+    replica = open_replica(path)
+    assert not replica.partial
+    assert replica.complete
+
+    cid = ["sig3", "sig1"]
+    queries = len(client.queries)
+    data_df = cmap_matrix(client, cid=cid).data_df
+    assert len(client.queries) == queries
+
+    assert list(data_df.columns) == ["sig1", "sig3"]
+    _assert_matches_reference(data_df, _reference(client, cid))
+
+
+def test_partial_replica_queries_missing_cids(tmp_path):
+    client = FakeClient()
+    path = _build(client, tmp_path, cid=["sig0", "sig1", "sig2"])
+    assert open_replica(path).partial
+
+    cid = ["sig1", "sig5", "sig0", "sig7"]
+    client.queries.clear()
+    data_df = cmap_matrix(client, cid=cid).data_df
+
+    assert list(data_df.columns) == sorted(cid)
+    assert not data_df.isna().any().any()
+    # Only the cids missing from the replica were queried
+    matrix_queries = [q for q in client.queries if "L1000_Level5" in q]
+    assert len(matrix_queries) == 1
+    assert "'sig5'" in matrix_queries[0] and "'sig0'" not in matrix_queries[0]
+
+    _assert_matches_reference(data_df, _reference(client, cid))
+
+
+def test_partial_replica_is_not_used_without_cids(tmp_path):
+    client = FakeClient()
+    path = _build(client, tmp_path, cid=["sig0", "sig1"])
+    replica = open_replica(path)
+
+    client.queries.clear()
+    data_df = cmap_matrix(client, rid=replica.rids[:2]).data_df
+    assert data_df.shape[1] > 2
+    assert any("L1000_Level5" in q for q in client.queries)
+
+
+def test_stale_replica_is_skipped(tmp_path):
+    client = FakeClient()
+    path = _build(client, tmp_path)
+    assert open_replica(path).source_modified is not None
+
+    client.table_info[TABLE] = FakeTable(TABLE, modified=datetime(2030, 1, 1, tzinfo=timezone.utc))
+    client.queries.clear()
+    data_df = cmap_matrix(client, cid=["sig2"]).data_df
+
+    assert list(data_df.columns) == ["sig2"]
+    assert any("L1000_Level5" in q for q in client.queries)
+
+
+def test_replica_without_modified_time_is_used(tmp_path):
+    client = FakeClient()
+    path = _build(client, tmp_path)
+    info_path = os.path.join(path, "replica.yaml")
+    with open(info_path) as fh:
+        info = yaml.safe_load(fh)
+    del info["source_modified"]
+    with open(info_path, "w") as fh:
+        yaml.dump(info, fh)
+
+    client.table_info[TABLE] = FakeTable(TABLE, modified=datetime(2030, 1, 1, tzinfo=timezone.utc))
+    client.queries.clear()
+    data_df = cmap_matrix(client, cid=["sig2", "missing"]).data_df
+
+    # Used, but cannot vouch for cids it does not hold
+    assert list(data_df.columns) == ["sig2"]
+    matrix_queries = [q for q in client.queries if "L1000_Level5" in q]
+    assert len(matrix_queries) == 1 and "'missing'" in matrix_queries[0]
+
+
+def test_replica_rows_follow_requested_rids_sorted(tmp_path):
+    client = FakeClient()
+    _build(client, tmp_path)
+
+    data_df = cmap_matrix(client, cid=["sig4", "sig2"], rid=["5", "1", "3"]).data_df
+    assert list(data_df.index) == ["1", "3", "5"]
+    _assert_matches_reference(
+        data_df, cmap_matrix(client, cid=["sig4", "sig2"], rid=["5", "1", "3"], use_replica=False).data_df
+    )
@@ -0,0 +1,72 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from cmapPy.pandasGEXpress.GCToo import GCToo
+
+from cmapBQ.utils.shards import ShardedMatrixWriter, open_sharded_matrix
+
+
+def _chunks(nrow=5, ncol=10, size=3):
+    rng = np.random.default_rng(0)
+    rids = ["g{}".format(i) for i in range(nrow)]
+    data_df = pd.DataFrame(
+        rng.normal(size=(nrow, ncol)).astype(np.float32),
+        index=pd.Index(rids, name="rid"),
+        columns=pd.Index(["sig{}".format(i) for i in range(ncol)], name="cid"),
+    )
+    return data_df, [GCToo(data_df.iloc[:, i:i + size]) for i in range(0, ncol, size)]
+
+
+@pytest.mark.parametrize("file_format", ["parquet", "gctx"])
+def test_round_trip(tmp_path, file_format):
+    data_df, chunks = _chunks()
+    path = str(tmp_path / "sharded")
+    with ShardedMatrixWriter(path, file_format=file_format, max_workers=2) as writer:
+        for gctoo in chunks:
+            writer.write(gctoo)
+
+    matrix = open_sharded_matrix(path)
+    assert matrix.shape == data_df.shape
+    assert matrix.cids == list(data_df.columns)
+    assert matrix.verify() == []
+
+    cid = ["sig7", "sig1", "missing"]
+    result = matrix.get(cid=cid, rid=["g3", "g0"]).data_df
+    assert list(result.columns) == ["sig7", "sig1"]
+    np.testing.assert_allclose(result.values, data_df.loc[["g3", "g0"], ["sig7", "sig1"]].values, rtol=1e-6)
+    np.testing.assert_allclose(matrix.get().data_df.values, data_df.values, rtol=1e-6)
+
+
+def test_manifest_holds_no_cid_lists(tmp_path):
+    _, chunks = _chunks()
+    path = str(tmp_path / "sharded")
+    with ShardedMatrixWriter(path) as writer:
+        for gctoo in chunks:
+            writer.write(gctoo)
+
+    with open(os.path.join(path, "manifest.json")) as fh:
+        manifest = json.load(fh)
+    assert [shard["ncid"] for shard in manifest["shards"]] == [3, 3, 3, 1]
+    assert all("cid" not in shard for shard in manifest["shards"])
+
+
+def test_verify_detects_changed_files(tmp_path):
+    _, chunks = _chunks()
+    path = str(tmp_path / "sharded")
+    with ShardedMatrixWriter(path) as writer:
+        for gctoo in chunks:
+            writer.write(gctoo)
+
+    with open(os.path.join(path, "shard_00001.cid.txt"), "a") as fh:
+        fh.write("extra\n")
+    os.remove(os.path.join(path, "shard_00002.parquet"))
+
+    assert open_sharded_matrix(path).verify() == ["shard_00001.cid.txt", "shard_00002.parquet"]
+
+
+def test_missing_manifest(tmp_path):
+    with pytest.raises(ValueError):
+        open_sharded_matrix(str(tmp_path))
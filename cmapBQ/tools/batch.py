@@ -0,0 +1,211 @@
+import os, re, sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+from google.auth import exceptions
+
+from cmapBQ.utils import write_args, write_status, mk_out_dir, str2bool
+
+toolname = "batch"
+description = "Run the jobs listed in a YAML manifest in one process, sharing one BigQuery client"
+
+# Job names become output directory names
+_JOB_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+_TOOL_NAME_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="cmapBQ {}".format(toolname), description=description
+    )
+    parser.add_argument("manifest", help="YAML manifest listing jobs to run")
+    parser.add_argument(
+        "--max_workers",
+        help="Number of jobs to run concurrently. Overrides max_workers in the manifest",
+        default=None,
+        type=int,
+    )
+
+    tool_group = parser.add_argument_group("Tool options")
+    tool_group.add_argument(
+        "-k",
+        "--key",
+        help="Path to service account key. \n Alternatively, set GOOGLE_APPLICATION_CREDENTIALS",
+        default=None,
+    )
+    tool_group.add_argument("-o", "--out", help="Output folder", default=os.getcwd())
+    tool_group.add_argument(
+        "-c", "--create_subdir", help="Create Subdirectory", type=str2bool, default=True
+    )
+
+    if argv:
+        args = parser.parse_args(argv)
+        return args
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+def read_manifest(path):
+    """
+    Read and validate a batch manifest. Job names may only contain letters, digits, '_', '.' and '-', since
+    each job writes into a directory of that name. Job args are the long option names of the tool, e.g.
+
+        max_workers: 4
+        jobs:
+          - name: vorinostat_compounds
+            tool: cmap_compounds
+            args:
+              cmap_name: vorinostat
+          - name: a375_matrix
+            tool: cmap_matrix
+            args:
+              cid: [sig_1, sig_2]
+              format: parquet
+
+    :param path: Path to YAML manifest
+    :return: (max_workers, list of job dicts with 'name', 'tool' and 'args')
+    """
+    with open(path, "r") as fh:
+        manifest = yaml.safe_load(fh)
+
+    if not isinstance(manifest, dict) or not manifest.get("jobs"):
+        print("Manifest {} must contain a list of jobs".format(path))
+        raise ValueError
+
+    jobs = []
+    names = set()
+    for i, job in enumerate(manifest["jobs"]):
+        if "tool" not in job:
+            print("Job {} in manifest is missing 'tool'".format(i))
+            raise ValueError
+        if not _TOOL_NAME_PATTERN.match(str(job["tool"])):
+            print("Invalid tool {} for job {} in manifest".format(job["tool"], i))
+            raise ValueError
+        name = str(job.get("name", "{}_{}".format(job["tool"], i)))
+        if not _JOB_NAME_PATTERN.match(name):
+            print("Invalid job name {!r} in manifest. Use letters, digits, '_', '.' and '-'".format(name))
+            raise ValueError
+        if name in names:
+            print("Duplicate job name {} in manifest".format(name))
+            raise ValueError
+        names.add(name)
+        jobs.append({"name": name, "tool": job["tool"], "args": job.get("args") or {}})
+
+    return manifest.get("max_workers", 1), jobs
+
+
+def job_argv(job_args):
+    """
+    Convert a job's argument mapping to a command line argument list.
+    Lists are comma separated and booleans are written as true/false.
+
+    :param job_args: dict of argument name to value
+    :return: list of strings
+    """
+    argv = []
+    for name, value in job_args.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = str(value).lower()
+        elif isinstance(value, (list, tuple)):
+            value = ",".join(str(v) for v in value)
+        argv.extend(["--{}".format(name), str(value)])
+    return argv
+
+
+def run_job(bq_client, job, out_path):
+    """
+    Run one manifest job with a shared client. The job writes into out_path/<name> with its own
+    config.txt and SUCCESS.txt or FAILURE.txt.
+
+    :param bq_client: BigQuery Client
+    :param job: job dict with 'name', 'tool' and 'args'
+    :param out_path: batch output folder
+    :return: True if the job succeeded
+    """
+    job_path = _job_path(out_path, job["name"])
+    job_path = mk_out_dir(job_path, job["name"], create_subdir=False)
+
+    try:
+        if job["tool"] == toolname:
+            print("Batch jobs cannot run the batch tool")
+            raise ValueError
+        tool = __import__("cmapBQ.tools.{}".format(job["tool"]), fromlist=["parse_args", "run"])
+        try:
+            args = tool.parse_args(job_argv(job["args"]) + ["--out", job_path, "--create_subdir", "false"])
+        except SystemExit:
+            raise ValueError("Invalid arguments for {}: {}".format(job["tool"], job["args"]))
+        write_args(args, job_path)
+
+        tool.run(bq_client, args, job_path)
+        write_status(True, job_path)
+        return True
+    except Exception as e:
+        write_status(False, job_path, exception=e)
+        return False
+
+
+def _job_path(out_path, name):
+    """
+    Output directory of a job. Raises ValueError if it would fall outside out_path.
+    """
+    root = os.path.realpath(out_path)
+    job_path = os.path.realpath(os.path.join(root, name))
+    if os.path.dirname(job_path) != root:
+        print("Job name {!r} resolves outside the output folder {}".format(name, out_path))
+        raise ValueError
+    return job_path
+
+
+def run(bq_client, args, out_path):
+    """
+    Run every job of the manifest, at most max_workers at a time.
+
+    :return: list of names of failed jobs
+    """
+    max_workers, jobs = read_manifest(args.manifest)
+    if args.max_workers is not None:
+        max_workers = args.max_workers
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_job, bq_client, job, out_path) for job in jobs]
+        results = [future.result() for future in futures]
+
+    failed = [job["name"] for job, success in zip(jobs, results) if not success]
+    print("{} of {} jobs succeeded".format(len(jobs) - len(failed), len(jobs)))
+    return failed
+
+
+def main(argv):
+    args = parse_args(argv)
+    out_path = mk_out_dir(args.out, toolname, create_subdir=args.create_subdir)
+    write_args(args, out_path)
+
+    if args.key is not None:
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = args.key
+
+    try:
+        from google.cloud import bigquery
+
+        bq_client = bigquery.Client()
+        failed = run(bq_client, args, out_path)
+        if failed:
+            raise RuntimeError("Failed jobs: {}".format(", ".join(failed)))
+        write_status(True, out_path)
+    except exceptions.DefaultCredentialsError as cred_error:
+        print(
+            "Could not automatically determine credentials. Please set GOOGLE_APPLICATION_CREDENTIALS or"
+            " specify path to key using --key"
+        )
+        write_status(False, out_path, exception=cred_error)
+        exit(1)
+    except Exception as e:
+        write_status(False, out_path, exception=e)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,16 +1,17 @@
 import os, sys
 import argparse
 
-import pandas as pd
-from google.cloud import bigquery
 from google.auth import exceptions
 
 from cmapBQ.utils import write_args, write_status, mk_out_dir, str2bool
-from cmapBQ.query import cmap_compounds
+
+toolname = "cmap_compounds"
+description = "Query Compound Info table for MoA, Target, BRD information"
+
 
 def parse_args(argv):
     parser = argparse.ArgumentParser(
-        description="Query Compound Info table for MoA, Target, BRD information"
+        prog="cmapBQ {}".format(toolname), description=description
     )
     parser.add_argument("--pert_id", help="List of pert_id to query", default=None)
     parser.add_argument("--cmap_name", help="List of cmap_names to query", default=None)
@@ -43,27 +44,41 @@ def parse_args(argv):
         sys.exit(1)
 
 
+def run(bq_client, args, out_path):
+    """
+    Run the tool with parsed arguments and an existing client. Used by main and the batch tool.
+
+    :return: path of output
+    """
+    from cmapBQ.query import cmap_compounds
+
+    result = cmap_compounds(
+        bq_client,
+        pert_id=args.pert_id,
+        cmap_name=args.cmap_name,
+        moa=args.moa,
+        target=args.target,
+        compound_aliases=args.compound_aliases,
+    )
+
+    ofile = os.path.join(out_path, args.filename)
+    result.to_csv(ofile, sep="\t", index=False)
+    return ofile
+
+
 def main(argv):
     args = parse_args(argv)
-    out_path = mk_out_dir(args.out, "cmap_compounds", create_subdir=args.create_subdir)
+    out_path = mk_out_dir(args.out, toolname, create_subdir=args.create_subdir)
     write_args(args, out_path)
 
     if args.key is not None:
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = args.key
 
     try:
-        bq_client = bigquery.Client()
+        from google.cloud import bigquery
 
-        result = cmap_compounds(
-            bq_client,
-            pert_id=args.pert_id,
-            cmap_name=args.cmap_name,
-            moa=args.moa,
-            target=args.target,
-            compound_aliases=args.compound_aliases,
-        )
-
-        result.to_csv(os.path.join(out_path, args.filename), sep="\t", index=False)
+        bq_client = bigquery.Client()
+        run(bq_client, args, out_path)
         write_status(True, out_path)
     except exceptions.DefaultCredentialsError as cred_error:
         print(
@@ -1,14 +1,10 @@
 import os, sys
 import argparse
 
-import pandas as pd
-from google.cloud import bigquery
 from google.auth import exceptions
 
 from cmapBQ.utils import write_args, write_status, mk_out_dir, str2bool
-from cmapBQ.query import cmap_matrix
-from cmapPy.pandasGEXpress.write_gctx import write as write_gctx
-from cmapPy.pandasGEXpress.write_gct import write as write_gct
+from cmapBQ.utils.formats import COLUMNAR_FORMATS, GCTX_COMPRESSION, get_extension, open_matrix_writer, write_gctx
 
 toolname = "cmap_matrix"
 description = "Download table hosted on BiqQuery as a GCTX"
@@ -21,12 +17,46 @@ def parse_args(argv):
     parser.add_argument("--table", help="Table to query", default=None)
     parser.add_argument("--cid", help="List of sig_ids to extract", default=None)
     parser.add_argument("--rid", help="List of moas to query", default=None)
+    parser.add_argument(
+        "--data_level",
+        help="Data level to query, one of ['level3', 'level4', 'level5']",
+        default="level5",
+    )
+    parser.add_argument(
+        "--feature_space",
+        help="Feature space to query when --rid is not given, one of ['landmark', 'bing', 'aig']",
+        default="landmark",
+    )
+    parser.add_argument(
+        "--annotate",
+        help="Write gene and signature/sample metadata into the output file",
+        type=str2bool,
+        default=False,
+    )
+    parser.add_argument(
+        "--large_result",
+        help="Materialize chunks into the configured dataset and read them with the BigQuery Storage API",
+        type=str2bool,
+        default=False,
+    )
     parser.add_argument(
         "--chunk_size",
         help="Size of each chunk as a number of columns from --cid",
         default=10000,
         type=int,
     )
+    parser.add_argument(
+        "--limit",
+        help="Maximum number of ids in --cid (or --rid without --cid), for every output format. 0 for no limit",
+        default=4000,
+        type=int,
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="Number of chunks downloaded and pivoted ahead of writing. 0 runs each chunk's stages in series",
+        default=2,
+        type=int,
+    )
 
     tool_group = parser.add_argument_group("Tool options")
     tool_group.add_argument(
@@ -49,6 +79,45 @@ def parse_args(argv):
         type=str2bool,
         default=True,
     )
+    tool_group.add_argument(
+        "--format",
+        help="Output format. Overrides --use_gctx. Columnar formats are written chunk by chunk as queries complete",
+        choices=["gctx", "gct"] + COLUMNAR_FORMATS,
+        default=None,
+    )
+    tool_group.add_argument(
+        "--sharded",
+        help="Write a directory of shard files and a manifest instead of a single file. Requires --cid",
+        type=str2bool,
+        default=False,
+    )
+    tool_group.add_argument(
+        "--chunks_per_shard", help="Number of query chunks written to each shard", type=int, default=1
+    )
+    tool_group.add_argument(
+        "--shard_workers", help="Number of shards written concurrently", type=int, default=4
+    )
+    tool_group.add_argument(
+        "--compression",
+        help="GCTX compression of the data matrix. Default none keeps columns contiguous for fastest subset reads",
+        choices=GCTX_COMPRESSION,
+        default="none",
+    )
+    tool_group.add_argument(
+        "--compression_level", help="gzip level (0-9) or blosc clevel for GCTX output", type=int, default=4
+    )
+    tool_group.add_argument(
+        "--chunk_cols",
+        help="Number of columns per HDF5 chunk of GCTX output. Default 4 with compression, otherwise contiguous",
+        type=int,
+        default=None,
+    )
+    tool_group.add_argument(
+        "--precision",
+        help="Float precision of GCTX data matrix",
+        choices=["float32", "float16", "float64"],
+        default="float32",
+    )
     tool_group.add_argument(
         "-v", "--verbose", help="Run in verbose mode", type=str2bool, default=False
     )
@@ -61,38 +130,177 @@ def parse_args(argv):
         sys.exit(1)
 
 
-def main(argv):
-    args = parse_args(argv)
-    out_path = mk_out_dir(args.out, toolname, create_subdir=args.create_subdir)
-    write_args(args, out_path)
+def _get_limit(args):
+    return args.limit or None
 
-    if args.key is not None:
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = args.key
 
-    try:
-        bq_client = bigquery.Client()
+def _iter_chunks(bq_client, args):
+    from cmapBQ.query import cmap_matrix, iter_cmap_matrix
 
-        gct = cmap_matrix(
+    if args.cid:
+        return iter_cmap_matrix(
             bq_client,
+            data_level=args.data_level,
+            feature_space=args.feature_space,
             table=args.table,
             rid=args.rid,
             cid=args.cid,
             verbose=args.verbose,
             chunk_size=args.chunk_size,
+            limit=_get_limit(args),
+            large_result=args.large_result,
+            prefetch=args.prefetch,
         )
+    else:
+        return [
+            cmap_matrix(
+                bq_client,
+                data_level=args.data_level,
+                feature_space=args.feature_space,
+                table=args.table,
+                rid=args.rid,
+                verbose=args.verbose,
+                chunk_size=args.chunk_size,
+                limit=_get_limit(args),
+                large_result=args.large_result,
+                prefetch=args.prefetch,
+            )
+        ]
+
+
+def write_columnar(bq_client, args, out_path):
+    """
+    Stream query results into a Parquet, Arrow IPC or Zarr file. Requests with --cid are written chunk by
+    chunk as each query completes.
+
+    :return: path of output
+    """
+    if args.annotate:
+        print("--annotate is only supported for gctx and gct formats")
+        raise ValueError
+
+    fn = os.path.splitext(os.path.basename(args.filename))[0]
+    ext = get_extension(args.format)
+    tmp_file = os.path.join(out_path, "{}.{}".format(fn, ext))
+
+    with open_matrix_writer(tmp_file, args.format) as writer:
+        for gct in _iter_chunks(bq_client, args):
+            writer.write(gct)
+
+    shape = writer.shape
+    ofile = os.path.join(out_path, "{}_n{}x{}.{}".format(fn, shape[1], shape[0], ext))
+    os.rename(tmp_file, ofile)
+    return ofile
+
+
+def write_sharded(bq_client, args, out_path):
+    """
+    Stream query results into a directory of shards written in parallel, with a manifest.json and a cid
+    list per shard. Read with cmapBQ.utils.shards.open_sharded_matrix.
+
+    :return: path of output directory
+    """
+    from cmapBQ.utils.shards import SHARD_FORMATS, ShardedMatrixWriter
+
+    if args.annotate:
+        print("--annotate is not supported with --sharded")
+        raise ValueError
+    if not args.cid:
+        print("--sharded requires --cid")
+        raise ValueError
+    if args.format not in SHARD_FORMATS:
+        print("--sharded supports formats {}".format(SHARD_FORMATS))
+        raise ValueError
+
+    writer_kwargs = {}
+    if args.format == "gctx":
+        writer_kwargs = dict(
+            compression=args.compression,
+            chunk_cols=args.chunk_cols,
+            compression_level=args.compression_level,
+            dtype=args.precision,
+        )
+
+    fn = os.path.splitext(os.path.basename(args.filename))[0]
+    tmp_dir = os.path.join(out_path, "{}_shards".format(fn))
+
+    with ShardedMatrixWriter(tmp_dir, args.format, chunks_per_shard=args.chunks_per_shard,
+                             max_workers=args.shard_workers, **writer_kwargs) as writer:
+        for gct in _iter_chunks(bq_client, args):
+            writer.write(gct)
+
+    shape = writer.shape
+    odir = os.path.join(out_path, "{}_n{}x{}_shards".format(fn, shape[1], shape[0]))
+    os.rename(tmp_dir, odir)
+    return odir
+
+
+def run(bq_client, args, out_path):
+    """
+    Run the tool with parsed arguments and an existing client. Used by main and the batch tool.
 
-        fn = os.path.splitext(os.path.basename(args.filename))[0]
-        shape = gct.data_df.shape
+    :return: path of output
+    """
+    from cmapBQ.query import cmap_matrix
+    from cmapPy.pandasGEXpress.write_gct import write as write_gct
 
-        if args.use_gctx:
-            fn = "{}_n{}x{}.gctx".format(fn, shape[1], shape[0])
-            ofile = os.path.join(out_path, fn)
-            write_gctx(gct, ofile)
-        else:
-            fn = "{}_n{}x{}.gct".format(fn, shape[1], shape[0])
-            ofile = os.path.join(out_path, fn)
-            write_gct(gct, ofile)
+    if args.format is None:
+        args.format = "gctx" if args.use_gctx else "gct"
 
+    if args.sharded:
+        return write_sharded(bq_client, args, out_path)
+
+    if args.format in COLUMNAR_FORMATS:
+        return write_columnar(bq_client, args, out_path)
+
+    gct = cmap_matrix(
+        bq_client,
+        data_level=args.data_level,
+        feature_space=args.feature_space,
+        table=args.table,
+        rid=args.rid,
+        cid=args.cid,
+        verbose=args.verbose,
+        chunk_size=args.chunk_size,
+        limit=_get_limit(args),
+        annotate=args.annotate,
+        large_result=args.large_result,
+        prefetch=args.prefetch,
+    )
+
+    fn = os.path.splitext(os.path.basename(args.filename))[0]
+    shape = gct.data_df.shape
+
+    if args.format == "gctx":
+        fn = "{}_n{}x{}.gctx".format(fn, shape[1], shape[0])
+        ofile = os.path.join(out_path, fn)
+        write_gctx(
+            gct, ofile,
+            compression=args.compression,
+            chunk_cols=args.chunk_cols,
+            compression_level=args.compression_level,
+            dtype=args.precision,
+        )
+    else:
+        fn = "{}_n{}x{}.gct".format(fn, shape[1], shape[0])
+        ofile = os.path.join(out_path, fn)
+        write_gct(gct, ofile)
+    return ofile
+
+
+def main(argv):
+    args = parse_args(argv)
+    out_path = mk_out_dir(args.out, toolname, create_subdir=args.create_subdir)
+    write_args(args, out_path)
+
+    if args.key is not None:
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = args.key
+
+    try:
+        from google.cloud import bigquery
+
+        bq_client = bigquery.Client()
+        run(bq_client, args, out_path)
         write_status(True, out_path)
     except exceptions.DefaultCredentialsError as cred_error:
         print(
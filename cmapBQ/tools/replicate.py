@@ -0,0 +1,118 @@
+import os, sys
+import argparse
+
+from google.auth import exceptions
+
+from cmapBQ.utils import write_args, write_status, mk_out_dir, str2bool
+
+toolname = "replicate"
+description = "Export a matrix table into a local memory-mapped replica used by cmap_matrix"
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="cmapBQ {}".format(toolname), description=description
+    )
+    parser.add_argument("--table", help="Table to replicate. Overrides --data_level", default=None)
+    parser.add_argument(
+        "--data_level",
+        help="Data level to replicate, one of ['level3', 'level4', 'level5']",
+        default="level5",
+    )
+    parser.add_argument(
+        "--feature_space",
+        help="Feature space to replicate, one of ['landmark', 'bing', 'aig']",
+        default="landmark",
+    )
+    parser.add_argument("--cid", help="List of ids to replicate. Default is all ids in the table", default=None)
+    parser.add_argument(
+        "--chunk_size",
+        help="Number of columns per query",
+        default=10000,
+        type=int,
+    )
+    parser.add_argument(
+        "--register",
+        help="Register replica in ~/.cmapBQ/config.txt so cmap_matrix reads from it",
+        type=str2bool,
+        default=True,
+    )
+
+    tool_group = parser.add_argument_group("Tool options")
+    tool_group.add_argument(
+        "-k",
+        "--key",
+        help="Path to service account key. \n Alternatively, set GOOGLE_APPLICATION_CREDENTIALS",
+        default=None,
+    )
+    tool_group.add_argument("-o", "--out", help="Output folder", default=os.getcwd())
+    tool_group.add_argument(
+        "-c", "--create_subdir", help="Create Subdirectory", type=str2bool, default=True
+    )
+    tool_group.add_argument(
+        "-v", "--verbose", help="Run in verbose mode", type=str2bool, default=False
+    )
+
+    if argv:
+        args = parser.parse_args(argv)
+        return args
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+def run(bq_client, args, out_path):
+    """
+    Run the tool with parsed arguments and an existing client. Used by main and the batch tool.
+
+    :return: path of replica
+    """
+    from cmapBQ.replica import build_replica, open_replica
+    from cmapBQ.config import register_replica
+
+    replica_path = build_replica(
+        bq_client,
+        out_path,
+        data_level=args.data_level,
+        feature_space=args.feature_space,
+        table=args.table,
+        cid=args.cid,
+        chunk_size=args.chunk_size,
+        verbose=args.verbose,
+    )
+
+    if args.register:
+        table_id = open_replica(replica_path).table
+        register_replica(table_id, replica_path)
+        print("Registered replica of {}".format(table_id))
+    return replica_path
+
+
+def main(argv):
+    args = parse_args(argv)
+    out_path = mk_out_dir(args.out, toolname, create_subdir=args.create_subdir)
+    write_args(args, out_path)
+
+    if args.key is not None:
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = args.key
+
+    try:
+        from google.cloud import bigquery
+
+        bq_client = bigquery.Client()
+        run(bq_client, args, out_path)
+        write_status(True, out_path)
+    except exceptions.DefaultCredentialsError as cred_error:
+        print(
+            "Could not automatically determine credentials. Please set GOOGLE_APPLICATION_CREDENTIALS or"
+            " specify path to key using --key"
+        )
+        write_status(False, out_path, exception=cred_error)
+        exit(1)
+    except Exception as e:
+        write_status(False, out_path, exception=e)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,13 +3,7 @@ import argparse
 import traceback
 from datetime import datetime
 
-import pandas as pd
-
-from cmapPy.pandasGEXpress.GCToo import GCToo
-from cmapPy.set_io.grp import read as parse_grp
-from cmapPy.pandasGEXpress.write_gctx import write as write_gctx
-from cmapPy.pandasGEXpress.write_gct import write as write_gct
-
+# pandas and cmapPy are imported where used so tools can parse arguments without loading them
 
 
 
@@ -25,6 +19,7 @@ def parse_condition(arg, sep=","):
     """
     if isinstance(arg, str):
         if os.path.isfile(arg):
+            from cmapPy.set_io.grp import read as parse_grp
             arg = parse_grp(arg)
         else:
             arg = arg.split(sep=sep)
@@ -62,6 +57,30 @@ def write_status(success, out, exception=""):
             file.write(traceback.format_exc())
 
 
+def read_ids(path):
+    """
+    Read a list of ids written by write_ids, one per line.
+
+    :param path: Text file path
+    :return: list of ids
+    """
+    with open(path, "r") as fh:
+        return [line.rstrip("\n") for line in fh]
+
+
+def write_ids(path, ids):
+    """
+    Write a list of ids, one per line.
+
+    :param path: Text file path
+    :param ids: Iterable of ids
+    :return: None
+    """
+    with open(path, "w") as fh:
+        for i in ids:
+            fh.write("{}\n".format(i))
+
+
 def mk_out_dir(path, toolname, create_subdir=True):
     path = os.path.abspath(path)
     if not os.path.exists(path):
@@ -85,6 +104,8 @@ def long_to_gctx(df):
     :param df: Long form pandas DataFrame
     :return: GCToo object
     """
+    from cmapPy.pandasGEXpress.GCToo import GCToo
+
     df = df[["rid", "cid", "value"]].pivot(index="rid", columns="cid", values="value")
     gct = GCToo(df)
 
@@ -104,6 +125,11 @@ def csv_to_gctx(filepaths, outpath, use_gctx=True):
     :param use_gctx: use GCTX HDF5 format. Default is True
     :return:
     """
+    import pandas as pd
+    from cmapPy.pandasGEXpress.GCToo import GCToo
+    from cmapPy.pandasGEXpress.write_gctx import write as write_gctx
+    from cmapPy.pandasGEXpress.write_gct import write as write_gct
+
     li = []
     for filename in filepaths:
         df = pd.read_csv(filename, index_col=None, header=0)
@@ -0,0 +1,201 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class DenseMatrix:
+    """
+    Dense matrix (rid x cid) held as a NumPy array with id arrays, without pandas indexes or GCToo metadata.
+    Values are column-major, so each cid is a contiguous block that converts to Arrow without a copy.
+    """
+    values: np.ndarray
+    rids: np.ndarray
+    cids: np.ndarray
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @classmethod
+    def from_dataframe(cls, data_df):
+        """
+        :param data_df: Pandas DataFrame (rid x cid)
+        :return: DenseMatrix
+        """
+        return cls(
+            np.asfortranarray(data_df.values),
+            np.asarray(data_df.index, dtype=object),
+            np.asarray(data_df.columns, dtype=object),
+        )
+
+    def to_arrow(self):
+        """
+        :return: pyarrow Table with a 'rid' column followed by one column per cid
+        """
+        import pyarrow as pa
+
+        columns = [pa.array(self.rids, type=pa.string())]
+        columns += [pa.array(self.values[:, i]) for i in range(self.values.shape[1])]
+        return pa.Table.from_arrays(columns, names=["rid"] + [str(cid) for cid in self.cids])
+
+    def to_dataframe(self):
+        """
+        :return: Pandas DataFrame (rid x cid)
+        """
+        data_df = pd.DataFrame(
+            self.values, index=pd.Index(self.rids, name="rid"), columns=pd.Index(self.cids, name="cid"), copy=False
+        )
+        return data_df
+
+    def to_gctoo(self):
+        """
+        :return: GCToo object
+        """
+        from cmapPy.pandasGEXpress.GCToo import GCToo
+
+        return GCToo(self.to_dataframe())
+
+
+class MatrixAssembler:
+    """
+    Assemble long-form chunk results (rid, cid, value) into one dense matrix. Ids known before the first
+    chunk arrives, e.g. the requested cids, are laid out in sorted order and the matrix is allocated once;
+    each chunk is scattered into its positions as it completes, without pivoting it into an intermediate
+    GCToo. Ids of an axis not known in advance are taken from the first chunk.
+
+    The result matches cmapPy's hstack/vstack of the pivoted chunks: both axes sorted, and requested
+    ids that returned no values dropped.
+    """
+
+    def __init__(self, rid=None, cid=None, dtype="float64"):
+        """
+        :param rid: Row ids expected in the result, or None to take them from the data
+        :param cid: Column ids expected in the result, or None to take them from the data
+        :param dtype: dtype of the assembled matrix
+        """
+        self.dtype = np.dtype(dtype)
+        self.rids = None if rid is None else _sorted_index(rid)
+        self.cids = None if cid is None else _sorted_index(cid)
+        self.values = None
+        self._row_seen = None
+        self._col_seen = None
+        if self.rids is not None and self.cids is not None:
+            self._allocate()
+
+    @property
+    def shape(self):
+        """
+        (number of rows, number of columns) allocated
+        """
+        return (0, 0) if self.values is None else self.values.shape
+
+    def add(self, df_long):
+        """
+        Write a long-form chunk into the matrix.
+
+        :param df_long: Pandas DataFrame or pyarrow Table with 'rid', 'cid' and 'value' columns
+        :return: None
+        """
+        # Ids are matched once per distinct value rather than once per record
+        rid_codes, rid = _factorize(df_long, "rid")
+        cid_codes, cid = _factorize(df_long, "cid")
+        if isinstance(df_long, pd.DataFrame):
+            values = df_long["value"].values
+        else:
+            values = df_long.column("value").to_numpy()
+
+        if self.values is None:
+            if self.rids is None:
+                self.rids = _sorted_index(rid)
+            if self.cids is None:
+                self.cids = _sorted_index(cid)
+            self._allocate()
+
+        rows = self._positions(rid, axis=0)[rid_codes]
+        cols = self._positions(cid, axis=1)[cid_codes]
+        self.values[rows, cols] = values
+        self._row_seen[rows] = True
+        self._col_seen[cols] = True
+
+    def to_dense(self):
+        """
+        :return: DenseMatrix of the ids that returned values
+        """
+        if self.values is None:
+            return DenseMatrix(
+                np.empty((0, 0), dtype=self.dtype, order="F"),
+                np.array([], dtype=object),
+                np.array([], dtype=object),
+            )
+
+        values, rids, cids = self.values, self.rids.values, self.cids.values
+        if not self._row_seen.all():
+            values, rids = values[self._row_seen], rids[self._row_seen]
+        if not self._col_seen.all():
+            values, cids = values[:, self._col_seen], cids[self._col_seen]
+        return DenseMatrix(np.asfortranarray(values), rids, cids)
+
+    def to_dataframe(self):
+        """
+        :return: Pandas DataFrame (rid x cid) of the ids that returned values
+        """
+        return self.to_dense().to_dataframe()
+
+    def to_gctoo(self):
+        """
+        :return: GCToo object of the ids that returned values
+        """
+        return self.to_dense().to_gctoo()
+
+    def _allocate(self):
+        self.values = np.full((len(self.rids), len(self.cids)), np.nan, dtype=self.dtype, order="F")
+        self._row_seen = np.zeros(len(self.rids), dtype=bool)
+        self._col_seen = np.zeros(len(self.cids), dtype=bool)
+
+    def _positions(self, ids, axis):
+        index = self.rids if axis == 0 else self.cids
+        positions = index.get_indexer(ids)
+        if (positions < 0).any():
+            # Ids outside the expected universe: grow the axis, keeping it sorted
+            self._extend(ids[positions < 0], axis)
+            index = self.rids if axis == 0 else self.cids
+            positions = index.get_indexer(ids)
+        return positions
+
+    def _extend(self, new_ids, axis):
+        old = self.rids if axis == 0 else self.cids
+        index = _sorted_index(np.concatenate([old.values, new_ids]))
+        target = index.get_indexer(old)
+
+        shape = list(self.values.shape)
+        shape[axis] = len(index)
+        values = np.full(shape, np.nan, dtype=self.dtype, order="F")
+        seen = np.zeros(len(index), dtype=bool)
+        if axis == 0:
+            values[target] = self.values
+            seen[target] = self._row_seen
+            self.rids, self._row_seen = index, seen
+        else:
+            values[:, target] = self.values
+            seen[target] = self._col_seen
+            self.cids, self._col_seen = index, seen
+        self.values = values
+
+
+def _factorize(df_long, field):
+    """
+    :return: (integer code per record, distinct ids as strings)
+    """
+    if isinstance(df_long, pd.DataFrame):
+        codes, uniques = pd.factorize(df_long[field])
+        return codes, np.asarray(uniques).astype(str)
+
+    encoded = df_long.column(field).combine_chunks().dictionary_encode()
+    codes = encoded.indices.to_numpy(zero_copy_only=False)
+    return codes, encoded.dictionary.to_numpy(zero_copy_only=False).astype(str)
+
+
+def _sorted_index(ids):
+    return pd.Index(np.unique(np.asarray(ids, dtype=str)).astype(object))
@@ -0,0 +1,372 @@
+import os
+
+
+COLUMNAR_FORMATS = ["parquet", "arrow", "zarr"]
+
+_EXTENSIONS = {"parquet": "parquet", "arrow": "arrow", "zarr": "zarr"}
+
+DEFAULT_GCTX_CHUNK_COLS = 4
+
+
+def get_extension(file_format):
+    """
+    File extension for a columnar output format
+
+    :param file_format: One of ['parquet', 'arrow', 'zarr']
+    :return: extension without leading '.'
+    """
+    if file_format not in _EXTENSIONS:
+        print("Unknown format {}. Choices {}".format(file_format, COLUMNAR_FORMATS))
+        raise ValueError
+    return _EXTENSIONS[file_format]
+
+
+class MatrixWriter:
+    """
+    Base class for streaming matrix writers. GCToo chunks are written with write() as they arrive and
+    the file is finalized with close(). The row ids of the first chunk fix the row order of the file;
+    later chunks are aligned to it.
+
+    Usable as a context manager.
+    """
+
+    def __init__(self, path, dtype="float32"):
+        self.path = path
+        self.dtype = dtype
+        self.rids = None
+        self.ncid = 0
+
+    @property
+    def shape(self):
+        """
+        (number of rows, number of columns) written so far
+        """
+        nrid = 0 if self.rids is None else len(self.rids)
+        return nrid, self.ncid
+
+    def write(self, gctoo):
+        """
+        Append the columns of a GCToo object.
+
+        :param gctoo: GCToo object
+        :return: None
+        """
+        data_df = gctoo.data_df
+        if self.rids is None:
+            self.rids = [str(rid) for rid in data_df.index]
+        else:
+            data_df = data_df.reindex(self.rids)
+
+        values = data_df.values.astype(self.dtype)
+        cids = [str(cid) for cid in data_df.columns]
+        self._write_chunk(values, cids)
+        self.ncid += len(cids)
+
+    def close(self):
+        """
+        Finalize the output file.
+
+        :return: path of output
+        """
+        return self.path
+
+    def _write_chunk(self, values, cids):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class _ArrowTableWriter(MatrixWriter):
+    """
+    Shared layout for Parquet and Arrow IPC: one row per signature with a 'cid' column followed by one
+    float column per rid. Each chunk is written as its own row group / record batch so signatures can be
+    located and read without scanning the full file.
+    """
+
+    def _to_record_batch(self, values, cids):
+        import pyarrow as pa
+
+        arrays = [pa.array(cids, type=pa.string())]
+        arrays.extend(pa.array(values[i]) for i in range(values.shape[0]))
+        return pa.RecordBatch.from_arrays(arrays, names=["cid"] + self.rids)
+
+
+class ParquetMatrixWriter(_ArrowTableWriter):
+    """
+    Write a matrix to a compressed Parquet file, one row group per chunk.
+    """
+
+    def __init__(self, path, dtype="float32", compression="zstd"):
+        super().__init__(path, dtype=dtype)
+        self.compression = compression
+        self._writer = None
+
+    def _write_chunk(self, values, cids):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        batch = self._to_record_batch(values, cids)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, batch.schema, compression=self.compression)
+        self._writer.write_table(pa.Table.from_batches([batch]))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        return self.path
+
+
+class ArrowMatrixWriter(_ArrowTableWriter):
+    """
+    Write a matrix to an uncompressed Arrow IPC file, one record batch per chunk. The file can be
+    memory-mapped by read_matrix.
+    """
+
+    def __init__(self, path, dtype="float32"):
+        super().__init__(path, dtype=dtype)
+        self._sink = None
+        self._writer = None
+
+    def _write_chunk(self, values, cids):
+        import pyarrow as pa
+
+        batch = self._to_record_batch(values, cids)
+        if self._writer is None:
+            self._sink = pa.OSFile(self.path, "wb")
+            self._writer = pa.ipc.new_file(self._sink, batch.schema)
+        self._writer.write_batch(batch)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+            self._writer = None
+        return self.path
+
+
+class ZarrMatrixWriter(MatrixWriter):
+    """
+    Write a matrix to a Zarr group. Values are held in a 'data' array of shape (rid, cid), chunked as all
+    rows by chunk_cols columns. Row and column ids are stored in the group attributes.
+    """
+
+    def __init__(self, path, dtype="float32", chunk_cols=256):
+        super().__init__(path, dtype=dtype)
+        self.chunk_cols = chunk_cols
+        self.cids = []
+        self._group = None
+        self._data = None
+
+    def _write_chunk(self, values, cids):
+        try:
+            import zarr
+        except ImportError:
+            print("zarr is required for Zarr output, install with 'pip install zarr'")
+            raise
+
+        if self._group is None:
+            self._group = zarr.open_group(self.path, mode="w")
+            self._data = self._group.zeros(
+                name="data",
+                shape=(len(self.rids), 0),
+                chunks=(len(self.rids), self.chunk_cols),
+                dtype=self.dtype,
+            )
+            self._group.attrs["rid"] = self.rids
+        self._data.append(values, axis=1)
+        self.cids.extend(cids)
+
+    def close(self):
+        if self._group is not None:
+            self._group.attrs["cid"] = self.cids
+        return self.path
+
+
+def open_matrix_writer(path, file_format, **kwargs):
+    """
+    Create a streaming writer for a columnar format.
+
+    :param path: Output path
+    :param file_format: One of ['parquet', 'arrow', 'zarr']
+    :param kwargs: Passed to the writer
+    :return: MatrixWriter
+    """
+    if file_format == "parquet":
+        return ParquetMatrixWriter(path, **kwargs)
+    elif file_format == "arrow":
+        return ArrowMatrixWriter(path, **kwargs)
+    elif file_format == "zarr":
+        return ZarrMatrixWriter(path, **kwargs)
+    else:
+        print("Unknown format {}. Choices {}".format(file_format, COLUMNAR_FORMATS))
+        raise ValueError
+
+
+GCTX_COMPRESSION = ["none", "gzip", "lzf", "blosc"]
+
+
+def write_gctx(gctoo, path, compression="none", chunk_cols=None, compression_level=4, dtype="float32"):
+    """
+    Write a GCToo object to GCTX with control over the HDF5 layout of the data matrix. GCTX stores the
+    matrix as (cid, rid), so each signature is a contiguous row. Uncompressed files are contiguous, which
+    gives the lowest latency for reading column subsets. Compression needs a chunked layout; chunks span
+    all rows and chunk_cols columns, and small chunks keep column reads cheap
+    (see benchmarks/gctx_read.py). Files are readable by cmapPy.pandasGEXpress.parse_gctx.
+
+    :param gctoo: GCToo object
+    :param path: Output path. '.gctx' is appended if missing.
+    :param compression: One of ['none', 'gzip', 'lzf', 'blosc']. blosc requires the hdf5plugin package.
+    :param chunk_cols: Number of columns (cids) per chunk. Default is contiguous without compression
+     and DEFAULT_GCTX_CHUNK_COLS with compression.
+    :param compression_level: gzip level (0-9) or blosc clevel. Ignored for lzf and none.
+    :param dtype: Storage precision of the data matrix, e.g. 'float32' or 'float16'
+    :return: path of output
+    """
+    import h5py
+    import numpy as np
+    import cmapPy.pandasGEXpress.write_gctx as cmap_write_gctx
+
+    path = cmap_write_gctx.add_gctx_to_out_name(path)
+    values = gctoo.data_df.T.values.astype(dtype)
+    options = _hdf5_compression(compression, compression_level)
+    if options and chunk_cols is None:
+        chunk_cols = DEFAULT_GCTX_CHUNK_COLS
+    if chunk_cols is not None and values.size:
+        options["chunks"] = (min(chunk_cols, values.shape[0]), values.shape[1])
+
+    with h5py.File(path, "w") as hdf5_out:
+        hdf5_out.attrs[cmap_write_gctx.version_attr] = np.bytes_(cmap_write_gctx.version_number)
+        cmap_write_gctx.write_src(hdf5_out, gctoo, path)
+        hdf5_out.create_dataset(cmap_write_gctx.data_matrix_node, data=values, **options)
+        cmap_write_gctx.write_metadata(hdf5_out, "col", gctoo.col_metadata_df, True, gzip_compression=6)
+        cmap_write_gctx.write_metadata(hdf5_out, "row", gctoo.row_metadata_df, True, gzip_compression=6)
+    return path
+
+
+def _hdf5_compression(compression, compression_level):
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": compression_level, "shuffle": True}
+    elif compression == "lzf":
+        return {"compression": "lzf", "shuffle": True}
+    elif compression == "blosc":
+        try:
+            import hdf5plugin
+        except ImportError:
+            print("hdf5plugin is required for blosc compression, install with 'pip install hdf5plugin'")
+            raise
+        return dict(hdf5plugin.Blosc(cname="zstd", clevel=compression_level, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    elif compression in ["none", None]:
+        return {}
+    else:
+        print("Unknown compression {}. Choices {}".format(compression, GCTX_COMPRESSION))
+        raise ValueError
+
+
+def read_matrix(path, cid=None, rid=None):
+    """
+    Read a matrix written by a MatrixWriter into a GCToo object. Only the requested columns are read.
+    The format is inferred from the file extension.
+
+    :param path: Path to .parquet, .arrow or .zarr output
+    :param cid: Optional list of column ids to read. Default reads all.
+    :param rid: Optional list of row ids to read. Default reads all.
+    :return: GCToo object
+    """
+    from cmapPy.pandasGEXpress.GCToo import GCToo
+
+    ext = os.path.splitext(path.rstrip(os.sep))[1].lstrip(".")
+    if ext == "parquet":
+        data_df = _read_parquet(path, cid=cid, rid=rid)
+    elif ext == "arrow":
+        data_df = _read_arrow(path, cid=cid, rid=rid)
+    elif ext == "zarr":
+        data_df = _read_zarr(path, cid=cid, rid=rid)
+    else:
+        print("Unknown file extension {}. Choices {}".format(ext, COLUMNAR_FORMATS))
+        raise ValueError
+
+    data_df.index.name = "rid"
+    data_df.columns.name = "cid"
+    return GCToo(data_df)
+
+
+def _rows_to_data_df(table, cid=None):
+    df = table.to_pandas().set_index("cid")
+    if cid is not None:
+        df = df.reindex([c for c in cid if c in df.index])
+    return df.T
+
+
+def _read_parquet(path, cid=None, rid=None):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    pf = pq.ParquetFile(path)
+    columns = None if rid is None else ["cid"] + [str(r) for r in rid]
+
+    if cid is None:
+        return _rows_to_data_df(pf.read(columns=columns))
+
+    wanted = set(str(c) for c in cid)
+    row_groups = [
+        i for i in range(pf.num_row_groups)
+        if wanted.intersection(pf.read_row_group(i, columns=["cid"]).column("cid").to_pylist())
+    ]
+    table = pf.read_row_groups(row_groups, columns=columns)
+    mask = pc.is_in(table.column("cid"), value_set=pa.array(list(wanted)))
+    return _rows_to_data_df(table.filter(mask), cid=[str(c) for c in cid])
+
+
+def _read_arrow(path, cid=None, rid=None):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    columns = None if rid is None else ["cid"] + [str(r) for r in rid]
+    wanted = None if cid is None else pa.array([str(c) for c in cid])
+
+    with pa.memory_map(path, "r") as source:
+        reader = pa.ipc.open_file(source)
+        schema = reader.schema
+        if columns is not None:
+            schema = pa.schema([schema.field(name) for name in columns])
+
+        batches = []
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if wanted is not None:
+                batch = batch.filter(pc.is_in(batch.column("cid"), value_set=wanted))
+            if columns is not None:
+                batch = batch.select(columns)
+            if batch.num_rows:
+                batches.append(batch)
+        table = pa.Table.from_batches(batches, schema=schema)
+        return _rows_to_data_df(table, cid=None if cid is None else [str(c) for c in cid])
+
+
+def _read_zarr(path, cid=None, rid=None):
+    import pandas as pd
+    import zarr
+
+    group = zarr.open_group(path, mode="r")
+    rids = list(group.attrs["rid"])
+    cids = list(group.attrs["cid"])
+
+    if rid is None:
+        row_idx = list(range(len(rids)))
+    else:
+        row_pos = {r: i for i, r in enumerate(rids)}
+        row_idx = [row_pos[str(r)] for r in rid]
+    if cid is None:
+        col_idx = list(range(len(cids)))
+    else:
+        col_pos = {c: i for i, c in enumerate(cids)}
+        col_idx = [col_pos[str(c)] for c in cid if str(c) in col_pos]
+
+    values = group["data"].get_orthogonal_selection((row_idx, col_idx))
+    return pd.DataFrame(values, index=[rids[i] for i in row_idx], columns=[cids[i] for i in col_idx])
@@ -0,0 +1,85 @@
+import queue
+import threading
+
+_DONE = object()
+_POLL_SECONDS = 0.1
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def run_pipeline(items, stages, queue_size=1):
+    """
+    Pass items through a chain of stages, e.g. download -> pivot, with each stage in its own thread and
+    consecutive stages connected by bounded queues. While the consumer handles item N, the last stage works
+    on item N+1 and earlier stages further ahead, so wall time approaches that of the slowest stage rather
+    than the sum of all stages. A full queue blocks the stage feeding it, which bounds memory use to
+    about queue_size + 1 items per stage.
+
+    An exception in any stage stops the pipeline and is raised to the consumer.
+
+    :param items: Iterable of inputs to the first stage
+    :param stages: List of functions, each called with the output of the previous stage
+    :param queue_size: Number of results held between two stages. 0 runs every stage in series in the
+     calling thread.
+    :return: Generator of outputs of the last stage, in input order
+    """
+    if queue_size <= 0:
+        for item in items:
+            for stage in stages:
+                item = stage(item)
+            yield item
+        return
+
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def inputs(i):
+        if i == 0:
+            yield from items
+            return
+        while not stop.is_set():
+            try:
+                item = queues[i - 1].get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+
+    def work(i, stage):
+        try:
+            for item in inputs(i):
+                if not put(queues[i], stage(item)):
+                    return
+            put(queues[i], _DONE)
+        except BaseException as e:
+            put(queues[i], _Failure(e))
+
+    for i, stage in enumerate(stages):
+        threading.Thread(target=work, args=(i, stage), daemon=True).start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        # Stops upstream stages if the consumer exits early
+        stop.set()
@@ -0,0 +1,302 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from . import read_ids, write_ids
+from .formats import COLUMNAR_FORMATS, get_extension, open_matrix_writer, read_matrix, write_gctx
+
+
+SHARD_FORMATS = COLUMNAR_FORMATS + ["gctx"]
+
+_MANIFEST_FILE = "manifest.json"
+
+
+class ShardedMatrixWriter:
+    """
+    Write a matrix as a directory of shard files and a manifest.json that records each shard's column range
+    and sha256 checksum. The cids of each shard are written to a text file next to it, so the manifest stays
+    small however many columns the matrix has. Shards are written by a thread pool while later chunks are
+    still being fetched, and a failed shard does not affect the others.
+
+    Usable as a context manager.
+    """
+
+    def __init__(self, path, file_format="parquet", chunks_per_shard=1, max_workers=4, **writer_kwargs):
+        """
+        :param path: Output directory
+        :param file_format: One of ['parquet', 'arrow', 'zarr', 'gctx']
+        :param chunks_per_shard: Number of written chunks combined into each shard
+        :param max_workers: Number of shards written concurrently
+        :param writer_kwargs: Passed to the shard writer, e.g. compression for gctx
+        """
+        if file_format not in SHARD_FORMATS:
+            print("Unknown format {}. Choices {}".format(file_format, SHARD_FORMATS))
+            raise ValueError
+
+        self.path = path
+        self.file_format = file_format
+        self.chunks_per_shard = chunks_per_shard
+        self.max_workers = max_workers
+        self.writer_kwargs = writer_kwargs
+
+        self.rids = None
+        self.ncid = 0
+        self._buffer = []
+        self._futures = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @property
+    def shape(self):
+        """
+        (number of rows, number of columns) written so far
+        """
+        nrid = 0 if self.rids is None else len(self.rids)
+        return nrid, self.ncid
+
+    def write(self, gctoo):
+        """
+        Append the columns of a GCToo object. Rows are aligned to the rows of the first chunk.
+
+        :param gctoo: GCToo object
+        :return: None
+        """
+        data_df = gctoo.data_df
+        if self.rids is None:
+            self.rids = [str(rid) for rid in data_df.index]
+        else:
+            data_df = data_df.reindex(self.rids)
+
+        self._buffer.append(data_df)
+        if len(self._buffer) >= self.chunks_per_shard:
+            self._submit_shard()
+
+    def close(self):
+        """
+        Wait for all shards and write the manifest.
+
+        :return: path of output directory
+        """
+        if self._buffer:
+            self._submit_shard()
+        shards = [future.result() for future in self._futures]
+        self._executor.shutdown()
+
+        manifest = {
+            "format": self.file_format,
+            "shape": [len(self.rids or []), self.ncid],
+            "rid": self.rids or [],
+            "created": datetime.now().strftime("%c"),
+            "shards": shards,
+        }
+        # Written last, a directory without manifest.json is incomplete
+        tmp_path = os.path.join(self.path, _MANIFEST_FILE + ".tmp")
+        with open(tmp_path, "w") as fh:
+            json.dump(manifest, fh)
+        os.replace(tmp_path, os.path.join(self.path, _MANIFEST_FILE))
+        return self.path
+
+    def _submit_shard(self):
+        import pandas as pd
+
+        data_df = self._buffer[0] if len(self._buffer) == 1 else pd.concat(self._buffer, axis=1)
+        self._buffer = []
+
+        # Bound the number of chunks held in memory while waiting for writers
+        outstanding = [future for future in self._futures if not future.done()]
+        if len(outstanding) >= 2 * self.max_workers:
+            outstanding[0].result()
+
+        start = self.ncid
+        self.ncid += data_df.shape[1]
+        self._futures.append(
+            self._executor.submit(self._write_shard, len(self._futures), start, data_df)
+        )
+
+    def _write_shard(self, index, start, data_df):
+        from cmapPy.pandasGEXpress.GCToo import GCToo
+
+        filename = "shard_{:05d}.{}".format(index, _shard_extension(self.file_format))
+        cid_filename = "shard_{:05d}.cid.txt".format(index)
+        shard_path = os.path.join(self.path, filename)
+        cid_path = os.path.join(self.path, cid_filename)
+        gctoo = GCToo(data_df)
+
+        if self.file_format == "gctx":
+            write_gctx(gctoo, shard_path, **self.writer_kwargs)
+        else:
+            with open_matrix_writer(shard_path, self.file_format, **self.writer_kwargs) as writer:
+                writer.write(gctoo)
+        write_ids(cid_path, data_df.columns)
+
+        return {
+            "file": filename,
+            "cid_file": cid_filename,
+            "start": start,
+            "stop": start + data_df.shape[1],
+            "ncid": data_df.shape[1],
+            "sha256": checksum(shard_path),
+            "cid_sha256": checksum(cid_path),
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown()
+
+
+class ShardedMatrix:
+    """
+    Read a directory written by ShardedMatrixWriter as one logical matrix. Only the shards holding the
+    requested columns are read. Shard cid lists are read on first use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        manifest_path = os.path.join(path, _MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            print("No manifest found in {}, output may be incomplete".format(path))
+            raise ValueError
+        with open(manifest_path, "r") as fh:
+            self.manifest = json.load(fh)
+
+        self.rids = self.manifest["rid"]
+        self.shards = self.manifest["shards"]
+        self._shard_cids = {}
+        self._cid_shard = None
+
+    @property
+    def file_format(self):
+        return self.manifest["format"]
+
+    @property
+    def shape(self):
+        return tuple(self.manifest["shape"])
+
+    @property
+    def cids(self):
+        return [cid for i in range(len(self.shards)) for cid in self.shard_cids(i)]
+
+    @property
+    def cid_shard(self):
+        """
+        dict of cid to index of the shard holding it
+        """
+        if self._cid_shard is None:
+            self._cid_shard = {cid: i for i in range(len(self.shards)) for cid in self.shard_cids(i)}
+        return self._cid_shard
+
+    def shard_cids(self, index):
+        """
+        :param index: Shard index
+        :return: list of cids in the shard, in column order
+        """
+        if index not in self._shard_cids:
+            self._shard_cids[index] = read_ids(os.path.join(self.path, self.shards[index]["cid_file"]))
+        return self._shard_cids[index]
+
+    def get(self, cid=None, rid=None, max_workers=4):
+        """
+        Slice the matrix. Column ids not present are dropped.
+
+        :param cid: list of column ids. Default returns all.
+        :param rid: list of row ids. Default returns all.
+        :param max_workers: Number of shards read concurrently
+        :return: GCToo object
+        """
+        import pandas as pd
+        from cmapPy.pandasGEXpress.GCToo import GCToo
+
+        cids = self.cids if cid is None else [str(c) for c in cid if str(c) in self.cid_shard]
+        rids = self.rids if rid is None else [str(r) for r in rid]
+
+        shard_cids = {}
+        for c in cids:
+            shard_cids.setdefault(self.cid_shard[c], []).append(c)
+
+        def read_shard(item):
+            index, shard_cid = item
+            return self._read_shard(self.shards[index], cid=shard_cid, rid=rid)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            data_dfs = list(executor.map(read_shard, sorted(shard_cids.items())))
+
+        if data_dfs:
+            data_df = pd.concat(data_dfs, axis=1).reindex(index=rids, columns=cids)
+        else:
+            data_df = pd.DataFrame(index=rids, columns=cids, dtype="float32")
+        data_df.index.name = "rid"
+        data_df.columns.name = "cid"
+        return GCToo(data_df)
+
+    def verify(self):
+        """
+        Compare each shard and its cid file to the checksums in the manifest.
+
+        :return: list of shard files that are missing or do not match
+        """
+        failed = []
+        for shard in self.shards:
+            for filename, digest in [(shard["file"], shard["sha256"]), (shard["cid_file"], shard["cid_sha256"])]:
+                file_path = os.path.join(self.path, filename)
+                if not os.path.exists(file_path) or checksum(file_path) != digest:
+                    failed.append(filename)
+        return failed
+
+    def _read_shard(self, shard, cid=None, rid=None):
+        shard_path = os.path.join(self.path, shard["file"])
+        if self.file_format == "gctx":
+            from cmapPy.pandasGEXpress.parse_gctx import parse as parse_gctx
+            data_df = parse_gctx(shard_path, cid=cid, rid=rid).data_df
+        else:
+            data_df = read_matrix(shard_path, cid=cid, rid=rid).data_df
+        data_df.index = data_df.index.astype(str)
+        return data_df
+
+
+def open_sharded_matrix(path):
+    """
+    Open a sharded matrix directory.
+
+    :param path: Directory containing manifest.json
+    :return: ShardedMatrix
+    """
+    return ShardedMatrix(os.path.abspath(os.path.expanduser(path)))
+
+
+def checksum(path):
+    """
+    sha256 of a file, or of every file under a directory (e.g. Zarr) in sorted order.
+
+    :param path: File or directory
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(root, fn) for root, _, fns in os.walk(path) for fn in fns
+        )
+    else:
+        files = [path]
+
+    for fn in files:
+        if os.path.isdir(path):
+            digest.update(os.path.relpath(fn, path).encode("utf-8"))
+        with open(fn, "rb") as fh:
+            for block in iter(lambda: fh.read(2 ** 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _shard_extension(file_format):
+    if file_format == "gctx":
+        return "gctx"
+    return get_extension(file_format)
@@ -0,0 +1,112 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class SparseMatrix:
+    """
+    Compressed sparse row matrix with one row per column id (signature) and one column per row id (gene),
+    e.g. the top and bottom genes of each signature. Row i holds values data[indptr[i]:indptr[i + 1]] at gene
+    positions indices[indptr[i]:indptr[i + 1]].
+    """
+    data: np.ndarray
+    indices: np.ndarray
+    indptr: np.ndarray
+    cids: np.ndarray
+    rids: np.ndarray
+
+    @property
+    def shape(self):
+        return len(self.cids), len(self.rids)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def row(self, cid):
+        """
+        Stored values of one signature, sorted descending.
+
+        :param cid: column id
+        :return: Pandas Series indexed by rid
+        """
+        i = int(np.flatnonzero(self.cids == cid)[0])
+        start, end = self.indptr[i], self.indptr[i + 1]
+        values = pd.Series(self.data[start:end], index=self.rids[self.indices[start:end]], name=cid)
+        values.index.name = "rid"
+        return values.sort_values(ascending=False)
+
+    def to_long(self):
+        """
+        :return: long-form Pandas DataFrame with cid, rid and value columns
+        """
+        counts = np.diff(self.indptr)
+        return pd.DataFrame({
+            "cid": np.repeat(self.cids, counts),
+            "rid": self.rids[self.indices],
+            "value": self.data,
+        })
+
+    def to_dataframe(self):
+        """
+        :return: dense Pandas DataFrame (rid x cid) with NaN for values not stored
+        """
+        return self.to_long().pivot(index="rid", columns="cid", values="value").reindex(
+            index=self.rids, columns=self.cids
+        )
+
+    def to_scipy(self):
+        """
+        :return: scipy.sparse.csr_matrix of shape (cid, rid). Requires scipy.
+        """
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+
+def long_to_sparse(df, rids=None):
+    """
+    Convert long-form DataFrame with 'cid', 'rid' and 'value' columns to a SparseMatrix.
+
+    :param df: Long form pandas DataFrame
+    :param rids: Optional gene universe. Default is the sorted rids present in df.
+    :return: SparseMatrix
+    """
+    df = df[["cid", "rid", "value"]].astype({"cid": str, "rid": str})
+    if rids is None:
+        rids = np.sort(df["rid"].unique())
+    rids = np.asarray(rids, dtype=object)
+    rid_pos = pd.Series(np.arange(len(rids)), index=rids)
+
+    cids, row_idx = np.unique(df["cid"].values, return_inverse=True)
+    col_idx = rid_pos.reindex(df["rid"].values).values
+    keep = ~np.isnan(col_idx)
+    row_idx, col_idx = row_idx[keep], col_idx[keep].astype(np.int32)
+    values = df["value"].values[keep].astype(np.float32)
+
+    order = np.lexsort((col_idx, row_idx))
+    indptr = np.zeros(len(cids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_idx, minlength=len(cids)), out=indptr[1:])
+
+    return SparseMatrix(
+        data=values[order],
+        indices=col_idx[order],
+        indptr=indptr,
+        cids=cids.astype(object),
+        rids=rids,
+    )
+
+
+def top_k_long(data_df, k):
+    """
+    Select the k highest and k lowest values of each column of a dense matrix.
+
+    :param data_df: Pandas DataFrame (rid x cid)
+    :param k: number of genes per end
+    :return: long-form Pandas DataFrame with cid, rid and value columns
+    """
+    df_long = data_df.rename_axis(index="rid", columns="cid").stack().rename("value").reset_index()
+    ranks_up = df_long.groupby("cid")["value"].rank(method="first", ascending=False)
+    ranks_down = df_long.groupby("cid")["value"].rank(method="first", ascending=True)
+    return df_long[(ranks_up <= k) | (ranks_down <= k)].reset_index(drop=True)
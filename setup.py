@@ -64,6 +64,9 @@ setup(
         'dacite',
         'pyarrow',
     ],
+    extras_require={
+        'zarr': ['zarr'],
+    },
     setup_requires=[
         'setuptools_scm>=3.3.1',
     ],